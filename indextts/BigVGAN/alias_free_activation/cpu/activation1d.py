@@ -0,0 +1,146 @@
+# Copyright (c) 2024 NVIDIA CORPORATION.
+#   Licensed under the MIT license.
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from indextts.BigVGAN.alias_free_activation.torch.resample import DownSample1d, UpSample1d
+
+
+def is_autocast_cpu_enabled() -> bool:
+    try:
+        return torch.is_autocast_enabled("cpu")
+    except TypeError:  # torch < 2.4
+        return torch.is_autocast_cpu_enabled()
+
+
+def activation_constants(activation1d, channels):
+    """
+    ``(up_filter, down_filter, alpha, inv_beta)`` of an anti-aliased Snake / SnakeBeta activation (any
+    ``Activation1d``): the upsampling filter scaled by ``up_ratio`` and the downsampling filter, expanded to the
+    channels, ``exp(alpha)`` and ``1 / (exp(beta) + eps)`` as (1, channels, 1).
+    """
+    act = activation1d.act
+    alpha = act.alpha.detach()
+    beta = getattr(act, "beta", act.alpha).detach()  # Snake uses the same params for alpha and beta
+    if act.alpha_logscale:
+        alpha, beta = torch.exp(alpha), torch.exp(beta)
+    inv_beta = 1.0 / (beta + act.no_div_by_zero)
+    return (
+        (activation1d.up_ratio * activation1d.upsample.filter).expand(channels, -1, -1).contiguous(),
+        activation1d.downsample.lowpass.filter.expand(channels, -1, -1).contiguous(),
+        alpha.view(1, -1, 1),
+        inv_beta.view(1, -1, 1),
+    )
+
+
+def anti_alias_snake(x, upsample, lowpass, up_filter, down_filter, alpha, inv_beta):
+    """
+    upsample -> ``x + inv_beta * sin(x * alpha) ** 2`` -> downsample, with the constants of `activation_constants()`
+    and the activation computed in place.
+    """
+    channels = x.shape[1]
+    x = F.pad(x, (upsample.pad, upsample.pad), mode="replicate")
+    x = F.conv_transpose1d(x, up_filter, stride=upsample.stride, groups=channels)
+    x = x[..., upsample.pad_left : -upsample.pad_right]
+    s = torch.mul(x, alpha).sin_()
+    s.mul_(s)
+    x = x.addcmul_(s, inv_beta)
+    del s
+    x = F.pad(x, (lowpass.pad_left, lowpass.pad_right), mode=lowpass.padding_mode)
+    return F.conv1d(x, down_filter, stride=lowpass.stride, groups=channels)
+
+
+class Activation1d(nn.Module):
+    """
+    CPU inference path of the anti-aliased Snake / SnakeBeta activation, drop-in for
+    `alias_free_torch.Activation1d` (same parameters and buffers).
+
+    The per-channel constants are computed once instead of at every call: the upsampling filter scaled by
+    ``up_ratio`` and expanded to the channels, the downsampling filter expanded to the channels, ``exp(alpha)``
+    and ``1 / (exp(beta) + eps)``. The activation is computed in place on the upsampled tensor, with a single
+    temporary for ``sin(x * alpha) ** 2``. The results match the unfused path.
+
+    Falls back to the unfused path when grad mode or autocast is enabled, or for inputs other than float32.
+    """
+
+    def __init__(
+        self,
+        activation,
+        up_ratio: int = 2,
+        down_ratio: int = 2,
+        up_kernel_size: int = 12,
+        down_kernel_size: int = 12,
+    ):
+        super().__init__()
+        self.up_ratio = up_ratio
+        self.down_ratio = down_ratio
+        self.act = activation
+        self.upsample = UpSample1d(up_ratio, up_kernel_size)
+        self.downsample = DownSample1d(down_ratio, down_kernel_size)
+        self._constants = None
+        self._constants_key = None
+
+    def constants(self, x):
+        """
+        `activation_constants()` for the channels and device of ``x``, recomputed when the parameters were updated
+        (e.g. by `load_state_dict()`) or moved.
+        """
+        alpha = self.act.alpha
+        beta = getattr(self.act, "beta", alpha)
+        key = (x.shape[1], x.device, alpha.data_ptr(), alpha._version, beta.data_ptr(), beta._version)
+        if key != self._constants_key:
+            self._constants = activation_constants(self, x.shape[1])
+            self._constants_key = key
+        return self._constants
+
+    # x: [B,C,T]
+    def forward(self, x):
+        if torch.is_grad_enabled() or is_autocast_cpu_enabled() or x.dtype != torch.float32:
+            return self.downsample(self.act(self.upsample(x)))
+        return anti_alias_snake(x, self.upsample, self.downsample.lowpass, *self.constants(x))
+
+
+class FrozenActivation1d(nn.Module):
+    """
+    Inference-only anti-aliased Snake / SnakeBeta activation of an exported BigVGAN (see `BigVGAN.freeze()`):
+    the constants of `activation_constants()` are buffers, the Snake parameters are dropped.
+    Runs on any device, without the CUDA kernel.
+    """
+
+    def __init__(
+        self,
+        channels: int,
+        up_ratio: int = 2,
+        down_ratio: int = 2,
+        up_kernel_size: int = 12,
+        down_kernel_size: int = 12,
+    ):
+        super().__init__()
+        self.up_ratio = up_ratio
+        self.down_ratio = down_ratio
+        # the filters and paddings, the filters used are the expanded buffers below
+        self.upsample = UpSample1d(up_ratio, up_kernel_size)
+        self.downsample = DownSample1d(down_ratio, down_kernel_size)
+        self.register_buffer("up_filter", torch.zeros(channels, 1, self.upsample.kernel_size))
+        self.register_buffer("down_filter", torch.zeros(channels, 1, self.downsample.kernel_size))
+        self.register_buffer("alpha", torch.ones(1, channels, 1))
+        self.register_buffer("inv_beta", torch.ones(1, channels, 1))
+
+    @classmethod
+    def from_activation(cls, activation1d) -> "FrozenActivation1d":
+        channels = activation1d.act.alpha.shape[0]
+        frozen = cls(channels, activation1d.up_ratio, activation1d.down_ratio,
+                     activation1d.upsample.kernel_size, activation1d.downsample.kernel_size)
+        frozen = frozen.to(activation1d.act.alpha.device)
+        with torch.no_grad():
+            for buffer, value in zip((frozen.up_filter, frozen.down_filter, frozen.alpha, frozen.inv_beta),
+                                     activation_constants(activation1d, channels)):
+                buffer.copy_(value)
+        return frozen
+
+    # x: [B,C,T]
+    def forward(self, x):
+        return anti_alias_snake(x, self.upsample, self.downsample.lowpass,
+                                self.up_filter, self.down_filter, self.alpha, self.inv_beta)
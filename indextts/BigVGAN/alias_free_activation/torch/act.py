@@ -3,7 +3,12 @@
 
 import torch.nn as nn
 
-from .resample import DownSample1d, UpSample1d
+from .resample import (
+    DownSample1d,
+    PolyphaseDownSample1d,
+    PolyphaseUpSample1d,
+    UpSample1d,
+)
 
 
 class Activation1d(nn.Module):
@@ -14,13 +19,19 @@ class Activation1d(nn.Module):
         down_ratio: int = 2,
         up_kernel_size: int = 12,
         down_kernel_size: int = 12,
+        polyphase: bool = False,
     ):
+        """
+        polyphase: use the polyphase resampling, same buffers and outputs.
+        """
         super().__init__()
         self.up_ratio = up_ratio
         self.down_ratio = down_ratio
         self.act = activation
-        self.upsample = UpSample1d(up_ratio, up_kernel_size)
-        self.downsample = DownSample1d(down_ratio, down_kernel_size)
+        upsample = PolyphaseUpSample1d if polyphase else UpSample1d
+        downsample = PolyphaseDownSample1d if polyphase else DownSample1d
+        self.upsample = upsample(up_ratio, up_kernel_size)
+        self.downsample = downsample(down_ratio, down_kernel_size)
 
     # x: [B,C,T]
     def forward(self, x):
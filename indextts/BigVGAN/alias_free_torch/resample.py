@@ -1,6 +1,7 @@
 # Adapted from https://github.com/junjun3518/alias-free-torch under the Apache License 2.0
 #   LICENSE is in incl_licenses directory.
 
+import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
@@ -46,4 +47,85 @@ class DownSample1d(nn.Module):
     def forward(self, x):
         xx = self.lowpass(x)
 
-        return xx
\ No newline at end of file
+        return xx
+
+
+class PolyphaseUpSample1d(UpSample1d):
+    """
+    `UpSample1d` computed per output phase: ``ratio`` convolutions of ``kernel_size // ratio`` taps at the input
+    rate, interleaved, instead of a transposed convolution of the zero-stuffed input.
+    Same buffers as `UpSample1d`, the outputs match within float rounding.
+    """
+
+    def __init__(self, ratio=2, kernel_size=None):
+        super().__init__(ratio, kernel_size)
+        if self.kernel_size % ratio != 0:
+            raise ValueError(f"kernel_size ({self.kernel_size}) must be a multiple of ratio ({ratio})")
+        self._phase_filters = None
+        self._phase_key = None
+
+    def phase_filters(self, channels):
+        """
+        (ratio, channels, 1, kernel_size // ratio) filters of the output phases, scaled by ``ratio``
+        """
+        key = (channels, self.filter.device, self.filter.dtype, self.filter._version)
+        if key != self._phase_key:
+            # output ``ratio * j + r`` sums ``x[j - i] * filter[ratio * i + r]``
+            taps = self.ratio * self.filter.view(-1, self.ratio).flip(0).t()
+            self._phase_filters = taps.view(self.ratio, 1, 1, -1).expand(-1, channels, -1, -1).contiguous()
+            self._phase_key = key
+        return self._phase_filters
+
+    # x: [B, C, T]
+    def forward(self, x):
+        B, C, T = x.shape
+        filters = self.phase_filters(C)
+
+        x = F.pad(x, (self.pad, self.pad), mode='replicate')
+        x = torch.stack([F.conv1d(x, f, groups=C) for f in filters], dim=-1).view(B, C, -1)
+        start = (self.kernel_size - self.ratio) // 2
+        x = x[..., start : start + self.ratio * T]
+
+        return x
+
+
+class PolyphaseDownSample1d(DownSample1d):
+    """
+    `DownSample1d` computed per input phase: the sum of ``ratio`` convolutions of ``kernel_size // ratio`` taps
+    at the output rate, so only the kept samples are computed.
+    Same buffers as `DownSample1d`, the outputs match within float rounding.
+    """
+
+    def __init__(self, ratio=2, kernel_size=None):
+        super().__init__(ratio, kernel_size)
+        if self.kernel_size % ratio != 0:
+            raise ValueError(f"kernel_size ({self.kernel_size}) must be a multiple of ratio ({ratio})")
+        self._phase_filters = None
+        self._phase_key = None
+
+    def phase_filters(self, channels):
+        """
+        (ratio, channels, 1, kernel_size // ratio) filters of the input phases
+        """
+        filter = self.lowpass.filter
+        key = (channels, filter.device, filter.dtype, filter._version)
+        if key != self._phase_key:
+            # output ``j`` sums ``x[ratio * (j + i) + r] * filter[ratio * i + r]``
+            taps = filter.view(-1, self.ratio).t()
+            self._phase_filters = taps.view(self.ratio, 1, 1, -1).expand(-1, channels, -1, -1).contiguous()
+            self._phase_key = key
+        return self._phase_filters
+
+    def forward(self, x):
+        C = x.shape[1]
+        lowpass = self.lowpass
+        filters = self.phase_filters(C)
+
+        if lowpass.padding:
+            x = F.pad(x, (lowpass.pad_left, lowpass.pad_right), mode=lowpass.padding_mode)
+        length = (x.shape[-1] - lowpass.kernel_size) // self.ratio + 1
+        xx = F.conv1d(x[..., 0 :: self.ratio], filters[0], groups=C)[..., :length]
+        for r in range(1, self.ratio):
+            xx = xx + F.conv1d(x[..., r :: self.ratio], filters[r], groups=C)[..., :length]
+
+        return xx
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import torch
+from omegaconf import OmegaConf
+
+from indextts.BigVGAN.models import BigVGAN
+
+
+def export_inference(model_dir: str, cfg_path: str = None) -> str:
+    """
+    Export the BigVGAN generator of ``model_dir`` as a frozen inference module (`BigVGAN.freeze()`), saved as
+    ``{model_dir}/bigvgan_inference.pth`` and loaded by `IndexTTS` instead of the generator checkpoint.
+    """
+    cfg = OmegaConf.load(cfg_path or os.path.join(model_dir, "config.yaml"))
+    bigvgan_path = os.path.join(model_dir, cfg.bigvgan_checkpoint)
+    bigvgan = BigVGAN(cfg.bigvgan)
+    bigvgan.load_state_dict(torch.load(bigvgan_path, map_location="cpu")["generator"])
+    bigvgan.eval().freeze()
+    return bigvgan.export_inference(os.path.join(model_dir, BigVGAN.inference_filename), source=bigvgan_path)
+
+
+if __name__ == "__main__":
+    """
+    Export the frozen BigVGAN inference module of a checkpoint dir.
+    ```
+    python -m indextts.BigVGAN.export checkpoints [config.yaml]
+    ```
+    `IndexTTS` loads the generator checkpoint instead when it was updated after the export, run it again.
+    """
+    if len(sys.argv) < 2:
+        print("Usage: python -m indextts.BigVGAN.export <model_dir> [config.yaml]")
+        sys.exit(1)
+    print(">> saved to:", export_inference(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None))
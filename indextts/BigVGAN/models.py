@@ -3,9 +3,14 @@
 
 # Adapted from https://github.com/jik876/hifi-gan under the MIT license.
 #   LICENSE is in incl_licenses directory.
+import math
+import os
+
 import torch
+import torch.ao.nn.quantized as nnq
 import torch.nn as nn
 import torch.nn.functional as F
+from omegaconf import OmegaConf
 from torch.nn import Conv1d, Conv2d, ConvTranspose1d
 from torch.nn.utils import remove_weight_norm, spectral_norm, weight_norm
 
@@ -17,6 +22,25 @@ from indextts.BigVGAN.utils import get_padding, init_weights
 LRELU_SLOPE = 0.1
 
 
+def _zero_padding(x, padding):
+    """
+    ``x`` (b, ch, t) with the samples where ``padding`` (b, 1, t) is True set to 0, ``x`` when ``padding`` is None.
+    """
+    return x if padding is None else x.masked_fill(padding, 0.0)
+
+
+def _replicate_padding(x, padding):
+    """
+    ``x`` (b, ch, t) with the samples where ``padding`` (b, 1, t) is True set to the last sample before them: the
+    `Activation1d` resampling filters then see the replicate padding of the end of the signal.
+    """
+    if padding is None:
+        return x
+    last = ((~padding).sum(-1, keepdim=True) - 1).clamp(min=0)
+    index = torch.minimum(torch.arange(x.shape[-1], device=x.device), last)
+    return x.gather(-1, index.expand(-1, x.shape[1], -1))
+
+
 class AMPBlock1(torch.nn.Module):
     def __init__(self, h, channels, kernel_size=3, dilation=(1, 3, 5), activation=None):
         super(AMPBlock1, self).__init__()
@@ -45,6 +69,8 @@ class AMPBlock1(torch.nn.Module):
         self.num_layers = len(self.convs1) + len(self.convs2)  # total number of conv layers
         if self.h.get("use_cuda_kernel", False):
             from indextts.BigVGAN.alias_free_activation.cuda.activation1d import Activation1d
+        elif self.h.get("use_cpu_kernel", False):
+            from indextts.BigVGAN.alias_free_activation.cpu.activation1d import Activation1d
         else:
             from indextts.BigVGAN.alias_free_torch import Activation1d
         if activation == 'snake':  # periodic nonlinearity with snake function and anti-aliasing
@@ -62,13 +88,14 @@ class AMPBlock1(torch.nn.Module):
         else:
             raise NotImplementedError("activation incorrectly specified. check the config file and look for 'activation'.")
 
-    def forward(self, x):
+    def forward(self, x, padding=None):
+        # padding: (b, 1, t) True on the padding samples of a padded batch, see `BigVGAN.forward()`
         acts1, acts2 = self.activations[::2], self.activations[1::2]
         for c1, c2, a1, a2 in zip(self.convs1, self.convs2, acts1, acts2):
-            xt = a1(x)
-            xt = c1(xt)
-            xt = a2(xt)
-            xt = c2(xt)
+            xt = _zero_padding(a1(_replicate_padding(x, padding)), padding)
+            xt = _zero_padding(c1(xt), padding)
+            xt = _zero_padding(a2(_replicate_padding(xt, padding)), padding)
+            xt = _zero_padding(c2(xt), padding)
             x = xt + x
 
         return x
@@ -96,6 +123,8 @@ class AMPBlock2(torch.nn.Module):
         self.num_layers = len(self.convs)  # total number of conv layers
         if self.h.get("use_cuda_kernel", False):
             from indextts.BigVGAN.alias_free_activation.cuda.activation1d import Activation1d
+        elif self.h.get("use_cpu_kernel", False):
+            from indextts.BigVGAN.alias_free_activation.cpu.activation1d import Activation1d
         else:
             from indextts.BigVGAN.alias_free_torch import Activation1d
 
@@ -114,10 +143,10 @@ class AMPBlock2(torch.nn.Module):
         else:
             raise NotImplementedError("activation incorrectly specified. check the config file and look for 'activation'.")
 
-    def forward(self, x):
+    def forward(self, x, padding=None):
         for c, a in zip(self.convs, self.activations):
-            xt = a(x)
-            xt = c(xt)
+            xt = _zero_padding(a(_replicate_padding(x, padding)), padding)
+            xt = _zero_padding(c(xt), padding)
             x = xt + x
 
         return x
@@ -129,15 +158,23 @@ class AMPBlock2(torch.nn.Module):
 
 class BigVGAN(torch.nn.Module):
     # this is our main BigVGAN model. Applies anti-aliased periodic activation for resblocks.
-    def __init__(self, h, use_cuda_kernel=False):
+    # frozen inference module in the checkpoint dir, see `export_inference()`
+    inference_filename = "bigvgan_inference.pth"
+    # static int8 module for CPU, see `indextts.BigVGAN.quantization`
+    int8_inference_filename = "bigvgan_int8.pth"
+
+    def __init__(self, h, use_cuda_kernel=False, use_cpu_kernel=False):
         """
         Args:
             h (dict)
             use_cuda_kernel (bool): whether to use custom cuda kernel for anti-aliased activation
+            use_cpu_kernel (bool): whether to use the CPU inference path of the anti-aliased activation
+                (`alias_free_activation.cpu.activation1d`), ignored with ``use_cuda_kernel``
         """
         super(BigVGAN, self).__init__()
         self.h = h
         self.h["use_cuda_kernel"] = use_cuda_kernel
+        self.h["use_cpu_kernel"] = use_cpu_kernel
 
         self.num_kernels = len(h.resblock_kernel_sizes)
         self.num_upsamples = len(h.upsample_rates)
@@ -168,6 +205,8 @@ class BigVGAN(torch.nn.Module):
                 self.resblocks.append(resblock(self.h, ch, k, d, activation=h.activation))
         if use_cuda_kernel:
             from indextts.BigVGAN.alias_free_activation.cuda.activation1d import Activation1d
+        elif use_cpu_kernel:
+            from indextts.BigVGAN.alias_free_activation.cpu.activation1d import Activation1d
         else:
             from indextts.BigVGAN.alias_free_torch import Activation1d
 
@@ -197,17 +236,60 @@ class BigVGAN(torch.nn.Module):
                 self.conds.append(nn.Conv1d(h.speaker_embedding_dim, ch, 1))
 
         # self.logit_scale = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
+        # inference module exported by `freeze()`
+        self.frozen = False
+        # settings of `quantize_static_int8()`
+        self.quantization = None
 
-    def forward(self, x, mel_ref, lens=None):
-        speaker_embedding = self.speaker_encoder(mel_ref, lens)
-        n_batch = x.size(0)
-        contrastive_loss = None
-        if n_batch * 2 == speaker_embedding.size(0):
-            spe_emb_chunk1, spe_emb_chunk2 = speaker_embedding[:n_batch, :, :], speaker_embedding[n_batch:, :, :]
-            contrastive_loss = self.cal_clip_loss(spe_emb_chunk1.squeeze(1), spe_emb_chunk2.squeeze(1), self.logit_scale.exp())
+    def get_speaker_embedding(self, mel_ref, lens=None):
+        """
+        Args:
+            mel_ref: (b, frames, n_mels) reference mel spectrogram
+        Returns:
+            speaker_embedding: (b, 1, speaker_embedding_dim)
+        """
+        return self.speaker_encoder(mel_ref, lens)
 
-            speaker_embedding = speaker_embedding[:n_batch, :, :]
+    def get_speaker_conds(self, speaker_embedding):
+        """
+        Project the speaker embedding to the bias terms added after `conv_pre` and after each upsampling layer.
+        They only depend on the voice, so they can be computed once and reused for every `forward()`.
+        Args:
+            speaker_embedding: (b, 1, speaker_embedding_dim)
+        Returns:
+            speaker_conds: list of (b, ch, 1), ``[cond_layer(emb), conds[0](emb), ..., conds[n-1](emb)]``
+        """
         speaker_embedding = speaker_embedding.transpose(1, 2)
+        speaker_conds = [self.cond_layer(speaker_embedding)]
+        if self.cond_in_each_up_layer:
+            speaker_conds.extend(cond(speaker_embedding) for cond in self.conds)
+        return speaker_conds
+
+    def forward(self, x, mel_ref=None, lens=None, speaker_embedding=None, speaker_conds=None, lengths=None):
+        """
+        Args:
+            x: (b, frames, gpt_dim) GPT latents, right padded when ``lengths`` is given
+            mel_ref: (b, frames, n_mels) reference mel, only used when neither ``speaker_embedding`` nor ``speaker_conds`` is given
+            speaker_embedding: (b, 1, speaker_embedding_dim) precomputed by `get_speaker_embedding()`
+            speaker_conds: precomputed by `get_speaker_conds()`, skips the speaker encoder and the conditioning layers
+            lengths: (b,) number of latent frames of each row, the padding samples are zeroed after each layer and
+                set to the last sample of the row before each activation, so that a padded row decodes as on its own
+                up to float rounding. Trim row ``i`` to ``lengths[i] * hop_length`` samples.
+        """
+        contrastive_loss = None
+        if lengths is not None:
+            padding = torch.arange(x.shape[1], device=x.device) >= lengths.unsqueeze(1)
+            x = x.masked_fill(padding.unsqueeze(-1), 0.0)
+        if speaker_conds is None:
+            if speaker_embedding is None:
+                speaker_embedding = self.get_speaker_embedding(mel_ref, lens)
+            n_batch = x.size(0)
+            if not self.frozen and n_batch * 2 == speaker_embedding.size(0):
+                spe_emb_chunk1, spe_emb_chunk2 = speaker_embedding[:n_batch, :, :], speaker_embedding[n_batch:, :, :]
+                contrastive_loss = self.cal_clip_loss(spe_emb_chunk1.squeeze(1), spe_emb_chunk2.squeeze(1), self.logit_scale.exp())
+
+                speaker_embedding = speaker_embedding[:n_batch, :, :]
+            speaker_conds = self.get_speaker_conds(speaker_embedding)
 
         # upsample feat
         if self.feat_upsample:
@@ -220,10 +302,16 @@ class BigVGAN(torch.nn.Module):
             x = x.transpose(1, 2)
 
         ### bigVGAN ###
+        # samples per latent frame at the current layer. The padding is zeroed again after each layer that adds a
+        # bias or the speaker conds, the convs of the last samples of a row then see zeros as at the end of the signal
+        scale = 4 if self.feat_upsample else 1
+        padding = None if lengths is None else self._padding(lengths, x.shape[-1], scale)
+        x = _zero_padding(x, padding)
+
         # pre conv
         x = self.conv_pre(x)
 
-        x = x + self.cond_layer(speaker_embedding)
+        x = _zero_padding(x + speaker_conds[0], padding)
 
         for i in range(self.num_upsamples):
             # upsampling
@@ -231,24 +319,122 @@ class BigVGAN(torch.nn.Module):
                 x = self.ups[i][i_up](x)
 
             if self.cond_in_each_up_layer:
-                x = x + self.conds[i](speaker_embedding)
+                x = x + speaker_conds[i + 1]
+            scale *= self.h.upsample_rates[i]
+            padding = None if lengths is None else self._padding(lengths, x.shape[-1], scale)
+            x = _zero_padding(x, padding)
 
             # AMP blocks
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
+                    xs = self.resblocks[i * self.num_kernels + j](x, padding)
                 else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
+                    xs += self.resblocks[i * self.num_kernels + j](x, padding)
             x = xs / self.num_kernels
 
         # post conv
-        x = self.activation_post(x)
+        x = _zero_padding(self.activation_post(_replicate_padding(x, padding)), padding)
         x = self.conv_post(x)
-        x = torch.tanh(x)
+        x = _zero_padding(torch.tanh(x), padding)
 
         return x, contrastive_loss
 
+    @staticmethod
+    def _padding(lengths, size, scale):
+        """
+        (b, 1, size) True on the samples after ``lengths * scale``, the padding of a right padded batch of
+        ``lengths`` latent frames at ``scale`` samples per frame.
+        """
+        return (torch.arange(size, device=lengths.device) >= (lengths * scale).unsqueeze(1)).unsqueeze(1)
+
+    @property
+    def hop_length(self) -> int:
+        """
+        Number of samples per latent frame
+        """
+        return math.prod(self.h.upsample_rates) * (4 if self.feat_upsample else 1)
+
+    def receptive_field(self) -> int:
+        """
+        Upper bound of the number of latent frames, on each side of a frame, that affect its samples.
+        """
+
+        def activation_field(activation):
+            # in samples before the upsampling of the anti-aliased activation
+            return (activation.upsample.kernel_size + activation.downsample.kernel_size) / activation.up_ratio / 2
+
+        def conv(module):
+            # unwrap the `QuantWrapper` of the int8 module
+            return getattr(module, "module", module)
+
+        def block_field(block):
+            convs = sum(conv.dilation[0] * (conv.kernel_size[0] - 1) // 2 for conv in block.modules()
+                        if isinstance(conv, (Conv1d, nnq.Conv1d)))
+            return convs + sum(activation_field(a) for a in block.activations)
+
+        # in latent frames, ``scale`` is the number of samples per frame of the current layer
+        field = 1.0 if self.feat_upsample else 0.0
+        scale = 4 if self.feat_upsample else 1
+        field += conv(self.conv_pre).padding[0] / scale
+        for i in range(self.num_upsamples):
+            for up in map(conv, self.ups[i]):
+                k, u, p = up.kernel_size[0], up.stride[0], up.padding[0]
+                field += (max(p, k - 1 - p) // u + 1) / scale
+                scale *= u
+            field += max(block_field(self.resblocks[i * self.num_kernels + j]) for j in range(self.num_kernels)) / scale
+        field += (activation_field(self.activation_post) + conv(self.conv_post).padding[0]) / scale
+        return math.ceil(field)
+
+    def inference_tiled(self, x, speaker_conds, tile_size=200, context=None, crossfade=2, lengths=None):
+        """
+        Decode long latents window by window, so the peak activation memory is bounded by the window size
+        instead of the length of ``x``.
+
+        Every window vocodes ``tile_size + crossfade`` frames with ``context`` frames on both sides, consecutive
+        windows overlap by ``crossfade`` frames which are linearly crossfaded. With the default ``context``
+        (`receptive_field()`) the samples match `forward()` up to float rounding.
+
+        Args:
+            x: (b, frames, gpt_dim) GPT latents
+            speaker_conds: precomputed by `get_speaker_conds()`
+            tile_size (int): number of new frames per window
+            context (None | int): number of frames of context on each side, defaults to `receptive_field()`
+            crossfade (int): number of frames crossfaded between consecutive windows
+            lengths: (b,) number of latent frames of each row of a padded batch, see `forward()`
+        Returns:
+            wav: (b, 1, frames * hop_length)
+        """
+        if tile_size <= 0 or crossfade < 0 or (context is not None and context < 0):
+            raise ValueError(f"Invalid tiling: tile_size={tile_size}, context={context}, crossfade={crossfade}")
+        num_frames = x.shape[1]
+        if num_frames <= tile_size + crossfade:
+            return self(x, speaker_conds=speaker_conds, lengths=lengths)[0]
+        if context is None:
+            context = self.receptive_field()
+        hop_length = self.hop_length
+        overlap = crossfade * hop_length
+        fade_in = (torch.arange(overlap, device=x.device, dtype=torch.float32) + 0.5) / max(overlap, 1)
+        wavs = []
+        tail = None
+        start = 0
+        while True:
+            end = min(start + tile_size + crossfade, num_frames)
+            left, right = max(0, start - context), min(num_frames, end + context)
+            wav, _ = self(x[:, left:right], speaker_conds=speaker_conds,
+                          lengths=None if lengths is None else (lengths - left).clamp(min=0))
+            wav = wav[..., (start - left) * hop_length : (end - left) * hop_length]
+            if tail is not None:
+                fade = fade_in.to(wav.dtype)
+                wav = torch.cat([tail * (1 - fade) + wav[..., :overlap] * fade, wav[..., overlap:]], dim=-1)
+            if end == num_frames:
+                wavs.append(wav)
+                break
+            wavs.append(wav[..., : wav.shape[-1] - overlap])
+            tail = wav[..., wav.shape[-1] - overlap :]
+            start = end - crossfade
+        return torch.cat(wavs, dim=-1)
+
     def remove_weight_norm(self):
         print('Removing weight norm...')
         for l in self.ups:
@@ -259,6 +445,74 @@ class BigVGAN(torch.nn.Module):
         remove_weight_norm(self.conv_pre)
         remove_weight_norm(self.conv_post)
 
+    def freeze(self):
+        """
+        Convert the loaded generator to an inference-only module, in place: weight norm folded, the anti-aliased
+        activations replaced by `FrozenActivation1d` (constants precomputed, filters expanded to the channels),
+        no contrastive loss branch. Save it with `export_inference()`.
+        """
+        from indextts.BigVGAN.alias_free_activation.cpu.activation1d import FrozenActivation1d
+
+        if self.frozen:
+            return self
+        if hasattr(self.conv_pre, "weight_g"):
+            self.remove_weight_norm()
+        for module in list(self.modules()):
+            for name, child in list(module.named_children()):
+                if hasattr(child, "act") and hasattr(child, "upsample"):
+                    setattr(module, name, FrozenActivation1d.from_activation(child))
+        self.frozen = True
+        self.h["use_cuda_kernel"] = False
+        return self.eval()
+
+    @staticmethod
+    def checkpoint_signature(path):
+        """
+        Size and modification time of the generator checkpoint an inference module is exported from,
+        cheap to check at every load unlike a hash of the file.
+        """
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def export_inference(self, path, source=None):
+        """
+        Save the frozen inference module with its config, loaded back by `load_inference()`.
+        ``source`` is the generator checkpoint it was loaded from, its `checkpoint_signature()` is saved.
+        """
+        if not self.frozen:
+            raise ValueError("BigVGAN.freeze() must be called before export_inference()")
+        config = OmegaConf.to_container(self.h) if OmegaConf.is_config(self.h) else dict(self.h)
+        torch.save({"config": config, "quantization": self.quantization,
+                    "source": None if source is None else self.checkpoint_signature(source),
+                    "state_dict": self.state_dict()}, path)
+        return path
+
+    @classmethod
+    def load_inference(cls, path, map_location="cpu", source=None) -> "BigVGAN":
+        """
+        Load a module saved by `export_inference()`, the modules are built on the meta device and the saved
+        tensors are assigned, without random initialization nor weight norm. The int8 modules of
+        `quantize_static_int8()` are loaded on CPU.
+        Raises `ValueError` if ``source`` is given and the module was not exported from that generator checkpoint
+        as it is now (e.g. the checkpoint was updated after the export).
+        """
+        from indextts.BigVGAN.quantization import quantized_engine, quantized_structure
+
+        checkpoint = torch.load(path, map_location=map_location)
+        if source is not None and checkpoint.get("source") != cls.checkpoint_signature(source):
+            raise ValueError(f"{path} was not exported from the current {source}, export it again")
+        with torch.device("meta"):
+            model = cls(OmegaConf.create(checkpoint["config"]))
+            model.freeze()
+        quantization = checkpoint.get("quantization")
+        if quantization:
+            quantized_structure(model, quantization["min_channels"])
+            with quantized_engine(quantization["engine"]):
+                model.load_state_dict(checkpoint["state_dict"], assign=True)
+        else:
+            model.load_state_dict(checkpoint["state_dict"], assign=True)
+        return model.eval()
+
     def cal_clip_loss(self, image_features, text_features, logit_scale):
         device = image_features.device
         logits_per_image, logits_per_text = self.get_logits(image_features, text_features, logit_scale)
@@ -0,0 +1,202 @@
+import contextlib
+import os
+import sys
+from typing import Iterable, List
+
+import torch
+import torch.ao.nn.quantized as nnq
+import torch.nn as nn
+from torch.ao.quantization import QuantWrapper, convert, get_default_qconfig, prepare
+
+# the x86 / onednn engines return wrong results for the quantized ConvTranspose1d
+QUANTIZED_ENGINE = "fbgemm"
+
+
+@contextlib.contextmanager
+def quantized_engine(engine=QUANTIZED_ENGINE):
+    """
+    Select the quantized engine while the weights are packed (`convert()` and `load_state_dict()`), the packed
+    weights keep their engine afterwards.
+    """
+    previous = torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    try:
+        yield
+    finally:
+        torch.backends.quantized.engine = previous
+
+
+def quantizable_convs(bigvgan, min_channels=128):
+    """
+    ``(parent, name, conv)`` of the `Conv1d` / `ConvTranspose1d` of the generator with at least ``min_channels``
+    input channels: ``conv_pre``, the upsamplers and the convolutions of the AMP blocks.
+    Below ~128 channels the int8 `Conv1d` is not faster than float32 on long inputs, the `ConvTranspose1d`
+    upsamplers are always faster. ``conv_post`` stays in float, its int8 output would be the waveform on 256 levels.
+    The speaker encoder and the conditioning layers stay in float too, they run once per voice.
+    """
+    parents = [(bigvgan, "conv_pre")]
+    parents += [(up, str(i)) for up in bigvgan.ups for i in range(len(up))]
+    for block in bigvgan.resblocks:
+        for convs in (getattr(block, "convs1", None), getattr(block, "convs2", None), getattr(block, "convs", None)):
+            if convs is not None:
+                parents += [(convs, str(i)) for i in range(len(convs))]
+    for parent, name in parents:
+        conv = getattr(parent, name)
+        if isinstance(conv, nn.ConvTranspose1d) or (isinstance(conv, nn.Conv1d) and conv.in_channels >= min_channels):
+            yield parent, name, conv
+
+
+def quantize_static_int8(bigvgan, calibration: Iterable, min_channels=128):
+    """
+    Post-training static int8 quantization of a BigVGAN generator, in place, on CPU: the selected convolutions
+    (see `quantizable_convs()`) get int8 weights and int8 inputs with the scales observed on ``calibration``.
+    The Snake activations, residual sums and the speaker conditioning stay in float32, each quantized convolution
+    quantizes its input and returns float32. The model is frozen first (`BigVGAN.freeze()`).
+
+    Args:
+        bigvgan: float32 `BigVGAN` on CPU
+        calibration: ``(latent, speaker_conds, lengths)`` of real inference runs, see `CalibrationRecorder`
+        min_channels (int): min input channels of the quantized `Conv1d`
+    """
+    bigvgan.freeze()
+    qconfig = get_default_qconfig(QUANTIZED_ENGINE)
+    for parent, name, conv in list(quantizable_convs(bigvgan, min_channels)):
+        wrapper = QuantWrapper(conv)
+        # per-channel weights are not supported by the quantized ConvTranspose1d
+        wrapper.qconfig = qconfig if isinstance(conv, nn.Conv1d) else torch.ao.quantization.QConfig(
+            activation=qconfig.activation, weight=torch.ao.quantization.default_weight_observer)
+        setattr(parent, name, wrapper)
+    prepare(bigvgan, inplace=True)
+    with torch.no_grad():
+        for latent, speaker_conds, lengths in calibration:
+            bigvgan(latent, speaker_conds=speaker_conds, lengths=lengths)
+    with quantized_engine():
+        convert(bigvgan, inplace=True)
+    bigvgan.quantization = {"min_channels": min_channels, "engine": QUANTIZED_ENGINE}
+    return bigvgan
+
+
+def quantized_structure(bigvgan, min_channels=128):
+    """
+    Replace in place the convolutions selected by `quantizable_convs()` of a frozen BigVGAN by empty quantized
+    modules, the layout of `quantize_static_int8()` to load its state dict into.
+    """
+    with torch.device("cpu"):
+        for parent, name, conv in list(quantizable_convs(bigvgan, min_channels)):
+            quantized = nnq.ConvTranspose1d if isinstance(conv, nn.ConvTranspose1d) else nnq.Conv1d
+            kwargs = dict(stride=conv.stride, padding=conv.padding, dilation=conv.dilation, groups=conv.groups,
+                          bias=conv.bias is not None)
+            if quantized is nnq.ConvTranspose1d:
+                kwargs["output_padding"] = conv.output_padding
+            wrapper = QuantWrapper(quantized(conv.in_channels, conv.out_channels, conv.kernel_size, **kwargs))
+            wrapper.quant = nnq.Quantize(1.0, 0, torch.quint8)
+            wrapper.dequant = nnq.DeQuantize()
+            setattr(parent, name, wrapper)
+    bigvgan.quantization = {"min_channels": min_channels, "engine": QUANTIZED_ENGINE}
+    return bigvgan
+
+
+class CalibrationRecorder:
+    """
+    Records the inputs of `BigVGAN.forward()` while it is used, e.g. by `IndexTTS.infer()`, as the calibration
+    data of `quantize_static_int8()`.
+    ```
+    with CalibrationRecorder(tts.bigvgan) as recorder:
+        tts.infer(audio_prompt, text, None)
+    quantize_static_int8(tts.bigvgan, recorder.inputs)
+    ```
+    """
+
+    def __init__(self, bigvgan):
+        self.bigvgan = bigvgan
+        self.inputs: List = []
+        self.handle = None
+
+    def _hook(self, module, args, kwargs):
+        self.inputs.append((args[0].detach().cpu(), [c.detach().cpu() for c in kwargs["speaker_conds"]],
+                            None if kwargs.get("lengths") is None else kwargs["lengths"].cpu()))
+
+    def __enter__(self):
+        self.handle = self.bigvgan.register_forward_pre_hook(self._hook, with_kwargs=True)
+        return self
+
+    def __exit__(self, *exc):
+        self.handle.remove()
+
+
+def multi_resolution_stft_distance(wav, reference, resolutions=((512, 128), (1024, 256), (2048, 512))) -> float:
+    """
+    Multi-resolution STFT distance of ``wav`` to ``reference`` (…, samples), averaged over the resolutions
+    ``(n_fft, hop_length)``: spectral convergence ``|| |S| - |S_ref| || / || |S_ref| ||`` plus the mean absolute
+    difference of the log magnitudes. ``0`` for identical signals.
+    """
+    wav, reference = wav.reshape(-1, wav.shape[-1]).float(), reference.reshape(-1, reference.shape[-1]).float()
+    distance = 0.0
+    for n_fft, hop_length in resolutions:
+        window = torch.hann_window(n_fft, device=wav.device)
+        mag, ref_mag = (torch.stft(w, n_fft, hop_length, window=window, pad_mode="constant", return_complex=True)
+                        .abs().clamp_min(1e-7) for w in (wav, reference))
+        distance += (torch.linalg.norm(mag - ref_mag) / torch.linalg.norm(ref_mag)).item()
+        distance += (mag.log() - ref_mag.log()).abs().mean().item()
+    return distance / len(resolutions)
+
+
+@torch.no_grad()
+def stft_distance(float_model, int8_model, inputs) -> float:
+    """
+    Mean `multi_resolution_stft_distance()` of the int8 outputs to the float32 outputs over ``inputs``,
+    the ``(latent, speaker_conds, lengths)`` of `CalibrationRecorder`.
+    """
+    distances = [
+        multi_resolution_stft_distance(int8_model(latent, speaker_conds=speaker_conds, lengths=lengths)[0],
+                                       float_model(latent, speaker_conds=speaker_conds, lengths=lengths)[0])
+        for latent, speaker_conds, lengths in inputs
+    ]
+    return sum(distances) / len(distances)
+
+
+def export_int8(model_dir: str, audio_prompt: str, texts: List[str], max_stft_distance=0.5, min_channels=128,
+                **generation_kwargs) -> str:
+    """
+    Calibrate the int8 BigVGAN of ``model_dir`` on the latents of `IndexTTS.infer()` for ``texts``, check it
+    against float32 and save it as ``{model_dir}/bigvgan_int8.pth``, loaded by ``IndexTTS(bigvgan_int8=True)``.
+    The last text is held out of the calibration for the quality guard: raises `ValueError` without saving when
+    the multi-resolution STFT distance to float32 is above ``max_stft_distance``.
+    ``generation_kwargs`` are passed to `IndexTTS.infer()`.
+    """
+    import copy
+
+    from indextts.BigVGAN.models import BigVGAN
+    from indextts.infer import IndexTTS
+
+    if len(texts) < 2:
+        raise ValueError("at least 2 texts are needed: calibration and quality check")
+    tts = IndexTTS(cfg_path=os.path.join(model_dir, "config.yaml"), model_dir=model_dir, device="cpu")
+    with CalibrationRecorder(tts.bigvgan) as recorder:
+        for text in texts[:-1]:
+            tts.infer(audio_prompt, text, None, **generation_kwargs)
+    calibration = recorder.inputs
+    with CalibrationRecorder(tts.bigvgan) as recorder:
+        tts.infer(audio_prompt, texts[-1], None, **generation_kwargs)
+    int8_model = quantize_static_int8(copy.deepcopy(tts.bigvgan), calibration, min_channels=min_channels)
+    distance = stft_distance(tts.bigvgan, int8_model, recorder.inputs)
+    print(f">> int8 BigVGAN multi-resolution STFT distance to float32: {distance:.4f}")
+    if distance > max_stft_distance:
+        raise ValueError(f"int8 BigVGAN rejected, STFT distance {distance:.4f} > {max_stft_distance}")
+    return int8_model.export_inference(os.path.join(model_dir, BigVGAN.int8_inference_filename), source=tts.bigvgan_path)
+
+
+if __name__ == "__main__":
+    """
+    Calibrate, check and export the static int8 BigVGAN of a checkpoint dir, for CPU inference.
+    ```
+    python -m indextts.BigVGAN.quantization checkpoints prompt.wav texts.txt
+    ```
+    ``texts.txt`` holds one text per line, the last one is held out for the quality check.
+    """
+    if len(sys.argv) < 4:
+        print("Usage: python -m indextts.BigVGAN.quantization <model_dir> <prompt.wav> <texts.txt>")
+        sys.exit(1)
+    with open(sys.argv[3], encoding="utf-8") as f:
+        texts = [line.strip() for line in f if line.strip()]
+    print(">> saved to:", export_int8(sys.argv[1], sys.argv[2], texts))
@@ -0,0 +1,251 @@
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+
+from indextts.utils.mel_length import ForcedStopLogitsProcessor
+
+
+def process_logits(scores: torch.Tensor, seen: torch.Tensor, do_sample: torch.Tensor, temperature: torch.Tensor,
+                   top_k: torch.Tensor, top_p: torch.Tensor, repetition_penalty: torch.Tensor) -> torch.Tensor:
+    """
+    Per-row version of the HF `RepetitionPenaltyLogitsProcessor` and the sampling warpers
+    (`TemperatureLogitsWarper`, `TopKLogitsWarper`, `TopPLogitsWarper`), so every row can use its own settings.
+    Args:
+        scores: (b, V) float32 logits of the next token
+        seen: (b, V) bool, tokens of the inputs and the generated codes, penalized by ``repetition_penalty``
+        do_sample: (b,) bool, the warpers are only applied to the sampling rows
+        temperature, top_p, repetition_penalty: (b,) float
+        top_k: (b,) long, ``0`` disables top-k filtering
+    Returns:
+        (b, V) processed scores, the filtered tokens are ``-inf``
+    """
+    penalty = repetition_penalty[:, None]
+    scores = torch.where(seen, torch.where(scores < 0, scores * penalty, scores / penalty), scores)
+    if not do_sample.any():
+        return scores
+    vocab_size = scores.shape[-1]
+    warped = scores / torch.where(do_sample, temperature, torch.ones_like(temperature))[:, None]
+    # top-k: drop the tokens below the k-th largest score
+    k = torch.where(top_k > 0, top_k, torch.full_like(top_k, vocab_size)).clamp(1, vocab_size)
+    sorted_scores = torch.sort(warped, dim=-1, descending=True).values
+    kth_score = sorted_scores.gather(-1, (k - 1)[:, None])
+    warped = warped.masked_fill(warped < kth_score, -float("inf"))
+    # top-p: drop the lowest tokens whose cumulative probability is at most 1 - top_p, keep at least one token
+    sorted_scores, sorted_indices = torch.sort(warped, dim=-1, descending=False)
+    cumulative_probs = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+    sorted_to_remove = cumulative_probs <= (1 - top_p)[:, None]
+    sorted_to_remove[:, -1] = False
+    to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+    warped = warped.masked_fill(to_remove, -float("inf"))
+    return torch.where(do_sample[:, None], warped, scores)
+
+
+def select_next_tokens(scores: torch.Tensor, do_sample: torch.Tensor) -> torch.Tensor:
+    """
+    Multinomial sampling for the ``do_sample`` rows, argmax for the others. Returns (b,) long
+    """
+    greedy = scores.argmax(dim=-1)
+    if not do_sample.any():
+        return greedy
+    sampled = torch.multinomial(scores.softmax(dim=-1), num_samples=1).squeeze(1)
+    return torch.where(do_sample, sampled, greedy)
+
+
+class DecodeSequence:
+    """
+    One sentence decoded by `BatchDecoder`, with its own voice and sampling settings.
+    """
+
+    def __init__(self, conds_latent: torch.Tensor, text_tokens: torch.Tensor, do_sample=True, top_k=30, top_p=0.8,
+                 temperature=1.0, repetition_penalty=10.0, max_new_tokens=600, capture_latents=False, tag=None,
+                 prefix_kv=None, max_length=None):
+        """
+        Args:
+            conds_latent: (1, 32, dim) `UnifiedVoice.get_conditioning()` of the voice
+            prefix_kv: `UnifiedVoice.get_prefix_kv()` of ``conds_latent``, the prefill then only runs the text
+            text_tokens: (1, L) or (L,) text token ids
+            capture_latents: keep the final-norm hidden state of every step, see `UnifiedVoice.inference_speech(return_latent=True)`
+            tag: any object to route the result back to its request
+            max_length (None | int): number of codes after which ``stop_mel_token`` is forced, the ``max_lengths``
+                of `UnifiedVoice.inference_speech()` (see `ForcedStopLogitsProcessor`)
+        """
+        self.conds_latent = conds_latent
+        self.text_tokens = text_tokens.view(1, -1)
+        self.do_sample = do_sample
+        self.top_k = top_k or 0
+        self.top_p = top_p if top_p is not None else 1.0
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.max_new_tokens = max_new_tokens
+        self.max_length = max_length
+        self.capture_latents = capture_latents
+        self.tag = tag
+        self.prefix_kv = prefix_kv
+        self.codes: List[int] = []
+        self.latents: List[torch.Tensor] = []
+        self.finished = False
+
+    def get_codes(self) -> torch.Tensor:
+        """
+        (1, T) generated codes, ending with ``stop_mel_token`` unless ``max_new_tokens`` was reached
+        """
+        return torch.tensor([self.codes], dtype=torch.long, device=self.text_tokens.device)
+
+    def get_latents(self) -> Optional[torch.Tensor]:
+        """
+        (1, T, dim) the hidden states that predicted the codes, only with ``capture_latents``
+        """
+        if not self.capture_latents:
+            return None
+        return torch.stack(self.latents, dim=1)
+
+
+class BatchDecoder:
+    """
+    Step-by-step decoding of a changing set of sequences: new sequences can be added and finished ones leave
+    between two decoding steps (continuous batching). Each row has its own conditioning latents and KV cache,
+    the caches are left-padded to the same length and the padding is masked out.
+
+    The positions and the inputs are the same as `UnifiedVoice.inference_speech()` with ``num_beams=1``:
+    [cond][text][start_mel_token] with the start token at mel position 0, and the t-th code at mel position t+2.
+    """
+
+    def __init__(self, gpt):
+        """
+        Args:
+            gpt: `UnifiedVoice` after `post_init_gpt2_config()`
+        """
+        self.gpt = gpt
+        self.sequences: List[DecodeSequence] = []
+        self.past_key_values = None
+        self.attention_mask: Optional[torch.Tensor] = None
+        self.next_tokens: Optional[torch.Tensor] = None
+        self.seen: Optional[torch.Tensor] = None
+        self._settings = None
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def add(self, sequences: List[DecodeSequence]) -> List[DecodeSequence]:
+        """
+        Prefill the new ``sequences`` and merge them into the running batch.
+        Returns the sequences that finished on their first token.
+        """
+        if len(sequences) == 0:
+            return []
+        gpt = self.gpt
+        text_tokens = [s.text_tokens.squeeze(0) for s in sequences]
+        text_tokens = torch.nn.utils.rnn.pad_sequence(text_tokens, batch_first=True, padding_value=gpt.stop_text_token)
+        conds_latent = torch.cat([s.conds_latent for s in sequences], dim=0)
+        # reuse the KV cache of the conditioning prefixes when all the sequences have one
+        prefix_kv = None
+        if all(s.prefix_kv is not None for s in sequences):
+            prefix_kv = tuple(
+                tuple(torch.cat(tensors, dim=0) for tensors in zip(*layers))
+                for layers in zip(*[s.prefix_kv for s in sequences])
+            )
+        _, inputs_embeds, attention_mask = gpt.prepare_gpt_inputs(conds_latent, text_tokens,
+                                                                  cond_first=prefix_kv is not None)
+        start = torch.full((len(sequences), 1), gpt.start_mel_token, dtype=torch.long, device=inputs_embeds.device)
+        start_emb = gpt.mel_embedding(start) + gpt.mel_pos_embedding(start)
+        inputs_embeds = torch.cat([inputs_embeds, start_emb.to(inputs_embeds.dtype)], dim=1)
+        if prefix_kv is not None:
+            inputs_embeds = inputs_embeds[:, conds_latent.shape[1]:]
+        out = gpt.gpt(inputs_embeds=inputs_embeds, past_key_values=prefix_kv, attention_mask=attention_mask,
+                      use_cache=True, return_dict=True)
+        # the HF path penalizes its placeholder input ids (1) and the start_mel_token as well
+        seen = torch.zeros((len(sequences), gpt.number_mel_codes), dtype=torch.bool, device=inputs_embeds.device)
+        seen[:, 1] = True
+        seen[:, gpt.start_mel_token] = True
+        self._merge(sequences, out.past_key_values, attention_mask, seen)
+        hidden = out.last_hidden_state[:, -1]
+        return self._next(hidden, rows=slice(len(self.sequences) - len(sequences), None))
+
+    def step(self) -> List[DecodeSequence]:
+        """
+        Feed the last tokens of all rows, returns the sequences that finished.
+        """
+        if len(self.sequences) == 0:
+            return []
+        gpt = self.gpt
+        positions = torch.tensor([len(s.codes) + 1 for s in self.sequences], device=self.next_tokens.device)
+        emb = gpt.mel_embedding(self.next_tokens) + gpt.mel_pos_embedding.emb(positions)
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        out = gpt.gpt(inputs_embeds=emb.unsqueeze(1), past_key_values=self.past_key_values,
+                      attention_mask=self.attention_mask, use_cache=True, return_dict=True)
+        self.past_key_values = out.past_key_values
+        return self._next(out.last_hidden_state[:, -1], rows=slice(None))
+
+    def _next(self, hidden: torch.Tensor, rows: slice) -> List[DecodeSequence]:
+        gpt = self.gpt
+        latent = gpt.final_norm(hidden)
+        scores = gpt.mel_head(latent).float()
+        do_sample, temperature, top_k, top_p, repetition_penalty = (v[rows] for v in self._settings)
+        scores = process_logits(scores, self.seen[rows], do_sample, temperature, top_k, top_p, repetition_penalty)
+        stop = [s.max_length is not None and len(s.codes) >= s.max_length for s in self.sequences[rows]]
+        if any(stop):
+            scores = ForcedStopLogitsProcessor.force_stop(scores, torch.tensor(stop, device=scores.device),
+                                                          gpt.stop_mel_token)
+        tokens = select_next_tokens(scores, do_sample)
+        self.next_tokens[rows] = tokens
+        self.seen[rows] = self.seen[rows].scatter(1, tokens[:, None], True)
+        finished = []
+        for seq, token, h in zip(self.sequences[rows], tokens.tolist(), latent):
+            seq.codes.append(token)
+            if seq.capture_latents:
+                seq.latents.append(h)
+            if token == gpt.stop_mel_token or len(seq.codes) >= seq.max_new_tokens:
+                seq.finished = True
+                finished.append(seq)
+        if finished:
+            self._remove([i for i, s in enumerate(self.sequences) if s.finished])
+        return finished
+
+    def _merge(self, sequences, past_key_values, attention_mask, seen):
+        device = attention_mask.device
+        settings = (
+            torch.tensor([s.do_sample for s in sequences], dtype=torch.bool, device=device),
+            torch.tensor([s.temperature for s in sequences], dtype=torch.float32, device=device),
+            torch.tensor([s.top_k for s in sequences], dtype=torch.long, device=device),
+            torch.tensor([s.top_p for s in sequences], dtype=torch.float32, device=device),
+            torch.tensor([s.repetition_penalty for s in sequences], dtype=torch.float32, device=device),
+        )
+        next_tokens = torch.zeros(len(sequences), dtype=torch.long, device=device)
+        if len(self.sequences) == 0:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+            self.seen = seen
+            self.next_tokens = next_tokens
+            self._settings = settings
+        else:
+            # left pad the shorter caches, the padded keys are masked out
+            length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+            pad = lambda t, dim_from_end: F.pad(t, (0, 0) * dim_from_end + (length - t.shape[-1 - dim_from_end], 0))
+            self.past_key_values = tuple(
+                tuple(torch.cat([pad(old, 1), pad(new, 1)], dim=0) for old, new in zip(old_layer, new_layer))
+                for old_layer, new_layer in zip(self.past_key_values, past_key_values)
+            )
+            self.attention_mask = torch.cat([pad(self.attention_mask, 0), pad(attention_mask, 0)], dim=0)
+            self.seen = torch.cat([self.seen, seen], dim=0)
+            self.next_tokens = torch.cat([self.next_tokens, next_tokens], dim=0)
+            self._settings = tuple(torch.cat([old, new], dim=0) for old, new in zip(self._settings, settings))
+        self.sequences.extend(sequences)
+
+    def _remove(self, indices: List[int]):
+        keep = [i for i in range(len(self.sequences)) if i not in set(indices)]
+        self.sequences = [self.sequences[i] for i in keep]
+        if len(keep) == 0:
+            self.past_key_values = self.attention_mask = self.next_tokens = self.seen = self._settings = None
+            return
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # drop the leading columns that are padding in all remaining rows
+        offset = int(attention_mask.any(dim=0).long().argmax().item())
+        self.attention_mask = attention_mask[:, offset:]
+        self.past_key_values = tuple(
+            tuple(t.index_select(0, index)[:, :, offset:] for t in layer) for layer in self.past_key_values
+        )
+        self.next_tokens = self.next_tokens.index_select(0, index)
+        self.seen = self.seen.index_select(0, index)
+        self._settings = tuple(v.index_select(0, index) for v in self._settings)
@@ -0,0 +1,461 @@
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import BeamSearchScorer, LogitsProcessorList
+
+
+class DecodeEngine:
+    """
+    Autoregressive decoding of `UnifiedVoice` without `GenerationMixin.generate()`.
+
+    The prefill runs the HF `GPT2Model` once, its KV cache is copied into buffers preallocated for all the
+    ``max_new_tokens`` steps, and every decoding step runs the GPT2 blocks directly: the new key / value are
+    written in place, the attention reads views of the buffers, and the repetition penalty, sampling warpers and
+    beam bookkeeping are done inline. The math is the same as the HF path operation by operation, so the same
+    seed gives the same codes as `GPT2InferenceModel.generate()`.
+
+    Supports greedy decoding, sampling, beam search and beam sampling with ``repetition_penalty``,
+    ``temperature``, ``top_k``, ``top_p``, ``length_penalty``, ``early_stopping`` and ``min_new_tokens``,
+    and custom ``logits_processor`` run on the same input ids as in `GenerationMixin.generate()`.
+
+    With ``compact_rows`` (off by default), the rows that finished (and the beams of finished batch items) leave
+    the KV cache and the transformer forward, instead of decoding padding until the longest row stops. The sampling
+    and the beam bookkeeping still see all the rows (finished ones get constant logits), so the random draws are
+    unchanged and the codes only differ by the floating point effects of a smaller batch in the matmuls, they are
+    no longer bit-exact. ``row_stats`` of the last call counts the forwarded and the skipped row-steps.
+    """
+
+    supported_kwargs = {"do_sample", "num_beams", "top_k", "top_p", "temperature", "repetition_penalty",
+                        "length_penalty", "early_stopping", "min_new_tokens"}
+
+    def __init__(self, gpt):
+        """
+        Args:
+            gpt: `UnifiedVoice` after `post_init_gpt2_config()`
+        """
+        self.gpt = gpt
+        self.transformer = gpt.gpt
+        self.num_heads = self.transformer.config.n_head
+        self.head_dim = self.transformer.config.n_embd // self.num_heads
+        # default of `generate(compact_rows=None)`
+        self.compact_rows = False
+        # rows of the full batch held by the cache, None if all of them
+        self.active: Optional[torch.Tensor] = None
+        self.row_stats = {"row_steps": 0, "skipped_row_steps": 0}
+
+    @classmethod
+    def supports(cls, num_return_sequences=1, **generate_kwargs) -> bool:
+        """
+        Whether `generate()` can replace `GPT2InferenceModel.generate(**generate_kwargs)`
+        """
+        if not set(generate_kwargs).issubset(cls.supported_kwargs):
+            return False
+        # HF greedy search refuses several return sequences, let it raise
+        return num_return_sequences == 1 or generate_kwargs.get("do_sample", False) or generate_kwargs.get("num_beams", 1) > 1
+
+    @torch.no_grad()
+    def generate(self, inputs_embeds: torch.Tensor, attention_mask: torch.Tensor, max_new_tokens: int,
+                 num_return_sequences=1, do_sample=False, num_beams=1, top_k: Optional[int] = 50,
+                 top_p: Optional[float] = 1.0, temperature: Optional[float] = 1.0,
+                 repetition_penalty: Optional[float] = 1.0, length_penalty: Optional[float] = 1.0,
+                 early_stopping=False, min_new_tokens: Optional[int] = None, prefix_kv=None,
+                 logits_processor: Optional[LogitsProcessorList] = None,
+                 compact_rows: Optional[bool] = None) -> torch.Tensor:
+        """
+        Args:
+            inputs_embeds: (b, s, dim) [cond][text] embeddings by `UnifiedVoice.prepare_gpt_inputs()`
+            attention_mask: (b, s+1) the attention mask of [cond][text][start_mel_token]
+            max_new_tokens (int): max number of generated codes
+            prefix_kv: `UnifiedVoice.get_prefix_kv()` of the conditioning latents, with the inputs prepared by
+                ``prepare_gpt_inputs(cond_first=True)``, only the positions after the prefix are prefilled
+            logits_processor: applied after the repetition penalty and ``min_new_tokens``, as the custom
+                processors of `GenerationMixin.generate()`
+            compact_rows (None | bool): drop the finished rows from the forward, not bit-exact (see the class
+                docstring), None for ``self.compact_rows``
+            the other arguments and their defaults are the ones of `GenerationMixin.generate()`
+        Returns:
+            codes: (b * num_return_sequences, T), the finished rows are padded with ``stop_mel_token``
+        """
+        gpt = self.gpt
+        inference_model = gpt.inference_model
+        if compact_rows is None:
+            compact_rows = self.compact_rows
+        b, s, _ = inputs_embeds.shape
+        device = inputs_embeds.device
+        expand = num_beams if num_beams > 1 else num_return_sequences
+        rows = b * expand
+        prompt_len = s + 1
+        total_len = prompt_len + max_new_tokens
+        logits, seen = self._prefill(inputs_embeds, attention_mask, expand, total_len, prefix_kv)
+        # the placeholder input ids of the HF path: ones and the start_mel_token
+        input_ids = torch.full((rows, total_len), gpt.stop_mel_token, dtype=torch.long, device=device)
+        input_ids[:, :prompt_len] = 1
+        input_ids[:, prompt_len - 1] = gpt.start_mel_token
+        warp = dict(temperature=temperature, top_k=top_k, top_p=top_p, min_tokens_to_keep=2 if num_beams > 1 else 1)
+        cur_len = prompt_len
+
+        if num_beams > 1:
+            beam_scorer = BeamSearchScorer(batch_size=b, num_beams=num_beams, device=device,
+                                           length_penalty=length_penalty, do_early_stopping=early_stopping,
+                                           num_beam_hyps_to_keep=num_return_sequences, max_length=total_len)
+            beam_scores = torch.zeros((b, num_beams), dtype=torch.float, device=device)
+            if not do_sample:
+                beam_scores[:, 1:] = -1e9
+            beam_scores = beam_scores.view(-1)
+            arange = torch.arange(rows, device=device)
+            while True:
+                scores = F.log_softmax(logits, dim=-1)
+                scores = self._penalize(scores, seen, repetition_penalty)
+                if min_new_tokens is not None and cur_len - prompt_len < min_new_tokens:
+                    scores[:, gpt.stop_mel_token] = -float("inf")
+                if logits_processor:
+                    scores = logits_processor(input_ids[:, :cur_len], scores)
+                if do_sample:
+                    scores = self._warp(scores, **warp)
+                vocab_size = scores.shape[-1]
+                scores = (scores + beam_scores[:, None].expand_as(scores)).view(b, num_beams * vocab_size)
+                if do_sample:
+                    next_tokens = torch.multinomial(F.softmax(scores, dim=-1), num_samples=2 * num_beams)
+                    next_scores = torch.gather(scores, -1, next_tokens)
+                    next_scores, indices = torch.sort(next_scores, descending=True, dim=1)
+                    next_tokens = torch.gather(next_tokens, -1, indices)
+                else:
+                    next_scores, next_tokens = torch.topk(scores, 2 * num_beams, dim=1, largest=True, sorted=True)
+                next_indices = torch.div(next_tokens, vocab_size, rounding_mode="floor")
+                next_tokens = next_tokens % vocab_size
+                beam_outputs = beam_scorer.process(input_ids[:, :cur_len], next_scores, next_tokens, next_indices,
+                                                   pad_token_id=gpt.stop_mel_token, eos_token_id=gpt.stop_mel_token,
+                                                   decoder_prompt_len=prompt_len)
+                beam_scores = beam_outputs["next_beam_scores"]
+                beam_idx = beam_outputs["next_beam_indices"]
+                beam_next_tokens = beam_outputs["next_beam_tokens"]
+                if inference_model.captured_beam_idx is not None:
+                    inference_model.captured_beam_idx.append(beam_idx)
+                if not torch.equal(beam_idx, arange):
+                    self._reorder(beam_idx, cur_len)
+                    input_ids[:, :cur_len] = input_ids[beam_idx, :cur_len]
+                    seen = seen[beam_idx]
+                input_ids[:, cur_len] = beam_next_tokens
+                seen.scatter_(1, beam_next_tokens[:, None], True)
+                cur_len += 1
+                if beam_scorer.is_done or cur_len >= total_len:
+                    break
+                if compact_rows:
+                    # the beams of a done batch item continue with pad_token_id, the open beams never with eos
+                    # (both are stop_mel_token): the done items leave one step after the scorer marks them
+                    self._compact(beam_next_tokens != gpt.stop_mel_token, cur_len - 1)
+                logits = self._step(beam_next_tokens, cur_len, cur_len - s)
+            output = beam_scorer.finalize(input_ids[:, :cur_len], beam_scores, next_tokens, next_indices,
+                                          pad_token_id=gpt.stop_mel_token, eos_token_id=gpt.stop_mel_token,
+                                          max_length=total_len, decoder_prompt_len=prompt_len)["sequences"]
+        else:
+            unfinished = torch.ones(rows, dtype=torch.long, device=device)
+            while True:
+                scores = self._penalize(logits, seen, repetition_penalty)
+                if min_new_tokens is not None and cur_len - prompt_len < min_new_tokens:
+                    scores[:, gpt.stop_mel_token] = -float("inf")
+                if logits_processor:
+                    scores = logits_processor(input_ids[:, :cur_len], scores)
+                if do_sample:
+                    scores = self._warp(scores, **warp)
+                    next_tokens = torch.multinomial(F.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+                else:
+                    next_tokens = torch.argmax(scores, dim=-1)
+                next_tokens = next_tokens * unfinished + gpt.stop_mel_token * (1 - unfinished)
+                input_ids[:, cur_len] = next_tokens
+                seen.scatter_(1, next_tokens[:, None], True)
+                cur_len += 1
+                unfinished = unfinished.mul((next_tokens != gpt.stop_mel_token).long())
+                if unfinished.max() == 0 or cur_len >= total_len:
+                    break
+                if compact_rows:
+                    self._compact(unfinished.bool(), cur_len - 1)
+                logits = self._step(next_tokens, cur_len, cur_len - s)
+            output = input_ids[:, :cur_len]
+        self.key = self.value = self.mask = self.active = None
+        return output[:, prompt_len:]
+
+    @torch.no_grad()
+    def generate_speculative(self, inputs_embeds: torch.Tensor, attention_mask: torch.Tensor, max_new_tokens: int,
+                             draft_layers: int, num_draft_tokens=4, num_return_sequences=1, do_sample=False,
+                             num_beams=1, top_k: Optional[int] = 50, top_p: Optional[float] = 1.0,
+                             temperature: Optional[float] = 1.0, repetition_penalty: Optional[float] = 1.0,
+                             min_new_tokens: Optional[int] = None, prefix_kv=None, **unused_beam_kwargs) -> torch.Tensor:
+        """
+        Self-speculative decoding of a single sequence: the first ``draft_layers`` blocks of the GPT, followed by
+        the final norms and `mel_head`, draft ``num_draft_tokens`` codes one by one, then the full model scores
+        all of them in one forward pass. With sampling, a draft code is accepted with probability
+        ``min(1, p / q)`` of the full (``p``) and the draft (``q``) distributions and the first rejected code is
+        resampled from ``max(0, p - q)``, so the codes follow the distribution of the full model exactly;
+        greedy decoding accepts the drafts that match the argmax of the full model.
+
+        The drafter shares the KV cache of the first layers with the full model, the verification pass
+        overwrites its entries. Acceptance counts of the last call are in ``self.speculative_stats``.
+        Args:
+            draft_layers (int): number of GPT blocks of the drafter
+            num_draft_tokens (int): number of codes drafted before every verification pass
+            the other arguments are the ones of `generate()`, with batch size 1 and ``num_beams=1``
+        Returns:
+            codes: (1, T)
+        """
+        if inputs_embeds.shape[0] != 1 or num_beams != 1 or num_return_sequences != 1:
+            raise ValueError("Speculative decoding requires a single sequence and num_beams=1")
+        if not 0 < draft_layers < len(self.transformer.h) or num_draft_tokens < 1:
+            raise ValueError(f"Invalid speculative decoding settings: draft_layers={draft_layers}, "
+                             f"num_draft_tokens={num_draft_tokens}")
+        gpt = self.gpt
+        stop = gpt.stop_mel_token
+        s = inputs_embeds.shape[1]
+        prompt_len = s + 1
+        logits, seen = self._prefill(inputs_embeds, attention_mask, 1, prompt_len + max_new_tokens, prefix_kv)
+        warp = dict(temperature=temperature, top_k=top_k, top_p=top_p, min_tokens_to_keep=1)
+
+        def process(logits: torch.Tensor, seen: torch.Tensor, num_generated: int) -> torch.Tensor:
+            # probabilities (sampling) or scores (greedy) of the n rows, row j follows ``num_generated + j`` codes
+            scores = self._penalize(logits, seen, repetition_penalty)
+            if min_new_tokens is not None and num_generated < min_new_tokens:
+                scores[:min_new_tokens - num_generated, stop] = -float("inf")
+            if do_sample:
+                return F.softmax(self._warp(scores, **warp), dim=-1)
+            return scores
+
+        def select(probs: torch.Tensor) -> int:
+            if do_sample:
+                return torch.multinomial(probs, num_samples=1).item()
+            return probs.argmax().item()
+
+        self.speculative_stats = {"rounds": 0, "drafted": 0, "accepted": 0}
+        codes = [select(process(logits, seen, 0)[0])]
+        cur_len = prompt_len  # the last code is not fed yet
+        while codes[-1] != stop and len(codes) < max_new_tokens:
+            token = codes[-1]
+            seen[0, token] = True
+            # draft with the first layers
+            num_draft = min(num_draft_tokens, max_new_tokens - len(codes))
+            drafts, draft_probs = [], []
+            draft_seen = seen.clone()
+            fed = token
+            for i in range(num_draft):
+                hidden_states = self._forward(self._embed([fed], cur_len + i, s), cur_len + i + 1, draft_layers)
+                probs = process(gpt.inference_model.lm_head(hidden_states)[:, -1], draft_seen, len(codes) + i)[0]
+                fed = select(probs)
+                drafts.append(fed)
+                draft_probs.append(probs)
+                draft_seen[0, fed] = True
+                if fed == stop:
+                    break
+            # verify the drafts with the full model, row j of `probs` predicts the code after fed[j]
+            fed = [token] + (drafts[:-1] if drafts[-1] == stop else drafts)
+            hidden_states = self._forward(self._embed(fed, cur_len, s), cur_len + len(fed))
+            step_seen = seen.repeat(len(fed), 1)
+            for j in range(1, len(fed)):
+                step_seen[j:, fed[j]] = True
+            probs = process(gpt.inference_model.lm_head(hidden_states)[0], step_seen, len(codes))
+            accepted, next_token = 0, None
+            for j, draft in enumerate(drafts):
+                if do_sample:
+                    if torch.rand((), device=probs.device) * draft_probs[j][draft] < probs[j, draft]:
+                        accepted += 1
+                        continue
+                    residual = (probs[j] - draft_probs[j]).clamp(min=0)
+                    next_token = select(residual if residual.sum() > 0 else probs[j])
+                elif draft == probs[j].argmax().item():
+                    accepted += 1
+                    continue
+                else:
+                    next_token = probs[j].argmax().item()
+                break
+            if next_token is None and accepted < len(fed):
+                next_token = select(probs[accepted])
+            self.speculative_stats["rounds"] += 1
+            self.speculative_stats["drafted"] += len(drafts)
+            self.speculative_stats["accepted"] += accepted
+            # the hidden states that predicted the accepted drafts and the next code
+            self._capture_steps(hidden_states[0, :accepted + 1], fed[:accepted + 1])
+            codes.extend(drafts[:accepted])
+            if next_token is not None:
+                codes.append(next_token)
+            cur_len += accepted + 1
+            for code in drafts[:accepted]:
+                seen[0, code] = True
+        self.key = self.value = self.mask = self.active = None
+        return torch.tensor([codes[:max_new_tokens]], dtype=torch.long, device=inputs_embeds.device)
+
+    def _prefill(self, inputs_embeds: torch.Tensor, attention_mask: torch.Tensor, expand: int, total_len: int,
+                 prefix_kv=None):
+        """
+        Run the HF model on [cond][text][start_mel_token], the same inputs as the first call of
+        `GPT2InferenceModel.forward()`, and copy its KV cache into buffers of ``total_len`` positions.
+        With ``prefix_kv``, the cached conditioning prefix is reused and only the rest of the inputs is run.
+        Returns the logits (rows, V) of the first code and the mask (rows, V) of the tokens seen by the
+        repetition penalty.
+        """
+        gpt = self.gpt
+        device = inputs_embeds.device
+        rows = inputs_embeds.shape[0] * expand
+        prompt_len = inputs_embeds.shape[1] + 1
+        self.active = None
+        self.row_stats = {"row_steps": rows, "skipped_row_steps": 0}
+        start = torch.full((rows, 1), gpt.start_mel_token, dtype=torch.long, device=device)
+        start_emb = gpt.mel_embedding(start)
+        start_emb = start_emb + gpt.mel_pos_embedding(start_emb)
+        emb = torch.cat([inputs_embeds.repeat_interleave(expand, 0), start_emb], dim=1)
+        mask = torch.ones((rows, total_len), dtype=attention_mask.dtype, device=device)
+        mask[:, :prompt_len] = attention_mask.repeat_interleave(expand, 0)
+        if prefix_kv is not None:
+            prefix_len = prefix_kv[0][0].shape[2]
+            prefix_kv = tuple(tuple(t.expand(rows, -1, -1, -1) if t.shape[0] == 1 else t.repeat_interleave(expand, 0)
+                                    for t in layer) for layer in prefix_kv)
+            emb = emb[:, prefix_len:]
+        out = self.transformer(inputs_embeds=emb, past_key_values=prefix_kv, attention_mask=mask[:, :prompt_len],
+                               use_cache=True, return_dict=True)
+        hidden_states, past_key_values = out.last_hidden_state, out.past_key_values
+        del out
+        dtype = self.transformer.dtype
+        # the additive mask of `GPT2Model.forward()`
+        self.mask = (1.0 - mask[:, None, None, :].to(dtype)) * torch.finfo(dtype).min
+        self.key = [None] * len(self.transformer.h)
+        self.value = [None] * len(self.transformer.h)
+        for i, (key, value) in enumerate(past_key_values):
+            self.key[i] = key.new_empty((rows, self.num_heads, total_len, self.head_dim))
+            self.value[i] = value.new_empty((rows, self.num_heads, total_len, self.head_dim))
+            self.key[i][:, :, :prompt_len] = key
+            self.value[i][:, :, :prompt_len] = value
+        del past_key_values
+        logits = gpt.inference_model.lm_head(hidden_states)[:, -1]
+        self._capture(hidden_states[:, -1], start[:, 0])
+        # the HF path penalizes its placeholder input ids (1) and the start_mel_token as well
+        seen = torch.zeros((rows, logits.shape[-1]), dtype=torch.bool, device=device)
+        seen[:, 1] = True
+        seen[:, gpt.start_mel_token] = True
+        return logits, seen
+
+    def _embed(self, tokens: List[int], index: int, s: int) -> torch.Tensor:
+        """
+        (1, n, dim) embeddings of the codes fed at cache positions ``index, index+1, ...``
+        """
+        gpt = self.gpt
+        device = self.mask.device
+        position = index + 1 - s  # the t-th code is at mel position t+2, see `_step()`
+        return gpt.mel_embedding(torch.tensor([tokens], device=device)) + \
+            gpt.mel_pos_embedding.emb.weight[position:position + len(tokens)]
+
+    def _step(self, tokens: torch.Tensor, cur_len: int, position: int) -> torch.Tensor:
+        """
+        Feed ``tokens`` (rows,) at mel ``position``, the sequence becomes ``cur_len`` long.
+        Returns the logits (rows, V) of the next token, zeros for the rows left out by `_compact()`.
+        """
+        gpt = self.gpt
+        rows = tokens.shape[0]
+        active_tokens = tokens if self.active is None else tokens[self.active]
+        emb = gpt.mel_embedding(active_tokens[:, None]) + gpt.mel_pos_embedding.emb.weight[position]
+        hidden_states = self._forward(emb, cur_len)[:, -1]
+        logits = gpt.inference_model.lm_head(hidden_states)
+        self.row_stats["row_steps"] += hidden_states.shape[0]
+        self.row_stats["skipped_row_steps"] += rows - hidden_states.shape[0]
+        if self.active is not None:
+            hidden_states = hidden_states.new_zeros((rows, hidden_states.shape[-1])).index_copy(0, self.active, hidden_states)
+            logits = logits.new_zeros((rows, logits.shape[-1])).index_copy(0, self.active, logits)
+        self._capture(hidden_states, tokens)
+        return logits
+
+    def _forward(self, hidden_states: torch.Tensor, cur_len: int, num_layers: Optional[int] = None) -> torch.Tensor:
+        """
+        `GPT2Model.forward()` of the n new positions ending at ``cur_len`` with the preallocated cache, same
+        operations as `GPT2Block` and `GPT2Attention._attn()`. Only the first ``num_layers`` blocks are run if given.
+        """
+        rows, n = hidden_states.shape[:2]
+        mask = self.mask[..., :cur_len]
+        causal_mask = None
+        if n > 1:
+            causal_mask = torch.ones((n, cur_len), dtype=torch.bool, device=mask.device).tril(cur_len - n)
+        for i, block in enumerate(self.transformer.h[:num_layers]):
+            attn = block.attn
+            residual = hidden_states
+            hidden_states = block.ln_1(hidden_states)
+            query, key, value = attn.c_attn(hidden_states).split(attn.split_size, dim=2)
+            query = query.view(rows, n, self.num_heads, self.head_dim).permute(0, 2, 1, 3)
+            self.key[i][:, :, cur_len - n:cur_len] = key.view(rows, n, self.num_heads, self.head_dim).permute(0, 2, 1, 3)
+            self.value[i][:, :, cur_len - n:cur_len] = value.view(rows, n, self.num_heads, self.head_dim).permute(0, 2, 1, 3)
+            key = self.key[i][:, :, :cur_len]
+            value = self.value[i][:, :, :cur_len]
+            attn_weights = torch.matmul(query, key.transpose(-1, -2))
+            attn_weights = attn_weights / torch.full([], value.size(-1) ** 0.5, dtype=attn_weights.dtype,
+                                                     device=attn_weights.device)
+            if causal_mask is not None:
+                mask_value = torch.full([], torch.finfo(attn_weights.dtype).min, dtype=attn_weights.dtype,
+                                        device=attn_weights.device)
+                attn_weights = torch.where(causal_mask, attn_weights, mask_value)
+            attn_weights = attn_weights + mask
+            attn_weights = F.softmax(attn_weights, dim=-1).type(value.dtype)
+            attn_output = torch.matmul(attn_weights, value)
+            attn_output = attn_output.permute(0, 2, 1, 3).contiguous().view(rows, n, self.num_heads * self.head_dim)
+            hidden_states = attn.c_proj(attn_output) + residual
+            residual = hidden_states
+            hidden_states = residual + block.mlp(block.ln_2(hidden_states))
+        return self.transformer.ln_f(hidden_states)
+
+    def _reorder(self, beam_idx: torch.Tensor, cur_len: int):
+        if self.active is not None:
+            # the beams of an unfinished item are all in the cache
+            cache_index = torch.full_like(beam_idx, -1)
+            cache_index[self.active] = torch.arange(len(self.active), device=beam_idx.device)
+            beam_idx = cache_index[beam_idx[self.active]]
+            if torch.equal(beam_idx, torch.arange(len(beam_idx), device=beam_idx.device)):
+                return
+        for cache in (self.key, self.value):
+            for buffer in cache:
+                buffer[:, :, :cur_len] = buffer[beam_idx, :, :cur_len]
+
+    def _compact(self, keep: torch.Tensor, cur_len: int):
+        """
+        Drop the rows of the full batch that are not in ``keep`` (rows,) from the first ``cur_len`` positions of the cache.
+        """
+        active = self.active if self.active is not None else torch.arange(keep.shape[0], device=keep.device)
+        index = keep[active].nonzero().squeeze(1)
+        if len(index) == len(active):
+            return
+        self.active = active[index]
+        for cache in (self.key, self.value):
+            for i, buffer in enumerate(cache):
+                cache[i] = buffer.new_empty((len(index),) + buffer.shape[1:])
+                cache[i][:, :, :cur_len] = buffer[index, :, :cur_len]
+        self.mask = self.mask[index]
+
+    def _capture(self, hidden_states: torch.Tensor, tokens: torch.Tensor):
+        # same records as `GPT2InferenceModel.forward()`, see `start_latent_capture()`
+        inference_model = self.gpt.inference_model
+        if inference_model.captured_latents is not None:
+            inference_model.captured_latents.append(inference_model.final_norm(hidden_states))
+            inference_model.captured_tokens.append(tokens)
+
+    def _capture_steps(self, hidden_states: torch.Tensor, tokens: List[int]):
+        # several steps of a single sequence: hidden_states (n, dim) and the n fed codes
+        for h, token in zip(hidden_states, tokens):
+            self._capture(h[None], torch.tensor([token], device=h.device))
+
+    @staticmethod
+    def _penalize(scores: torch.Tensor, seen: torch.Tensor, penalty: Optional[float]) -> torch.Tensor:
+        # `RepetitionPenaltyLogitsProcessor`, with a mask of the seen tokens instead of gather / scatter
+        if penalty is None or penalty == 1.0:
+            return scores
+        return torch.where(seen, torch.where(scores < 0, scores * penalty, scores / penalty), scores)
+
+    @staticmethod
+    def _warp(scores: torch.Tensor, temperature: Optional[float], top_k: Optional[int], top_p: Optional[float],
+              min_tokens_to_keep: int) -> torch.Tensor:
+        # `TemperatureLogitsWarper`, `TopKLogitsWarper` and `TopPLogitsWarper`
+        if temperature is not None and temperature != 1.0:
+            scores = scores / temperature
+        if top_k is not None and top_k != 0:
+            top_k = min(max(top_k, min_tokens_to_keep), scores.size(-1))
+            scores = scores.masked_fill(scores < torch.topk(scores, top_k)[0][..., -1, None], -float("inf"))
+        if top_p is not None and top_p < 1.0:
+            sorted_logits, sorted_indices = torch.sort(scores, descending=False)
+            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            sorted_to_remove = cumulative_probs <= (1 - top_p)
+            sorted_to_remove[..., -min_tokens_to_keep:] = 0
+            to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+            scores = scores.masked_fill(to_remove, -float("inf"))
+        return scores
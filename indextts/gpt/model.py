@@ -9,8 +9,11 @@ from transformers.utils.model_parallel_utils import (assert_device_map,
                                                      get_device_map)
 
 from indextts.gpt.conformer_encoder import ConformerEncoder
+from indextts.gpt.decode_engine import DecodeEngine
 from indextts.gpt.perceiver import PerceiverResampler
 from indextts.utils.arch_util import AttentionBlock
+from indextts.utils.degenerate_output import DegenerateOutputLogitsProcessor
+from indextts.utils.mel_length import ForcedStopLogitsProcessor
 from indextts.utils.typical_sampling import TypicalLogitsWarper
 
 
@@ -52,6 +55,10 @@ class GPT2InferenceModel(GPT2PreTrainedModel, GenerationMixin):
         self.model_parallel = False
         self.device_map = None
         self.cached_mel_emb = None
+        # latent capture, see `start_latent_capture()`
+        self.captured_latents = None
+        self.captured_tokens = None
+        self.captured_beam_idx = None
 
     def parallelize(self, device_map=None):
         self.device_map = (
@@ -82,6 +89,55 @@ class GPT2InferenceModel(GPT2PreTrainedModel, GenerationMixin):
     def store_mel_emb(self, mel_emb):
         self.cached_mel_emb = mel_emb
 
+    def start_latent_capture(self):
+        """
+        Record the final-norm hidden state of the last position at every decoding step, together with the fed
+        token and the beam reordering, so the latents of the generated codes can be recovered by
+        `pop_captured_latents()` without running the GPT again.
+        """
+        self.captured_latents = []
+        self.captured_tokens = []
+        self.captured_beam_idx = []
+
+    def stop_latent_capture(self):
+        self.captured_latents = self.captured_tokens = self.captured_beam_idx = None
+
+    def pop_captured_latents(self, codes, num_items=1):
+        """
+        Stop capturing and return the latents of the generated codes.
+        Args:
+            codes: (n, T) generated codes returned by `generate()` (without the input prefix)
+            num_items: the batch size of the inputs, before expanding for beams or return sequences
+        Returns:
+            latents: (n, T, dim), latents[:, t] is the hidden state that predicted codes[:, t]
+        """
+        latents = torch.stack(self.captured_latents, dim=1)  # (rows, S, dim)
+        tokens = torch.stack(self.captured_tokens, dim=1)  # (rows, S)
+        beam_idx = self.captured_beam_idx
+        self.stop_latent_capture()
+
+        n, T = codes.shape
+        rows, steps = tokens.shape
+        steps = min(steps, T)
+        device = latents.device
+        # trace every output sequence through the (reordered) rows: at step s, the row that holds the
+        # sequence is a child of the row at step s-1 that was fed codes[:, s-1]
+        item = torch.arange(n, device=device) // (n // num_items)
+        row_item = torch.arange(rows, device=device) // (rows // num_items)
+        mask = item[:, None] == row_item[None, :]  # (n, rows)
+        row_index = []
+        for s in range(steps):
+            if s > 0:
+                if len(beam_idx) >= s:
+                    mask = mask[:, beam_idx[s - 1].to(device)]
+                mask = mask & (tokens[None, :, s] == codes[:, s - 1:s])
+            row_index.append(mask.long().argmax(dim=1))
+        row_index = torch.stack(row_index, dim=1)  # (n, steps)
+        latents = latents[row_index, torch.arange(steps, device=device)[None, :]]
+        if steps < T:
+            latents = F.pad(latents, (0, 0, 0, T - steps))
+        return latents
+
     def prepare_inputs_for_generation(self, input_ids, past_key_values=None, **kwargs):
         token_type_ids = kwargs.get("token_type_ids", None)  # usually None
         if not self.kv_cache:
@@ -178,6 +234,9 @@ class GPT2InferenceModel(GPT2PreTrainedModel, GenerationMixin):
             hidden_states = hidden_states.to(self.lm_head.weight.device)
 
         lm_logits = self.lm_head(hidden_states)
+        if self.captured_latents is not None:
+            self.captured_latents.append(self.final_norm(hidden_states[:, -1]))
+            self.captured_tokens.append(input_ids[:, -1])
 
         if not return_dict:
             return (lm_logits,) + transformer_outputs[1:]
@@ -191,13 +250,14 @@ class GPT2InferenceModel(GPT2PreTrainedModel, GenerationMixin):
             cross_attentions=transformer_outputs.cross_attentions,
         )
 
-    @staticmethod
-    def _reorder_cache(past, beam_idx):
+    def _reorder_cache(self, past, beam_idx):
         """
         This function is used to re-order the :obj:`past_key_values` cache if
         :meth:`~transformers.PreTrainedModel.beam_search` or :meth:`~transformers.PreTrainedModel.beam_sample` is
         called. This is required to match :obj:`past_key_values` with the correct beam_idx at every generation step.
         """
+        if self.captured_beam_idx is not None:
+            self.captured_beam_idx.append(beam_idx)
         return tuple(
             tuple(
                 past_state.index_select(0, beam_idx.to(past_state.device))
@@ -422,6 +482,8 @@ class UnifiedVoice(nn.Module):
             self.inference_model = self.ds_engine.module.eval()
         else:
             self.inference_model = self.inference_model.eval()
+        # native decoding loop used by `inference_speech()`, deepspeed keeps the HF `generate()`
+        self.decode_engine = DecodeEngine(self) if kv_cache and not use_deepspeed else None
 
         # self.inference_model = PrunedGPT2InferenceModel(gpt_config, self.gpt, self.mel_pos_embedding, self.mel_embedding, self.final_norm, self.mel_head)
         self.gpt.wte = self.mel_embedding
@@ -437,13 +499,11 @@ class UnifiedVoice(nn.Module):
         that audio clip, reformats the tokens with STOP_MEL_TOKEN in place of the zero padding. This is required
         preformatting to create a working TTS model.
         """
-        for b in range(len(mel_lengths)):
-            # Due to the convolutional nature of how these tokens are generated,
-            # it would be best if the model predicts a token past the actual last token.
-            actual_end = mel_lengths[b]
-            if actual_end < mel_input_tokens.shape[-1]:
-                mel_input_tokens[b, actual_end:] = self.stop_mel_token
-        return mel_input_tokens
+        # Due to the convolutional nature of how these tokens are generated,
+        # it would be best if the model predicts a token past the actual last token.
+        actual_end = torch.as_tensor(mel_lengths, device=mel_input_tokens.device).unsqueeze(1)
+        positions = torch.arange(mel_input_tokens.shape[-1], device=mel_input_tokens.device)
+        return mel_input_tokens.masked_fill_(positions >= actual_end, self.stop_mel_token)
 
     def set_text_padding(self, text_input_tokens, text_lengths):
         """
@@ -451,13 +511,11 @@ class UnifiedVoice(nn.Module):
         that audio clip, reformats the tokens with STOP_MEL_TOKEN in place of the zero padding. This is required
         preformatting to create a working TTS model.
         """
-        for b in range(len(text_lengths)):
-            # Due to the convolutional nature of how these tokens are generated,
-            # it would be best if the model predicts a token past the actual last token.
-            actual_end = text_lengths[b]
-            if actual_end < text_input_tokens.shape[-1]:
-                text_input_tokens[b, actual_end:] = self.stop_text_token
-        return text_input_tokens
+        # Due to the convolutional nature of how these tokens are generated,
+        # it would be best if the model predicts a token past the actual last token.
+        actual_end = torch.as_tensor(text_lengths, device=text_input_tokens.device).unsqueeze(1)
+        positions = torch.arange(text_input_tokens.shape[-1], device=text_input_tokens.device)
+        return text_input_tokens.masked_fill_(positions >= actual_end, self.stop_text_token)
 
     def get_logits(self, speech_conditioning_inputs, first_inputs, first_head, second_inputs=None, second_head=None, get_attns=False, return_latent=False):
         if second_inputs is not None:
@@ -518,9 +576,21 @@ class UnifiedVoice(nn.Module):
             conds = conds.unsqueeze(1)
         return conds
 
+    def get_prefix_kv(self, conds_latent: torch.Tensor):
+        """
+        Per-layer key / value of the conditioning latents, the prefix shared by all the sentences of a voice.
+        The GPT has no absolute position embedding, so they do not depend on the position of the prefix;
+        with ``prepare_gpt_inputs(cond_first=True)`` the decode engine only prefills the text of a sentence.
+        Args:
+            conds_latent: (b, 32, dim) by `get_conditioning()`
+        Returns:
+            tuple of (key, value) per layer, each (b, heads, 32, dim // heads)
+        """
+        return self.gpt(inputs_embeds=conds_latent, use_cache=True, return_dict=True).past_key_values
+
     def forward(self, speech_conditioning_latent, text_inputs, text_lengths, mel_codes, wav_lengths,
                 cond_mel_lengths=None, types=None, text_first=True, raw_mels=None, return_attentions=False,
-                return_latent=False, clip_inputs=False):
+                return_latent=False, clip_inputs=False, conds_latent=None):
         """
         Forward pass that uses both text and voice in either text conditioning mode or voice conditioning mode
         (actuated by `text_first`).
@@ -535,9 +605,13 @@ class UnifiedVoice(nn.Module):
         If return_attentions is specified, only logits are returned.
         If return_latent is specified, loss & logits are not computed or returned. Only the predicted latents are returned.
         If clip_inputs is True, the inputs will be clipped to the smallest input size across each input modality.
+        If conds_latent (b, 32, dim) is given, it is used instead of computing `get_conditioning()` from the MEL.
         """
 
-        speech_conditioning_latent = self.get_conditioning(speech_conditioning_latent, cond_mel_lengths)
+        if conds_latent is not None:
+            speech_conditioning_latent = conds_latent
+        else:
+            speech_conditioning_latent = self.get_conditioning(speech_conditioning_latent, cond_mel_lengths)
         # Types are expressed by expanding the text embedding space.
         if types is not None:
             text_inputs = text_inputs * (1 + types).unsqueeze(-1)
@@ -592,6 +666,7 @@ class UnifiedVoice(nn.Module):
         self,
         conditional_latents: torch.Tensor,
         text_inputs: torch.Tensor,
+        cond_first: bool = False,
     ):
         
         """
@@ -599,6 +674,8 @@ class UnifiedVoice(nn.Module):
         Args:
             conds_latent: (b, 32, dim) audio conditioning embedding by `get_conditioning()`
             text_inputs: (b, L)
+            cond_first: pad between the conditioning and the text, [cond][pad][text] instead of [pad][cond][text],
+                so the conditioning prefix is at the same positions in every row (see `get_prefix_kv()`)
         Returns:
             input_ids: (b, s+1) the input ids for the GPT2InferenceModel.generate()
             inputs_embeds: (b, s+1, dim) the input embeddings for the GPT2InferenceModel.forward()
@@ -609,38 +686,39 @@ class UnifiedVoice(nn.Module):
         single_cond = conditional_latents.ndim == 3 and conditional_latents.shape[0] == 1
         if not single_cond:
             assert conditional_latents.shape[0] == b, f"batch size mismatch: {conditional_latents.shape[0]} vs {b}"
-        batched_mel_emb = []
-        attention_masks = []
-        target_len = conditional_latents.shape[1] + L + 2
-        for i in range(b):
-            valid_mask = (text_inputs[i] != self.stop_text_token) & (text_inputs[i] != self.start_text_token)
-            text_input = text_inputs[i][valid_mask]
-            text_input = F.pad(text_input, (1, 0), value=self.start_text_token)
-            text_input = F.pad(text_input, (0, 1), value=self.stop_text_token)
-            text_input_pos = torch.arange(0, text_input.size(-1), device=device)
-            text_emb = self.text_embedding(text_input) + self.text_pos_embedding.emb(text_input_pos)
-            # concatenate [conditional latents][text embeddings]
-            conds_text_emb = [
-                conditional_latents.squeeze(0) if single_cond else conditional_latents[i],
-                text_emb,
-            ]
-            # +1 for the start_mel_token
-            attention_mask = torch.ones(target_len+1, dtype=torch.long, device=device)
-            # check this text input is padded
-            padding: int = L + 2 - text_input.size(-1)
-            # pad left of [cond][text] -> [pad][cond][text]
-            if padding > 0:
-                pad = torch.zeros((padding, conditional_latents.size(-1)), dtype=text_emb.dtype, device=device) # [p, dim]
-                conds_text_emb.insert(0, pad)
-                attention_mask[:padding] = 0
-            mel_emb = torch.cat(conds_text_emb) #[s, dim]
-            assert mel_emb.shape[0] == target_len, f"mel_emb.shape: {mel_emb.shape}, target_len: {target_len}"
-            batched_mel_emb.append(mel_emb)
-            attention_masks.append(attention_mask)
+        conds = conditional_latents.expand(b, -1, -1)
+        cond_len = conds.shape[1]
+        target_len = cond_len + L + 2
+        # drop the start/stop text tokens and move the remaining ones to the left, keeping their order
+        valid_mask = (text_inputs != self.stop_text_token) & (text_inputs != self.start_text_token)
+        text_lens = valid_mask.sum(dim=-1, keepdim=True)  # [b, 1]
+        order = torch.sort((~valid_mask).to(torch.uint8), dim=-1, stable=True).indices
+        text_input = text_inputs.gather(1, order)
+        text_input = torch.where(torch.arange(L, device=device) < text_lens, text_input, self.stop_text_token)
+        # [start][text][stop][stop padding...]
+        text_input = F.pad(text_input, (1, 0), value=self.start_text_token)
+        text_input = F.pad(text_input, (0, 1), value=self.stop_text_token)
+        text_input_pos = torch.arange(0, L + 2, device=device)
+        text_emb = self.text_embedding(text_input) + self.text_pos_embedding.emb(text_input_pos)
+        # shift right by the padding length of each row:
+        # [cond][text][...] -> [pad][cond][text], or [cond][pad][text] with cond_first
+        padding = L - text_lens  # [b, 1]
+        if cond_first:
+            emb = text_emb
+            pad_start = cond_len
+        else:
+            emb = torch.cat([conds, text_emb], dim=1)
+            pad_start = 0
+        positions = torch.arange(emb.shape[1], device=device)
+        is_pad = positions < padding
+        index = (positions - padding).clamp(min=0)
+        emb = emb.gather(1, index.unsqueeze(-1).expand(-1, -1, emb.shape[-1]))
+        emb = emb.masked_fill(is_pad.unsqueeze(-1), 0)
         # [b, s, dim]
-        batched_mel_emb = torch.stack(batched_mel_emb, dim=0)
-        # [b, s+1]
-        attention_mask = torch.stack(attention_masks, dim=0)
+        batched_mel_emb = torch.cat([conds, emb], dim=1) if cond_first else emb
+        # [b, s+1], +1 for the start_mel_token
+        attention_mask = torch.ones((b, target_len + 1), dtype=torch.long, device=device)
+        attention_mask[:, pad_start : pad_start + emb.shape[1]].masked_fill_(is_pad, 0)
         # [b, s+1]
         fake_inputs = torch.ones(
             (
@@ -653,22 +731,49 @@ class UnifiedVoice(nn.Module):
         fake_inputs[:, -1] = self.start_mel_token
         return fake_inputs, batched_mel_emb, attention_mask
     def inference_speech(self, speech_conditioning_mel, text_inputs, cond_mel_lengths=None, input_tokens=None, num_return_sequences=1,
-                         max_generate_length=None, typical_sampling=False, typical_mass=.9, **hf_generate_kwargs):
+                         max_generate_length=None, typical_sampling=False, typical_mass=.9, conds_latent=None, return_latent=False,
+                         draft_layers=None, num_draft_tokens=4, prefix_kv=None, max_lengths=None, detect_degenerate=False,
+                         compact_rows=False, **hf_generate_kwargs):
         """
         Args:
-            speech_conditioning_mel: (b, n_mels, frames) or (n_mels, frames)
+            speech_conditioning_mel: (b, n_mels, frames) or (n_mels, frames), unused if ``conds_latent`` is given
             text_inputs: (b, L)
             cond_mel_lengths: lengths of the conditioning mel spectrograms in shape (b,) or (1,)
             input_tokens: additional tokens for generation in shape (b, s) or (s,)
             max_generate_length: limit the number of generated tokens
-            hf_generate_kwargs: kwargs for `GPT2InferenceModel.generate(**hf_generate_kwargs)`
+            conds_latent: (b, 32, dim) or (1, 32, dim) precomputed `get_conditioning()` output
+            return_latent: also return the latents (n, T, dim) of the generated codes, collected while decoding.
+                Note that decoding feeds the t-th code at mel position t+1, while `forward(..., return_latent=True)`
+                uses position t, so these latents are close to, but not the same as the forward pass.
+            hf_generate_kwargs: kwargs for `GPT2InferenceModel.generate(**hf_generate_kwargs)`, decoded by
+                `DecodeEngine` with the same results when it supports them (set ``self.decode_engine = None`` to
+                always use the HF `generate()`)
+            draft_layers: enable self-speculative decoding with a drafter made of the first ``draft_layers``
+                GPT blocks, see `DecodeEngine.generate_speculative()`. Requires a single sequence and ``num_beams=1``.
+            num_draft_tokens: number of codes drafted per verification pass of the full model
+            prefix_kv: `get_prefix_kv()` of ``conds_latent``, reused by the decode engine so only the text is
+                prefilled (ignored by the HF `generate()`). The keys are summed in a different order than with
+                the left-padded layout, so the results can differ by floating point rounding.
+            max_lengths: (b,) max generated codes of each text before ``stop_mel_token`` is forced, see
+                `ForcedStopLogitsProcessor`
+            detect_degenerate: cap the long runs of silent tokens and stop the rows looping over a short cycle of
+                codes while decoding, see `DegenerateOutputLogitsProcessor`. Off by default: it also stops
+                sustained sounds repeating a few codes. Not supported by speculative decoding.
+            compact_rows: the finished rows leave the forward of the decode engine (ignored by the HF `generate()`),
+                faster for batches of different lengths but the codes are no longer bit-exact, see `DecodeEngine`
         """
-        if speech_conditioning_mel.ndim == 2:
-            speech_conditioning_mel = speech_conditioning_mel.unsqueeze(0)
-        if cond_mel_lengths is None:
-            cond_mel_lengths = torch.tensor([speech_conditioning_mel.shape[-1]], device=speech_conditioning_mel.device)
-        conds_latent = self.get_conditioning(speech_conditioning_mel, cond_mel_lengths)
-        input_ids, inputs_embeds, attention_mask = self.prepare_gpt_inputs(conds_latent, text_inputs)
+        if conds_latent is None:
+            if speech_conditioning_mel.ndim == 2:
+                speech_conditioning_mel = speech_conditioning_mel.unsqueeze(0)
+            if cond_mel_lengths is None:
+                cond_mel_lengths = torch.tensor([speech_conditioning_mel.shape[-1]], device=speech_conditioning_mel.device)
+            conds_latent = self.get_conditioning(speech_conditioning_mel, cond_mel_lengths)
+        use_engine = self.decode_engine is not None and input_tokens is None and not typical_sampling \
+            and DecodeEngine.supports(num_return_sequences, **hf_generate_kwargs)
+        if not use_engine:
+            prefix_kv = None
+        input_ids, inputs_embeds, attention_mask = self.prepare_gpt_inputs(conds_latent, text_inputs,
+                                                                           cond_first=prefix_kv is not None)
         self.inference_model.store_mel_emb(inputs_embeds)
         if input_tokens is None:
             inputs = input_ids
@@ -694,15 +799,51 @@ class UnifiedVoice(nn.Module):
                 raise ValueError(f"`typical_mass` has to be a float > 0 and < 1, but is {typical_mass}")
             min_tokens_to_keep = 2 if hf_generate_kwargs.get("num_beams", 1) > 1 else 1
             logits_processor.append(TypicalLogitsWarper(mass=typical_mass, min_tokens_to_keep=min_tokens_to_keep))
+        if max_lengths is not None:
+            max_lengths = torch.as_tensor(max_lengths, device=inputs.device)
+            logits_processor.append(ForcedStopLogitsProcessor(max_lengths, trunc_index, self.stop_mel_token))
+        if detect_degenerate:
+            logits_processor.append(DegenerateOutputLogitsProcessor(trunc_index, self.stop_mel_token))
         max_length = (trunc_index + self.max_mel_tokens - 1) if max_generate_length is None else trunc_index + max_generate_length
-        output = self.inference_model.generate(inputs, 
-                                            bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token,
-                                            eos_token_id=self.stop_mel_token, attention_mask=attention_mask,
-                                            max_length=max_length, logits_processor=logits_processor,
-                                            num_return_sequences=num_return_sequences,
-                                            **hf_generate_kwargs)
-        if isinstance(output, torch.Tensor):
-            return output[:, trunc_index:]
-        # GenerateOutput
-        output.sequences = output.sequences[:, trunc_index:]
+        if return_latent:
+            assert self.inference_model.kv_cache or hf_generate_kwargs.get("num_beams", 1) == 1, \
+                "return_latent with beam search requires kv_cache"
+            self.inference_model.start_latent_capture()
+        if draft_layers is not None and (not use_engine or detect_degenerate):
+            raise ValueError("Speculative decoding is not supported with these generation settings")
+        try:
+            if draft_layers is not None:
+                if max_lengths is not None:
+                    max_length = min(max_length, trunc_index + int(max_lengths.max()) + 1)
+                output = self.decode_engine.generate_speculative(inputs_embeds, attention_mask, max_length - trunc_index,
+                                                                 draft_layers, num_draft_tokens=num_draft_tokens,
+                                                                 prefix_kv=prefix_kv,
+                                                                 num_return_sequences=num_return_sequences,
+                                                                 **hf_generate_kwargs)
+            elif use_engine:
+                output = self.decode_engine.generate(inputs_embeds, attention_mask, max_length - trunc_index,
+                                                     num_return_sequences=num_return_sequences, prefix_kv=prefix_kv,
+                                                     logits_processor=logits_processor, compact_rows=compact_rows,
+                                                     **hf_generate_kwargs)
+            else:
+                output = self.inference_model.generate(inputs,
+                                                    bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token,
+                                                    eos_token_id=self.stop_mel_token, attention_mask=attention_mask,
+                                                    max_length=max_length, logits_processor=logits_processor,
+                                                    num_return_sequences=num_return_sequences,
+                                                    **hf_generate_kwargs)
+        except BaseException:
+            self.inference_model.stop_latent_capture()
+            raise
+        if use_engine:
+            codes = output
+        elif isinstance(output, torch.Tensor):
+            output = output[:, trunc_index:]
+            codes = output
+        else:
+            # GenerateOutput
+            output.sequences = output.sequences[:, trunc_index:]
+            codes = output.sequences
+        if return_latent:
+            return output, self.inference_model.pop_captured_latents(codes, num_items=text_inputs.shape[0])
         return output
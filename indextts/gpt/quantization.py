@@ -0,0 +1,46 @@
+import torch
+import torch.nn as nn
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from torch.ao.quantization import per_channel_dynamic_qconfig
+from transformers.pytorch_utils import Conv1D
+
+
+def conv1d_to_linear(conv: Conv1D) -> nn.Linear:
+    """
+    `nn.Linear` computing the same as the HF GPT2 `Conv1D` (``x @ weight + bias``, weight in shape (in, out)).
+    """
+    in_features, out_features = conv.weight.shape
+    linear = nn.Linear(in_features, out_features, device=conv.weight.device)
+    with torch.no_grad():
+        linear.weight.copy_(conv.weight.t())
+        linear.bias.copy_(conv.bias)
+    return linear
+
+
+def quantize_linear_int8(module: nn.Module) -> DynamicQuantizedLinear:
+    """
+    Dynamic int8 `nn.Linear` (or `Conv1D`): int8 weights with per-output-channel scales, the activations are
+    quantized per batch at every call and the outputs are float32.
+    """
+    if isinstance(module, Conv1D):
+        module = conv1d_to_linear(module)
+    module.qconfig = per_channel_dynamic_qconfig
+    return DynamicQuantizedLinear.from_float(module)
+
+
+def quantize_gpt_int8(gpt) -> None:
+    """
+    Quantizes in place the `Conv1D` projections of the GPT2 blocks (``attn.c_attn``, ``attn.c_proj``,
+    ``mlp.c_fc``, ``mlp.c_proj``) and the ``mel_head`` of a float32 `UnifiedVoice` on CPU, see
+    `quantize_linear_int8()`. The embeddings, norms and ``text_head`` stay in float.
+
+    These projections hold most of the weights read at every decoding step. The codes of `inference_speech()`
+    are close to, but not the same as float32.
+    """
+    for block in gpt.gpt.h:
+        for parent, name in ((block.attn, "c_attn"), (block.attn, "c_proj"), (block.mlp, "c_fc"), (block.mlp, "c_proj")):
+            setattr(parent, name, quantize_linear_int8(getattr(parent, name)))
+    gpt.mel_head = quantize_linear_int8(gpt.mel_head)
+    if hasattr(gpt, "inference_model"):
+        # lm_head = (final_norm, mel_head) of `post_init_gpt2_config()`
+        gpt.inference_model.lm_head[1] = gpt.mel_head
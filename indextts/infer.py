@@ -1,5 +1,8 @@
+import math
 import os
+import queue
 import sys
+import threading
 import time
 from subprocess import CalledProcessError
 from typing import Dict, List, Tuple
@@ -17,15 +20,108 @@ warnings.filterwarnings("ignore", category=UserWarning)
 
 from indextts.BigVGAN.models import BigVGAN as Generator
 from indextts.gpt.model import UnifiedVoice
+from indextts.gpt.quantization import quantize_gpt_int8
 from indextts.utils.checkpoint import load_checkpoint
 from indextts.utils.feature_extractors import MelSpectrogramFeatures
+from indextts.utils.mel_length import MelLengthEstimator
+from indextts.utils.prompt_cache import PromptCache
+from indextts.utils.speaker_profile import SpeakerProfileStore
+from indextts.utils.stream_vocoder import LatentStreamer, StreamingVocoder
 
 from indextts.utils.front import TextNormalizer, TextTokenizer
 
 
+class PipelineStage:
+    """
+    A pipeline stage that runs ``fn`` on a worker thread. Items are fed through a bounded queue, so the producer
+    runs at most ``queue_size`` items ahead and blocks instead of piling up latents in memory.
+    The busy time of the stage is recorded to measure how much it overlaps with the producer.
+    """
+
+    def __init__(self, fn, queue_size=2, num_threads=None, device=None, name="stage", keep_results=True):
+        """
+        Args:
+            fn: called with the submitted arguments on the worker thread, under `torch.no_grad()`
+            queue_size (int): max number of pending items
+            keep_results (bool): collect the return values of ``fn`` for `join()`, disable for long running stages
+            num_threads (None | int): intra-op threads of the worker (`torch.set_num_threads()` is per thread with OpenMP)
+            device (None | str): on CUDA devices the worker runs on its own stream
+        """
+        self.fn = fn
+        self.name = name
+        self.num_threads = num_threads
+        self.keep_results = keep_results
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.stream = torch.cuda.Stream(device) if device is not None and str(device).startswith("cuda") else None
+        self.results = []
+        self.error = None
+        self.busy_time = 0.0
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, *args):
+        if self.error is not None:
+            raise self.error
+        event = None
+        if self.stream is not None:
+            # the worker waits for the producer's kernels, and the tensors are kept alive for its stream
+            event = torch.cuda.Event()
+            event.record()
+            for arg in args:
+                if isinstance(arg, torch.Tensor) and arg.is_cuda:
+                    arg.record_stream(self.stream)
+        self.queue.put((args, event))
+
+    def _run(self):
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # keep draining the queue so the producer never blocks
+                continue
+            args, event = item
+            start = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    if self.stream is not None:
+                        with torch.cuda.stream(self.stream):
+                            self.stream.wait_event(event)
+                            result = self.fn(*args)
+                        self.stream.synchronize()
+                    else:
+                        result = self.fn(*args)
+                if self.keep_results:
+                    self.results.append(result)
+            except BaseException as e:
+                self.error = e
+            self.busy_time += time.perf_counter() - start
+
+    def join(self) -> list:
+        """
+        Wait for all submitted items, returns the results in submission order.
+        """
+        self.close()
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+    def close(self):
+        """
+        Stop the worker after the submitted items, without raising its error. Safe to call more than once.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
 class IndexTTS:
     def __init__(
         self, cfg_path="checkpoints/config.yaml", model_dir="checkpoints", is_fp16=True, device=None, use_cuda_kernel=None,
+        use_cpu_kernel=None, prompt_cache_mb=256, speaker_profile_dir=None, speaker_profile_fp16=False, mel_length_log=None,
+        bigvgan_tile_size=None, gpt_int8=False, bigvgan_int8=False,
     ):
         """
         Args:
@@ -34,6 +130,19 @@ class IndexTTS:
             is_fp16 (bool): whether to use fp16.
             device (str): device to use (e.g., 'cuda:0', 'cpu'). If None, it will be set automatically based on the availability of CUDA or MPS.
             use_cuda_kernel (None | bool): whether to use BigVGan custom fused activation CUDA kernel, only for CUDA device.
+            use_cpu_kernel (None | bool): whether to use the BigVGan CPU inference path of the activation, only for CPU device.
+                None to use it whenever the device is CPU.
+            prompt_cache_mb (int): memory budget (MB) of the reference prompt cache, which holds the features of many voices.
+            speaker_profile_dir (None | str): directory of the enrolled speaker profiles, defaults to ``{model_dir}/speaker_profiles``.
+            speaker_profile_fp16 (bool): whether to store the speaker profiles in float16.
+            mel_length_log (None | str): jsonl file to log the text and mel lengths of the generated sentences,
+                to fit the `MelLengthEstimator` of ``{model_dir}/mel_length_estimator.json``.
+            bigvgan_tile_size (None | int): decode BigVGAN in windows of that many latent frames with overlapping context
+                (see `BigVGAN.inference_tiled()`), so its memory does not grow with the text length. None to decode at once.
+            gpt_int8 (bool): dynamic int8 quantization of the GPT2 blocks and ``mel_head`` (see `quantize_gpt_int8()`),
+                only on CPU. The generated codes are close to, but not the same as float32.
+            bigvgan_int8 (bool): load the static int8 BigVGAN ``{model_dir}/bigvgan_int8.pth`` exported by
+                ``python -m indextts.BigVGAN.quantization``, only on CPU.
         """
         if device is not None:
             self.device = device
@@ -52,6 +161,7 @@ class IndexTTS:
             self.is_fp16 = False
             self.use_cuda_kernel = False
             print(">> Be patient, it may take a while to run in CPU mode.")
+        self.use_cpu_kernel = self.device == "cpu" and (use_cpu_kernel is None or use_cpu_kernel)
 
         self.cfg = OmegaConf.load(cfg_path)
         self.model_dir = model_dir
@@ -80,6 +190,12 @@ class IndexTTS:
         else:
             self.gpt.eval()
         print(">> GPT weights restored from:", self.gpt_path)
+        if gpt_int8:
+            if self.device == "cpu":
+                quantize_gpt_int8(self.gpt)
+                print(">> GPT quantized to int8")
+            else:
+                print(f">> int8 GPT quantization is only supported on CPU, ignored on {self.device}")
         if self.is_fp16:
             try:
                 import deepspeed
@@ -107,140 +223,250 @@ class IndexTTS:
                     "See more details: https://github.com/index-tts/index-tts/issues/164#issuecomment-2903453206", file=sys.stderr
                 )
                 self.use_cuda_kernel = False
-        self.bigvgan = Generator(self.cfg.bigvgan, use_cuda_kernel=self.use_cuda_kernel)
         self.bigvgan_path = os.path.join(self.model_dir, self.cfg.bigvgan_checkpoint)
-        vocoder_dict = torch.load(self.bigvgan_path, map_location="cpu")
-        self.bigvgan.load_state_dict(vocoder_dict["generator"])
-        self.bigvgan = self.bigvgan.to(self.device)
-        # remove weight norm on eval mode
-        self.bigvgan.remove_weight_norm()
-        self.bigvgan.eval()
-        print(">> bigvgan weights restored from:", self.bigvgan_path)
+        bigvgan_inference_path = os.path.join(self.model_dir, Generator.inference_filename)
+        if bigvgan_int8:
+            bigvgan_int8_path = os.path.join(self.model_dir, Generator.int8_inference_filename)
+            if self.device != "cpu":
+                print(f">> int8 BigVGAN is only supported on CPU, ignored on {self.device}")
+            elif not os.path.isfile(bigvgan_int8_path):
+                print(">> int8 BigVGAN not found, export it with `python -m indextts.BigVGAN.quantization`:", bigvgan_int8_path)
+            else:
+                bigvgan_inference_path = bigvgan_int8_path
+        self.bigvgan = None
+        if os.path.isfile(bigvgan_inference_path) and not self.use_cuda_kernel:
+            # frozen inference module exported by `python -m indextts.BigVGAN.export`
+            try:
+                self.bigvgan = Generator.load_inference(bigvgan_inference_path, source=self.bigvgan_path).to(self.device)
+                print(">> bigvgan inference module restored from:", bigvgan_inference_path)
+            except ValueError as e:
+                print(f">> {e}. Falling back to the generator checkpoint.", file=sys.stderr)
+        if self.bigvgan is None:
+            self.bigvgan = Generator(self.cfg.bigvgan, use_cuda_kernel=self.use_cuda_kernel, use_cpu_kernel=self.use_cpu_kernel)
+            vocoder_dict = torch.load(self.bigvgan_path, map_location="cpu")
+            self.bigvgan.load_state_dict(vocoder_dict["generator"])
+            self.bigvgan = self.bigvgan.to(self.device)
+            # remove weight norm on eval mode
+            self.bigvgan.remove_weight_norm()
+            self.bigvgan.eval()
+            print(">> bigvgan weights restored from:", self.bigvgan_path)
+        self.bigvgan_tile_size = bigvgan_tile_size
         self.bpe_path = os.path.join(self.model_dir, self.cfg.dataset["bpe_model"])
         self.normalizer = TextNormalizer()
         self.normalizer.load()
         print(">> TextNormalizer loaded")
         self.tokenizer = TextTokenizer(self.bpe_path, self.normalizer)
         print(">> bpe model loaded from:", self.bpe_path)
-        # 缓存参考音频mel：
-        self.cache_audio_prompt = None
-        self.cache_cond_mel = None
+        # 缓存参考音频mel（按解码后的PCM内容哈希，LRU淘汰）：
+        self.prompt_cache = PromptCache(max_bytes=int(prompt_cache_mb * 1024 * 1024))
+        # 加载参考音频 / 计算conditioning时加锁：webui的请求与连续批处理的调度线程可能同时查找同一声音
+        self.prompt_lock = threading.RLock()
+        # 预先注册的说话人（conditioning latents + speaker embedding）
+        self.speaker_profiles = SpeakerProfileStore(speaker_profile_dir or os.path.join(self.model_dir, "speaker_profiles"),
+                                                    fp16=speaker_profile_fp16)
+        # 按文本长度和语言预估每句的mel token数，用于分桶和提前终止失控的生成
+        self.mel_length_estimator = MelLengthEstimator.load(self.model_dir)
+        self.mel_length_log = mel_length_log
         # 进度引用显示（可选）
         self.gr_progress = None
         self.model_version = self.cfg.version if hasattr(self.cfg, "version") else None
 
+    def get_prompt_features(self, audio_prompt, verbose=False, with_conditioning=False) -> Dict[str, torch.Tensor]:
+        """
+        Load the reference audio and return its features from the prompt cache.
+        The cache is keyed by the hash of the decoded PCM, so the same voice sent as different files still hits.
+        Returns:
+            dict with ``cond_mel``: (1, n_mels, frames) on ``self.device``,
+            and the outputs of `compute_voice_conditioning()` if ``with_conditioning``
+        """
+        with self.prompt_lock:
+            audio, sr = torchaudio.load(audio_prompt)
+            key = PromptCache.hash_audio(audio, sr)
+            features = self.prompt_cache.get(key)
+            if features is None:
+                audio = torch.mean(audio, dim=0, keepdim=True)
+                if audio.shape[0] > 1:
+                    audio = audio[0].unsqueeze(0)
+                audio = torchaudio.transforms.Resample(sr, 24000)(audio)
+                cond_mel = MelSpectrogramFeatures()(audio).to(self.device)
+                if verbose:
+                    print(f"cond_mel shape: {cond_mel.shape}", "dtype:", cond_mel.dtype)
+                features = {"cond_mel": cond_mel}
+                self.prompt_cache.put(key, features)
+            if with_conditioning and "conds_latent" not in features:
+                self.prompt_cache.update(key, **self.compute_voice_conditioning(features["cond_mel"]))
+            return features
+
+    def compute_voice_conditioning(self, cond_mel: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """
+        Run the voice conditioning stack on the reference mel once.
+        Returns:
+            dict with ``conds_latent``: (1, 32, dim) by `UnifiedVoice.get_conditioning()`,
+            ``prefix_kv``: its per-layer key / value by `UnifiedVoice.get_prefix_kv()`,
+            ``speaker_embedding``: (1, 1, spk_dim) by `BigVGAN.get_speaker_embedding()`
+            and ``speaker_conds`` by `BigVGAN.get_speaker_conds()`
+        """
+        cond_mel_lengths = torch.tensor([cond_mel.shape[-1]], device=cond_mel.device)
+        with torch.no_grad():
+            with torch.amp.autocast(cond_mel.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                conds_latent = self.gpt.get_conditioning(cond_mel, cond_mel_lengths)
+                prefix_kv = self.gpt.get_prefix_kv(conds_latent)
+                speaker_embedding = self.bigvgan.get_speaker_embedding(cond_mel.transpose(1, 2))
+                speaker_conds = self.bigvgan.get_speaker_conds(speaker_embedding)
+        return {"conds_latent": conds_latent, "prefix_kv": prefix_kv, "speaker_embedding": speaker_embedding,
+                "speaker_conds": speaker_conds}
+
+    def enroll_voice(self, voice_id: str, audio_prompt, verbose=False) -> Dict[str, torch.Tensor]:
+        """
+        Precompute the conditioning of ``audio_prompt`` and save it as the speaker profile ``voice_id``,
+        later requests with ``infer(voice_id=...)`` skip the whole conditioning stack.
+        """
+        SpeakerProfileStore.check_voice_id(voice_id)
+        features = self.get_prompt_features(audio_prompt, verbose=verbose, with_conditioning=True)
+        profile = {k: features[k] for k in ("cond_mel", "conds_latent", "speaker_embedding")}
+        path = self.speaker_profiles.save(voice_id, profile)
+        self.prompt_cache.put("voice:" + voice_id, self._cast_voice_profile(profile))
+        print(f">> voice {voice_id!r} enrolled to:", path)
+        return profile
+
+    def _cast_voice_profile(self, profile: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        gpt_dtype = self.gpt.text_embedding.weight.dtype
+        profile = {k: v.to(self.device) for k, v in profile.items()}
+        profile["conds_latent"] = profile["conds_latent"].to(gpt_dtype)
+        profile["speaker_embedding"] = profile["speaker_embedding"].float()
+        with torch.no_grad():
+            with torch.amp.autocast(profile["speaker_embedding"].device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                profile["speaker_conds"] = self.bigvgan.get_speaker_conds(profile["speaker_embedding"])
+                # the KV cache of the conditioning prefix is rebuilt from conds_latent, it is not saved
+                profile["prefix_kv"] = self.gpt.get_prefix_kv(profile["conds_latent"])
+        return profile
+
+    def get_voice_conditioning(self, audio_prompt=None, voice_id=None, verbose=False) -> Dict[str, torch.Tensor]:
+        """
+        Returns the conditioning of a request, computed once and shared by all its sentences:
+            ``cond_mel``, ``conds_latent``, ``prefix_kv``, ``speaker_embedding`` and ``speaker_conds``
+        """
+        with self.prompt_lock:
+            if voice_id is None:
+                if audio_prompt is None:
+                    raise ValueError("Either `audio_prompt` or `voice_id` is required")
+                return self.get_prompt_features(audio_prompt, verbose=verbose, with_conditioning=True)
+            key = "voice:" + voice_id
+            profile = self.prompt_cache.get(key)
+            if profile is None:
+                profile = self._cast_voice_profile(self.speaker_profiles.load(voice_id))
+                self.prompt_cache.put(key, profile)
+                if verbose:
+                    print(f">> speaker profile {voice_id!r} loaded from:", self.speaker_profiles.path(voice_id))
+            return profile
+
+    def codes_stop_lens(self, codes: torch.Tensor) -> torch.Tensor:
+        """
+        Number of codes before the first ``stop_mel_token`` of each row, codes: [B, T]
+        """
+        return (codes != self.stop_mel_token).long().cumprod(dim=-1).sum(dim=-1)
+
     def remove_long_silence(self, codes: torch.Tensor, silent_token=52, max_consecutive=30):
         """
         Shrink special tokens (silent_token and stop_mel_token) in codes
         codes: [B, T]
+
+        Rows with more than ``max_consecutive`` silent tokens keep at most 10 tokens of each silent run.
+        Batched tensor ops, only one host sync for the output shape.
         """
-        code_lens = []
-        codes_list = []
-        device = codes.device
-        dtype = codes.dtype
-        isfix = False
-        for i in range(0, codes.shape[0]):
-            code = codes[i]
-            if not torch.any(code == self.stop_mel_token).item():
-                len_ = code.size(0)
-            else:
-                stop_mel_idx = (code == self.stop_mel_token).nonzero(as_tuple=False)
-                len_ = stop_mel_idx[0].item() if len(stop_mel_idx) > 0 else code.size(0)
-
-            count = torch.sum(code == silent_token).item()
-            if count > max_consecutive:
-                # code = code.cpu().tolist()
-                ncode_idx = []
-                n = 0
-                for k in range(len_):
-                    assert code[k] != self.stop_mel_token, f"stop_mel_token {self.stop_mel_token} should be shrinked here"
-                    if code[k] != silent_token:
-                        ncode_idx.append(k)
-                        n = 0
-                    elif code[k] == silent_token and n < 10:
-                        ncode_idx.append(k)
-                        n += 1
-                    # if (k == 0 and code[k] == 52) or (code[k] == 52 and code[k-1] == 52):
-                    #    n += 1
-                # new code
-                len_ = len(ncode_idx)
-                codes_list.append(code[ncode_idx])
-                isfix = True
-            else:
-                # shrink to len_
-                codes_list.append(code[:len_])
-            code_lens.append(len_)
+        T = codes.shape[1]
+        positions = torch.arange(T, device=codes.device)
+        # shrink to the first stop_mel_token
+        valid = positions < self.codes_stop_lens(codes).unsqueeze(1)
+        silent = codes == silent_token
+        fix = silent.sum(dim=-1) > max_consecutive
+        # index of each silent token in its run: distance to the last non-silent token
+        last_sound = torch.where(silent, -1, positions).cummax(dim=-1).values
+        keep = valid & (~silent | (positions - last_sound <= 10))
+        keep = torch.where(fix.unsqueeze(1), keep, valid)
+        code_lens = keep.sum(dim=-1)
+        isfix, max_len = torch.stack([fix.any().long(), code_lens.max()]).tolist()
         if isfix:
-            if len(codes_list) > 1:
-                codes = pad_sequence(codes_list, batch_first=True, padding_value=self.stop_mel_token)
-            else:
-                codes = codes_list[0].unsqueeze(0)
-        else:
-            # unchanged
-            pass
+            # stable sort moves the kept codes to the front, in order
+            order = torch.sort((~keep).to(torch.uint8), dim=-1, stable=True).indices[:, :max_len]
+            codes = codes.gather(1, order)
+            codes = codes.masked_fill(positions[:max_len] >= code_lens.unsqueeze(1), self.stop_mel_token)
         # clip codes to max length
-        max_len = max(code_lens)
         if max_len < codes.shape[1]:
             codes = codes[:, :max_len]
-        code_lens = torch.tensor(code_lens, dtype=torch.long, device=device)
         return codes, code_lens
 
-    def bucket_sentences(self, sentences, bucket_max_size=4) -> List[List[Dict]]:
+    def estimate_mel_tokens(self, sent: List[str], max_mel_tokens=600) -> int:
+        """
+        Predicted number of mel codes of a tokenized sentence by `MelLengthEstimator`, used to plan the buckets.
+        """
+        return min(max_mel_tokens, round(self.mel_length_estimator.estimate(sent)))
+
+    def mel_length_kwargs(self, sentences: List[List[str]], max_mel_tokens=600) -> Dict:
         """
-        Sentence data bucketing.
-        if ``bucket_max_size=1``, return all sentences in one bucket.
+        ``max_generate_length`` and the per-row ``max_lengths`` of `UnifiedVoice.inference_speech()`:
+        a sentence stops when it exceeds ``max_ratio`` times its predicted mel length (see `MelLengthEstimator`).
+        """
+        if self.mel_length_estimator.max_ratio is None:
+            return {"max_generate_length": max_mel_tokens}
+        max_lengths = [self.mel_length_estimator.max_tokens(sent, max_mel_tokens) for sent in sentences]
+        return {
+            "max_generate_length": min(max_mel_tokens, max(max_lengths) + 1),
+            "max_lengths": torch.tensor(max_lengths, device=self.device),
+        }
+
+    def _log_mel_lengths(self, sentences: List[List[str]], codes: torch.Tensor, max_mel_tokens=600):
+        """
+        Log the sentences that stopped by themselves to ``mel_length_log``, codes: [B, T]
+        """
+        if self.mel_length_log is None:
+            return
+        for sent, n in zip(sentences, self.codes_stop_lens(codes).tolist()):
+            if n < self.mel_length_estimator.max_tokens(sent, max_mel_tokens) and n < codes.shape[-1]:
+                MelLengthEstimator.log(self.mel_length_log, sent, n)
+
+    def bucket_sentences(self, sentences, bucket_max_size=4, token_budget=None, num_beams=1, max_mel_tokens=600) -> List[List[Dict]]:
+        """
+        Sentence data bucketing by a token budget.
+
+        The cost of a bucket is ``rows * padded text tokens * predicted mel tokens * num_beams``, which bounds both the
+        padded compute and the KV cache of its batched generation. Sentences are packed longest first, a new bucket
+        starts when the cost would exceed ``token_budget``: each bucket holds sentences of similar lengths, and the
+        sum of the decoding steps (the longest sentence of each bucket) is minimal for the budget.
+        The "idx" of each sentence restores the text order.
+        Args:
+            bucket_max_size: the default ``token_budget`` is the cost of ``bucket_max_size`` longest sentences,
+                shorter sentences share a bucket with more rows
+            token_budget: max cost of a bucket, ``0`` puts every sentence in its own bucket
+            num_beams: beams of the generation
+            max_mel_tokens: max generated mel tokens
         """
         outputs: List[Dict] = []
         for idx, sent in enumerate(sentences):
-            outputs.append({"idx": idx, "sent": sent, "len": len(sent)})
-       
-        if len(outputs) > bucket_max_size:
-            # split sentences into buckets by sentence length
-            buckets: List[List[Dict]] = []
-            factor = 1.5
-            last_bucket = None
-            last_bucket_sent_len_median = 0
-
-            for sent in sorted(outputs, key=lambda x: x["len"]):
-                current_sent_len = sent["len"]
-                if current_sent_len == 0:
-                    print(">> skip empty sentence")
-                    continue
-                if last_bucket is None \
-                        or current_sent_len >= int(last_bucket_sent_len_median * factor) \
-                        or len(last_bucket) >= bucket_max_size:
-                    # new bucket
-                    buckets.append([sent])
-                    last_bucket = buckets[-1]
-                    last_bucket_sent_len_median = current_sent_len
-                else:
-                    # current bucket can hold more sentences
-                    last_bucket.append(sent) # sorted
-                    mid = len(last_bucket) // 2
-                    last_bucket_sent_len_median = last_bucket[mid]["len"]
-            last_bucket=None
-            # merge all buckets with size 1
-            out_buckets: List[List[Dict]] = []
-            only_ones: List[Dict] = []
-            for b in buckets:
-                if len(b) == 1:
-                    only_ones.append(b[0])
-                else:
-                    out_buckets.append(b)
-            if len(only_ones) > 0:
-                # merge into previous buckets if possible
-                # print("only_ones:", [(o["idx"], o["len"]) for o in only_ones])
-                for i in range(len(out_buckets)):
-                    b = out_buckets[i]
-                    if len(b) < bucket_max_size:
-                        b.append(only_ones.pop(0))
-                        if len(only_ones) == 0:
-                            break
-                # combined all remaining sized 1 buckets
-                if len(only_ones) > 0:
-                    out_buckets.extend([only_ones[i:i+bucket_max_size] for i in range(0, len(only_ones), bucket_max_size)])
-            return out_buckets
-        return [outputs]
+            if len(sent) == 0:
+                print(">> skip empty sentence")
+                continue
+            outputs.append({"idx": idx, "sent": sent, "len": len(sent),
+                            "mel_len": self.estimate_mel_tokens(sent, max_mel_tokens)})
+        if len(outputs) == 0:
+            return []
+
+        def cost(rows, longest):
+            # +2 for the start/stop text tokens
+            return rows * (longest["len"] + 2) * longest["mel_len"] * num_beams
+
+        outputs.sort(key=lambda x: x["len"])
+        if token_budget is None:
+            token_budget = cost(bucket_max_size, outputs[-1])
+        buckets: List[List[Dict]] = []
+        for sent in reversed(outputs):
+            # the first sentence is the longest of a bucket
+            if len(buckets) > 0 and cost(len(buckets[-1]) + 1, buckets[-1][0]) <= token_budget:
+                buckets[-1].append(sent)
+            else:
+                buckets.append([sent])
+        # in ascending length
+        return [bucket[::-1] for bucket in reversed(buckets)]
 
     def pad_tokens_cat(self, tokens: List[torch.Tensor]) -> torch.Tensor:
         if self.model_version and self.model_version >= 1.5:
@@ -275,7 +501,8 @@ class IndexTTS:
             self.gr_progress(value, desc=desc)
 
     # 快速推理：对于“多句长文本”，可实现至少 2~10 倍以上的速度提升~ （First modified by sunnyboxs 2025-04-16）
-    def infer_fast(self, audio_prompt, text, output_path, verbose=False, max_text_tokens_per_sentence=100, sentences_bucket_max_size=4, **generation_kwargs):
+    def infer_fast(self, audio_prompt, text, output_path, verbose=False, max_text_tokens_per_sentence=100, sentences_bucket_max_size=4,
+                   voice_id=None, capture_latents=False, bucket_token_budget=None, bigvgan_batch_size=4, **generation_kwargs):
         """
         Args:
             ``max_text_tokens_per_sentence``: 分句的最大token数，默认``100``，可以根据GPU硬件情况调整
@@ -284,6 +511,19 @@ class IndexTTS:
             ``sentences_bucket_max_size``: 分句分桶的最大容量，默认``4``，可以根据GPU内存调整
                 - 越大，bucket数量越少，batch越多，推理速度越*快*，占用内存更多，可能影响质量
                 - 越小，bucket数量越多，batch越少，推理速度越*慢*，占用内存和质量更接近于非快速推理
+            ``bucket_token_budget``: 每个bucket的计算/显存预算，即 句数 × 补齐后的文本token数 × 预估mel token数 × num_beams
+                - 默认 ``None`` 为 ``sentences_bucket_max_size`` 个最长句子的开销，短句可以组成更大的batch
+                - 见 ``bucket_sentences``
+            ``bigvgan_batch_size``: BigVGAN每批解码的句数，默认``4``，长度相近的句子补齐后一起解码，按 hop_length × 帧数 裁剪
+                - CPU上同样生效，多核利用率更高
+            ``voice_id``: 已注册的说话人（见``enroll_voice``），指定后忽略``audio_prompt``，跳过参考音频的条件编码
+            ``capture_latents``: 直接使用生成过程中的GPT隐状态作为BigVGAN输入，省去第二次GPT前向计算
+                - 生成时mel位置编码比前向计算偏移1位，latent与原始推理略有差异
+                - 被``remove_long_silence``修改过的句子仍使用前向计算
+            ``detect_degenerate``: 生成时截断过长的静音并终止短循环的重复code，默认``False``，见``DegenerateOutputLogitsProcessor``
+                - 持续的元音等也可能重复少量code而被终止
+            ``compact_rows``: 已结束的句子退出解码引擎的batch，默认``True``，见``DecodeEngine``
+                - 相同seed的code与``infer``/HF ``generate()``不再逐位一致（batch变小带来的浮点误差），``False``可恢复逐位一致
         """
         print(">> start fast inference...")
         
@@ -293,23 +533,11 @@ class IndexTTS:
         start_time = time.perf_counter()
 
         # 如果参考音频改变了，才需要重新生成 cond_mel, 提升速度
-        if self.cache_cond_mel is None or self.cache_audio_prompt != audio_prompt:
-            audio, sr = torchaudio.load(audio_prompt)
-            audio = torch.mean(audio, dim=0, keepdim=True)
-            if audio.shape[0] > 1:
-                audio = audio[0].unsqueeze(0)
-            audio = torchaudio.transforms.Resample(sr, 24000)(audio)
-            cond_mel = MelSpectrogramFeatures()(audio).to(self.device)
-            cond_mel_frame = cond_mel.shape[-1]
-            if verbose:
-                print(f"cond_mel shape: {cond_mel.shape}", "dtype:", cond_mel.dtype)
-
-            self.cache_audio_prompt = audio_prompt
-            self.cache_cond_mel = cond_mel
-        else:
-            cond_mel = self.cache_cond_mel
-            cond_mel_frame = cond_mel.shape[-1]
-            pass
+        voice = self.get_voice_conditioning(audio_prompt, voice_id, verbose=verbose)
+        cond_mel = voice["cond_mel"]
+        cond_mel_frame = cond_mel.shape[-1]
+        conds_latent = voice["conds_latent"]
+        speaker_conds = voice["speaker_conds"]
 
         auto_conditioning = cond_mel
         cond_mel_lengths = torch.tensor([cond_mel_frame], device=self.device)
@@ -332,10 +560,10 @@ class IndexTTS:
         num_beams = generation_kwargs.pop("num_beams", 3)
         repetition_penalty = generation_kwargs.pop("repetition_penalty", 10.0)
         max_mel_tokens = generation_kwargs.pop("max_mel_tokens", 600)
+        compact_rows = generation_kwargs.pop("compact_rows", True)
         sampling_rate = 24000
         # lang = "EN"
         # lang = "ZH"
-        wavs = []
         gpt_gen_time = 0
         gpt_forward_time = 0
         bigvgan_time = 0
@@ -344,12 +572,14 @@ class IndexTTS:
         all_text_tokens: List[List[torch.Tensor]] = []
         self._set_gr_progress(0.1, "text processing...")
         bucket_max_size = sentences_bucket_max_size if self.device != "cpu" else 1
-        all_sentences = self.bucket_sentences(sentences, bucket_max_size=bucket_max_size)
+        all_sentences = self.bucket_sentences(sentences, bucket_max_size=bucket_max_size,
+                                              token_budget=bucket_token_budget if self.device != "cpu" else 0,
+                                              num_beams=num_beams, max_mel_tokens=max_mel_tokens)
         bucket_count = len(all_sentences)
         if verbose:
             print(">> sentences bucket_count:", bucket_count,
                   "bucket sizes:", [(len(s), [t["idx"] for t in s]) for s in all_sentences],
-                  "bucket_max_size:", bucket_max_size)
+                  "bucket_max_size:", bucket_max_size, "bucket_token_budget:", bucket_token_budget)
         for sentences in all_sentences:
             temp_tokens: List[torch.Tensor] = []
             all_text_tokens.append(temp_tokens)
@@ -369,8 +599,12 @@ class IndexTTS:
         # Sequential processing of bucketing data
         all_batch_num = sum(len(s) for s in all_sentences)
         all_batch_codes = []
+        all_batch_latents = []
         processed_num = 0
-        for item_tokens in all_text_tokens:
+        # finished rows leave the batch of the decode engine (compact_rows), count the skipped row-steps
+        decode_engine = self.gpt.decode_engine
+        row_steps = skipped_row_steps = 0
+        for item_tokens, bucket in zip(all_text_tokens, all_sentences):
             batch_num = len(item_tokens)
             if batch_num > 1:
                 batch_text_tokens = self.pad_tokens_cat(item_tokens)
@@ -380,6 +614,8 @@ class IndexTTS:
             # gpt speech
             self._set_gr_progress(0.2 + 0.3 * processed_num/all_batch_num, f"gpt inference speech... {processed_num}/{all_batch_num}")
             m_start_time = time.perf_counter()
+            if decode_engine is not None:
+                decode_engine.row_stats = {"row_steps": 0, "skipped_row_steps": 0}
             with torch.no_grad():
                 with torch.amp.autocast(batch_text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
                     temp_codes = self.gpt.inference_speech(auto_conditioning, batch_text_tokens,
@@ -393,37 +629,55 @@ class IndexTTS:
                                         length_penalty=length_penalty,
                                         num_beams=num_beams,
                                         repetition_penalty=repetition_penalty,
-                                        max_generate_length=max_mel_tokens,
+                                        conds_latent=conds_latent,
+                                        prefix_kv=voice.get("prefix_kv"),
+                                        return_latent=capture_latents,
+                                        compact_rows=compact_rows,
+                                        **self.mel_length_kwargs([item["sent"] for item in bucket], max_mel_tokens),
                                         **generation_kwargs)
+                    if capture_latents:
+                        temp_codes, temp_latents = temp_codes
+                        all_batch_latents.append(temp_latents)
                     all_batch_codes.append(temp_codes)
             gpt_gen_time += time.perf_counter() - m_start_time
+            if decode_engine is not None:
+                row_steps += decode_engine.row_stats["row_steps"]
+                skipped_row_steps += decode_engine.row_stats["skipped_row_steps"]
 
         # gpt latent
         self._set_gr_progress(0.5, "gpt inference latents...")
         all_idxs = []
         all_latents = []
         has_warned = False
-        for batch_codes, batch_tokens, batch_sentences in zip(all_batch_codes, all_text_tokens, all_sentences):
+        for batch_idx, (batch_codes, batch_tokens, batch_sentences) in enumerate(zip(all_batch_codes, all_text_tokens, all_sentences)):
+            if not has_warned and (batch_codes[:, -1] != self.stop_mel_token).any():
+                warnings.warn(
+                    f"WARN: generation stopped due to exceeding `max_mel_tokens` ({max_mel_tokens}). "
+                    f"Consider reducing `max_text_tokens_per_sentence`({max_text_tokens_per_sentence}) or increasing `max_mel_tokens`.",
+                    category=RuntimeWarning
+                )
+                has_warned = True
+            if verbose:
+                print("codes:", batch_codes.shape)
+                print(batch_codes)
+            self._log_mel_lengths([item["sent"] for item in batch_sentences], batch_codes, max_mel_tokens)
+            batch_stop_lens = self.codes_stop_lens(batch_codes)
+            batch_codes, batch_code_lens = self.remove_long_silence(batch_codes, silent_token=52, max_consecutive=30)
+            if verbose:
+                print("fix codes:", batch_codes.shape)
+                print(batch_codes)
+                print("code_lens:", batch_code_lens)
+            lens_list = batch_code_lens.tolist()
+            unchanged_list = (batch_code_lens == batch_stop_lens).tolist()
             for i in range(batch_codes.shape[0]):
-                codes = batch_codes[i]  # [x]
-                if not has_warned and codes[-1] != self.stop_mel_token:
-                    warnings.warn(
-                        f"WARN: generation stopped due to exceeding `max_mel_tokens` ({max_mel_tokens}). "
-                        f"Consider reducing `max_text_tokens_per_sentence`({max_text_tokens_per_sentence}) or increasing `max_mel_tokens`.",
-                        category=RuntimeWarning
-                    )
-                    has_warned = True
-                codes = codes.unsqueeze(0)  # [x] -> [1, x]
-                if verbose:
-                    print("codes:", codes.shape)
-                    print(codes)
-                codes, code_lens = self.remove_long_silence(codes, silent_token=52, max_consecutive=30)
-                if verbose:
-                    print("fix codes:", codes.shape)
-                    print(codes)
-                    print("code_lens:", code_lens)
+                codes = batch_codes[i : i + 1, : lens_list[i]]  # [1, x]
+                code_lens = batch_code_lens[i : i + 1]
                 text_tokens = batch_tokens[i]
                 all_idxs.append(batch_sentences[i]["idx"])
+                if capture_latents and unchanged_list[i]:
+                    # the codes are unchanged, use the latents captured during generation
+                    all_latents.append(all_batch_latents[batch_idx][i : i + 1, : codes.shape[-1]])
+                    continue
                 m_start_time = time.perf_counter()
                 with torch.no_grad():
                     with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
@@ -432,39 +686,41 @@ class IndexTTS:
                                         torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
                                         code_lens*self.gpt.mel_length_compression,
                                         cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device),
-                                        return_latent=True, clip_inputs=False)
+                                        return_latent=True, clip_inputs=False, conds_latent=conds_latent)
                         gpt_forward_time += time.perf_counter() - m_start_time
                         all_latents.append(latent)
-        del all_batch_codes, all_text_tokens, all_sentences
-        # bigvgan chunk
-        chunk_size = 2
+        del all_batch_codes, all_batch_latents, all_text_tokens, all_sentences
+        # bigvgan batch: sentences of similar lengths, padded, trimmed to hop_length * frames
         all_latents = [all_latents[all_idxs.index(i)] for i in range(len(all_latents))]
         if verbose:
             print(">> all_latents:", len(all_latents))
             print("  latents length:", [l.shape[1] for l in all_latents])
-        chunk_latents = [all_latents[i : i + chunk_size] for i in range(0, len(all_latents), chunk_size)]
-        chunk_length = len(chunk_latents)
+        order = sorted(range(len(all_latents)), key=lambda i: all_latents[i].shape[1])
+        bigvgan_batches = [order[i : i + bigvgan_batch_size] for i in range(0, len(order), bigvgan_batch_size)]
         latent_length = len(all_latents)
+        hop_length = self.bigvgan.hop_length
+        wavs = [None] * latent_length
 
-        # bigvgan chunk decode
+        # bigvgan batch decode
         self._set_gr_progress(0.7, "bigvgan decode...")
         tqdm_progress = tqdm(total=latent_length, desc="bigvgan")
-        for items in chunk_latents:
-            tqdm_progress.update(len(items))
-            latent = torch.cat(items, dim=1)
+        for batch in bigvgan_batches:
+            tqdm_progress.update(len(batch))
+            lengths = [all_latents[i].shape[1] for i in batch]
+            latent = pad_sequence([all_latents[i][0] for i in batch], batch_first=True)
             with torch.no_grad():
                 with torch.amp.autocast(latent.device.type, enabled=self.dtype is not None, dtype=self.dtype):
                     m_start_time = time.perf_counter()
-                    wav, _ = self.bigvgan(latent, auto_conditioning.transpose(1, 2))
+                    wav = self._bigvgan_decode(latent, speaker_conds, lengths=torch.tensor(lengths, device=latent.device))
                     bigvgan_time += time.perf_counter() - m_start_time
                     wav = wav.squeeze(1)
-                    pass
-            wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
-            wavs.append(wav.cpu()) # to cpu before saving
+            wav = torch.clamp(32767 * wav, -32767.0, 32767.0).cpu()  # to cpu before saving
+            for i, row, n in zip(batch, wav, lengths):
+                wavs[i] = row[None, : n * hop_length]
 
         # clear cache
         tqdm_progress.close()  # 确保进度条被关闭
-        del all_latents, chunk_latents
+        del all_latents
         end_time = time.perf_counter()
         self.torch_empty_cache()
 
@@ -473,13 +729,17 @@ class IndexTTS:
         wav = torch.cat(wavs, dim=1)
         wav_length = wav.shape[-1] / sampling_rate
         print(f">> Reference audio length: {cond_mel_frame * 256 / sampling_rate:.2f} seconds")
+        print(f">> {self.prompt_cache}")
         print(f">> gpt_gen_time: {gpt_gen_time:.2f} seconds")
         print(f">> gpt_forward_time: {gpt_forward_time:.2f} seconds")
         print(f">> bigvgan_time: {bigvgan_time:.2f} seconds")
         print(f">> Total fast inference time: {end_time - start_time:.2f} seconds")
         print(f">> Generated audio length: {wav_length:.2f} seconds")
-        print(f">> [fast] bigvgan chunk_length: {chunk_length}")
+        print(f">> [fast] bigvgan batches: {len(bigvgan_batches)} bigvgan_batch_size: {bigvgan_batch_size}")
         print(f">> [fast] batch_num: {all_batch_num} bucket_max_size: {bucket_max_size}", f"bucket_count: {bucket_count}" if bucket_max_size > 1 else "")
+        if row_steps + skipped_row_steps > 0:
+            print(f">> [fast] gpt row-steps: {row_steps}, skipped finished rows: {skipped_row_steps} "
+                  f"({skipped_row_steps / (row_steps + skipped_row_steps):.1%})")
         print(f">> [fast] RTF: {(end_time - start_time) / wav_length:.4f}")
 
         # save audio
@@ -497,7 +757,14 @@ class IndexTTS:
             return (sampling_rate, wav_data)
 
     # 原始推理模式
-    def infer(self, audio_prompt, text, output_path, verbose=False, max_text_tokens_per_sentence=120, **generation_kwargs):
+    def infer(self, audio_prompt, text, output_path, verbose=False, max_text_tokens_per_sentence=120, voice_id=None,
+              capture_latents=False, **generation_kwargs):
+        """
+        Args:
+            ``voice_id``: 已注册的说话人（见``enroll_voice``），指定后忽略``audio_prompt``
+            ``capture_latents``: 直接使用生成过程中的GPT隐状态作为BigVGAN输入，省去第二次GPT前向计算，见``infer_fast``
+            ``detect_degenerate``: 生成时截断过长的静音并终止短循环的重复code，默认``False``，见``infer_fast``
+        """
         print(">> start inference...")
         self._set_gr_progress(0, "start inference...")
         if verbose:
@@ -505,23 +772,11 @@ class IndexTTS:
         start_time = time.perf_counter()
 
         # 如果参考音频改变了，才需要重新生成 cond_mel, 提升速度
-        if self.cache_cond_mel is None or self.cache_audio_prompt != audio_prompt:
-            audio, sr = torchaudio.load(audio_prompt)
-            audio = torch.mean(audio, dim=0, keepdim=True)
-            if audio.shape[0] > 1:
-                audio = audio[0].unsqueeze(0)
-            audio = torchaudio.transforms.Resample(sr, 24000)(audio)
-            cond_mel = MelSpectrogramFeatures()(audio).to(self.device)
-            cond_mel_frame = cond_mel.shape[-1]
-            if verbose:
-                print(f"cond_mel shape: {cond_mel.shape}", "dtype:", cond_mel.dtype)
-
-            self.cache_audio_prompt = audio_prompt
-            self.cache_cond_mel = cond_mel
-        else:
-            cond_mel = self.cache_cond_mel
-            cond_mel_frame = cond_mel.shape[-1]
-            pass
+        voice = self.get_voice_conditioning(audio_prompt, voice_id, verbose=verbose)
+        cond_mel = voice["cond_mel"]
+        cond_mel_frame = cond_mel.shape[-1]
+        conds_latent = voice["conds_latent"]
+        speaker_conds = voice["speaker_conds"]
 
         self._set_gr_progress(0.1, "text processing...")
         auto_conditioning = cond_mel
@@ -582,8 +837,13 @@ class IndexTTS:
                                                         length_penalty=length_penalty,
                                                         num_beams=num_beams,
                                                         repetition_penalty=repetition_penalty,
-                                                        max_generate_length=max_mel_tokens,
+                                                        conds_latent=conds_latent,
+                                                        prefix_kv=voice.get("prefix_kv"),
+                                                        return_latent=capture_latents,
+                                                        **self.mel_length_kwargs([sent], max_mel_tokens),
                                                         **generation_kwargs)
+                    if capture_latents:
+                        codes, gen_latent = codes
                 gpt_gen_time += time.perf_counter() - m_start_time
                 if not has_warned and (codes[:, -1] != self.stop_mel_token).any():
                     warnings.warn(
@@ -593,6 +853,7 @@ class IndexTTS:
                         category=RuntimeWarning
                     )
                     has_warned = True
+                self._log_mel_lengths([sent], codes, max_mel_tokens)
 
                 code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
                 if verbose:
@@ -602,6 +863,7 @@ class IndexTTS:
 
                 # remove ultra-long silence if exits
                 # temporarily fix the long silence bug.
+                stop_lens = self.codes_stop_lens(codes)
                 codes, code_lens = self.remove_long_silence(codes, silent_token=52, max_consecutive=30)
                 if verbose:
                     print(codes, type(codes))
@@ -611,16 +873,20 @@ class IndexTTS:
                 m_start_time = time.perf_counter()
                 # latent, text_lens_out, code_lens_out = \
                 with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
-                    latent = \
-                        self.gpt(auto_conditioning, text_tokens,
-                                    torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
-                                    code_lens*self.gpt.mel_length_compression,
-                                    cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device),
-                                    return_latent=True, clip_inputs=False)
+                    if capture_latents and torch.equal(code_lens, stop_lens):
+                        # the codes are unchanged, use the latents captured during generation
+                        latent = gen_latent[:, : codes.shape[-1]]
+                    else:
+                        latent = \
+                            self.gpt(auto_conditioning, text_tokens,
+                                        torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
+                                        code_lens*self.gpt.mel_length_compression,
+                                        cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device),
+                                        return_latent=True, clip_inputs=False, conds_latent=conds_latent)
                     gpt_forward_time += time.perf_counter() - m_start_time
 
                     m_start_time = time.perf_counter()
-                    wav, _ = self.bigvgan(latent, auto_conditioning.transpose(1, 2))
+                    wav = self._bigvgan_decode(latent, speaker_conds)
                     bigvgan_time += time.perf_counter() - m_start_time
                     wav = wav.squeeze(1)
 
@@ -634,6 +900,7 @@ class IndexTTS:
         wav = torch.cat(wavs, dim=1)
         wav_length = wav.shape[-1] / sampling_rate
         print(f">> Reference audio length: {cond_mel_frame * 256 / sampling_rate:.2f} seconds")
+        print(f">> {self.prompt_cache}")
         print(f">> gpt_gen_time: {gpt_gen_time:.2f} seconds")
         print(f">> gpt_forward_time: {gpt_forward_time:.2f} seconds")
         print(f">> bigvgan_time: {bigvgan_time:.2f} seconds")
@@ -659,6 +926,354 @@ class IndexTTS:
             wav_data = wav_data.numpy().T
             return (sampling_rate, wav_data)
 
+    # 流水线推理：BigVGAN在独立线程中解码上一句，同时GPT生成下一句
+    def infer_pipelined(self, audio_prompt, text, output_path, verbose=False, max_text_tokens_per_sentence=120, voice_id=None,
+                        capture_latents=False, pipeline_queue_size=2, gpt_threads=None, vocoder_threads=None, **generation_kwargs):
+        """
+        Same results as `infer()`, but the vocoder stage of sentence N runs on a worker thread (and CUDA stream)
+        while the GPT generates sentence N+1.
+        Args:
+            ``pipeline_queue_size``: GPT最多领先BigVGAN的句子数
+            ``gpt_threads``, ``vocoder_threads``: CPU上GPT与BigVGAN各自的intra-op线程数，``None``为不修改
+            others: same as `infer()`
+        """
+        print(">> start pipelined inference...")
+        self._set_gr_progress(0, "start pipelined inference...")
+        if verbose:
+            print(f"origin text:{text}")
+        start_time = time.perf_counter()
+
+        voice = self.get_voice_conditioning(audio_prompt, voice_id, verbose=verbose)
+        cond_mel = voice["cond_mel"]
+        cond_mel_lengths = torch.tensor([cond_mel.shape[-1]], device=self.device)
+        text_tokens_list = self.tokenizer.tokenize(text)
+        sentences = self.tokenizer.split_sentences(text_tokens_list, max_text_tokens_per_sentence)
+        if verbose:
+            print("text token count:", len(text_tokens_list))
+            print("sentences count:", len(sentences))
+            print(*sentences, sep="\n")
+        gen_kwargs = {
+            "do_sample": generation_kwargs.pop("do_sample", True),
+            "top_p": generation_kwargs.pop("top_p", 0.8),
+            "top_k": generation_kwargs.pop("top_k", 30),
+            "temperature": generation_kwargs.pop("temperature", 1.0),
+            "num_return_sequences": 1,
+            "length_penalty": generation_kwargs.pop("length_penalty", 0.0),
+            "num_beams": generation_kwargs.pop("num_beams", 3),
+            "repetition_penalty": generation_kwargs.pop("repetition_penalty", 10.0),
+            "max_generate_length": generation_kwargs.pop("max_mel_tokens", 600),
+            **generation_kwargs,
+        }
+        sampling_rate = 24000
+
+        on_cpu = self.device == "cpu"
+        prev_threads = torch.get_num_threads()
+        if on_cpu and gpt_threads:
+            torch.set_num_threads(gpt_threads)
+        vocoder_stage = PipelineStage(lambda latent: self._vocode(latent, voice["speaker_conds"]),
+                                      queue_size=pipeline_queue_size,
+                                      num_threads=vocoder_threads if on_cpu else None,
+                                      device=self.device, name="bigvgan")
+        gpt_time = 0.0
+        has_warned = False
+        pipeline_start_time = time.perf_counter()
+        try:
+            for progress, sent in enumerate(sentences, 1):
+                self._set_gr_progress(0.1 + 0.8 * (progress - 1) / len(sentences), f"gpt inference speech... {progress}/{len(sentences)}")
+                m_start_time = time.perf_counter()
+                text_tokens = self._text_to_tokens(sent)
+                with torch.no_grad():
+                    with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                        codes = self.gpt.inference_speech(cond_mel, text_tokens,
+                                                          cond_mel_lengths=cond_mel_lengths,
+                                                          conds_latent=voice["conds_latent"],
+                                                          prefix_kv=voice.get("prefix_kv"),
+                                                          return_latent=capture_latents,
+                                                          **{**gen_kwargs, **self.mel_length_kwargs([sent], gen_kwargs["max_generate_length"])})
+                gen_latent = None
+                if capture_latents:
+                    codes, gen_latent = codes
+                if not has_warned:
+                    has_warned = self._warn_max_mel_tokens(codes, gen_kwargs)
+                self._log_mel_lengths([sent], codes, gen_kwargs["max_generate_length"])
+                latent = self._sentence_latent(cond_mel, voice["conds_latent"], text_tokens, codes, gen_latent)
+                gpt_time += time.perf_counter() - m_start_time
+                # blocks while the vocoder is ``pipeline_queue_size`` sentences behind
+                vocoder_stage.submit(latent)
+            wavs = vocoder_stage.join()
+        finally:
+            # the worker would stay blocked on its queue when the GPT loop raised
+            vocoder_stage.close()
+            if on_cpu and gpt_threads:
+                torch.set_num_threads(prev_threads)
+        end_time = time.perf_counter()
+        self.torch_empty_cache()
+
+        self._set_gr_progress(0.9, "save audio...")
+        wav = torch.cat(wavs, dim=1)
+        wav_length = wav.shape[-1] / sampling_rate
+        pipeline_time = end_time - pipeline_start_time
+        print(f">> Reference audio length: {cond_mel.shape[-1] * 256 / sampling_rate:.2f} seconds")
+        print(f">> [pipeline] gpt stage: {gpt_time:.2f} seconds, utilisation: {gpt_time / pipeline_time:.1%}")
+        print(f">> [pipeline] bigvgan stage: {vocoder_stage.busy_time:.2f} seconds, utilisation: {vocoder_stage.busy_time / pipeline_time:.1%}")
+        print(f">> [pipeline] overlapped: {max(0.0, gpt_time + vocoder_stage.busy_time - pipeline_time):.2f} seconds")
+        print(f">> Total inference time: {end_time - start_time:.2f} seconds")
+        print(f">> Generated audio length: {wav_length:.2f} seconds")
+        print(f">> RTF: {(end_time - start_time) / wav_length:.4f}")
+
+        wav = wav.cpu()
+        if output_path:
+            if os.path.dirname(output_path) != "":
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            torchaudio.save(output_path, wav.type(torch.int16), sampling_rate)
+            print(">> wav file saved to:", output_path)
+            return output_path
+        else:
+            # 返回以符合Gradio的格式要求
+            wav_data = wav.type(torch.int16)
+            wav_data = wav_data.numpy().T
+            return (sampling_rate, wav_data)
+
+    def _sentence_latent(self, cond_mel, conds_latent, text_tokens, codes, gen_latent=None):
+        """
+        GPT latent of one generated sentence, codes: [1, T] (may end with stop_mel_token)
+        ``gen_latent``: latents captured during generation, used if `remove_long_silence()` leaves the codes unchanged
+        """
+        stop_lens = self.codes_stop_lens(codes)
+        codes, code_lens = self.remove_long_silence(codes, silent_token=52, max_consecutive=30)
+        if gen_latent is not None and torch.equal(code_lens, stop_lens):
+            return gen_latent[:, : codes.shape[-1]]
+        with torch.no_grad():
+            with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                latent = self.gpt(cond_mel, text_tokens,
+                                  torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
+                                  code_lens * self.gpt.mel_length_compression,
+                                  cond_mel_lengths=torch.tensor([cond_mel.shape[-1]], device=text_tokens.device),
+                                  return_latent=True, clip_inputs=False, conds_latent=conds_latent)
+        return latent
+
+    def _vocode(self, latent, speaker_conds) -> torch.Tensor:
+        """
+        BigVGAN decode, returns the wav [1, samples] on cpu, scaled to the int16 range
+        """
+        with torch.no_grad():
+            with torch.amp.autocast(latent.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                wav = self._bigvgan_decode(latent, speaker_conds)
+        wav = torch.clamp(32767 * wav.squeeze(1), -32767.0, 32767.0)
+        return wav.cpu()
+
+    def _bigvgan_decode(self, latent, speaker_conds, lengths=None) -> torch.Tensor:
+        """
+        BigVGAN decode of latents (b, frames, dim) to a wav (b, 1, samples), tiled with ``bigvgan_tile_size``,
+        ``lengths``: (b,) latent frames of the rows of a padded batch
+        """
+        if self.bigvgan_tile_size:
+            return self.bigvgan.inference_tiled(latent, speaker_conds, tile_size=self.bigvgan_tile_size, lengths=lengths)
+        wav, _ = self.bigvgan(latent, speaker_conds=speaker_conds, lengths=lengths)
+        return wav
+
+    # 流式推理：逐句（或逐段token）输出音频，降低首包延迟
+    def infer_stream(self, audio_prompt, text, verbose=False, max_text_tokens_per_sentence=100, sentences_bucket_max_size=4,
+                     voice_id=None, capture_latents=False, stream_chunk_tokens=None, stream_lookback_tokens=16,
+                     stream_crossfade_tokens=4, **generation_kwargs):
+        """
+        Streaming inference, yields the audio as soon as it passes BigVGAN.
+
+        By default a chunk is one sentence: the first sentence is generated alone to minimize the time to first chunk,
+        the remaining sentences are bucketed as in `infer_fast()` and yielded in text order.
+        With ``stream_chunk_tokens``, BigVGAN runs on windows of the latents while the GPT is still decoding,
+        see `StreamingVocoder`.
+        Args:
+            ``stream_chunk_tokens``: 每隔多少个mel token输出一段音频（如 20~40），``None`` 为逐句输出
+                - 需要 ``num_beams=1``，使用生成过程中的GPT隐状态，且不做 ``remove_long_silence``
+            ``stream_lookback_tokens``: 每段额外输入BigVGAN的历史token数，作为卷积的上文
+            ``stream_crossfade_tokens``: 相邻两段交叉淡化（overlap-add）的token数
+            others: same as `infer_fast()`
+        Yields:
+            (sampling_rate, wav_data): int16 PCM chunk, ``wav_data`` shape (samples, 1)
+        """
+        print(">> start stream inference...")
+        if verbose:
+            print(f"origin text:{text}")
+        start_time = time.perf_counter()
+
+        voice = self.get_voice_conditioning(audio_prompt, voice_id, verbose=verbose)
+        text_tokens_list = self.tokenizer.tokenize(text)
+        sentences = self.tokenizer.split_sentences(text_tokens_list, max_tokens_per_sentence=max_text_tokens_per_sentence)
+        sentences = [sent for sent in sentences if len(sent) > 0]
+        if verbose:
+            print(">> text token count:", len(text_tokens_list))
+            print("   splited sentences count:", len(sentences))
+            print(*sentences, sep="\n")
+        if len(sentences) == 0:
+            return
+        gen_kwargs = {
+            "do_sample": generation_kwargs.pop("do_sample", True),
+            "top_p": generation_kwargs.pop("top_p", 0.8),
+            "top_k": generation_kwargs.pop("top_k", 30),
+            "temperature": generation_kwargs.pop("temperature", 1.0),
+            "num_return_sequences": 1,
+            "length_penalty": generation_kwargs.pop("length_penalty", 0.0),
+            "num_beams": generation_kwargs.pop("num_beams", 1 if stream_chunk_tokens else 3),
+            "repetition_penalty": generation_kwargs.pop("repetition_penalty", 10.0),
+            "max_generate_length": generation_kwargs.pop("max_mel_tokens", 600),
+            **generation_kwargs,
+        }
+        sampling_rate = 24000
+
+        if stream_chunk_tokens:
+            if gen_kwargs["num_beams"] != 1:
+                raise ValueError("Token-level streaming (`stream_chunk_tokens`) requires `num_beams=1`")
+            chunks = self._stream_tokens(voice, sentences, gen_kwargs, verbose,
+                                         stream_chunk_tokens, stream_lookback_tokens, stream_crossfade_tokens)
+        else:
+            chunks = self._stream_sentences(voice, sentences, gen_kwargs, verbose, sentences_bucket_max_size, capture_latents)
+
+        chunk_count = 0
+        first_chunk_time = None
+        wav_length = 0.0
+        for wav, chunk_time in chunks:
+            chunk_length = wav.shape[-1] / sampling_rate
+            wav_length += chunk_length
+            chunk_count += 1
+            if first_chunk_time is None:
+                first_chunk_time = time.perf_counter() - start_time
+                print(f">> [stream] time to first chunk: {first_chunk_time:.2f} seconds")
+            print(f">> [stream] chunk {chunk_count}: {chunk_length:.2f} seconds audio, "
+                  f"RTF: {chunk_time / max(chunk_length, 1e-6):.4f}")
+            yield (sampling_rate, wav.type(torch.int16).numpy().T)
+
+        end_time = time.perf_counter()
+        self.torch_empty_cache()
+        print(f">> [stream] time to first chunk: {first_chunk_time:.2f} seconds")
+        print(f">> [stream] Total inference time: {end_time - start_time:.2f} seconds")
+        print(f">> [stream] Generated audio length: {wav_length:.2f} seconds")
+        print(f">> [stream] RTF: {(end_time - start_time) / max(wav_length, 1e-6):.4f}")
+
+    def _text_to_tokens(self, sent) -> torch.Tensor:
+        text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
+        return torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
+
+    def _warn_max_mel_tokens(self, codes, gen_kwargs) -> bool:
+        """
+        Warn if a row of ``codes`` stopped at ``max_mel_tokens``, returns whether it warned
+        """
+        if (codes[:, -1] != self.stop_mel_token).any():
+            warnings.warn(
+                f"WARN: generation stopped due to exceeding `max_mel_tokens` ({gen_kwargs['max_generate_length']}). "
+                f"Consider reducing `max_text_tokens_per_sentence` or increasing `max_mel_tokens`.",
+                category=RuntimeWarning
+            )
+            return True
+        return False
+
+    def _stream_sentences(self, voice, sentences, gen_kwargs, verbose, sentences_bucket_max_size, capture_latents):
+        """
+        Yields (wav, compute_time) of every sentence in text order, wav: [1, samples] in the int16 range
+        """
+        cond_mel = voice["cond_mel"]
+        cond_mel_lengths = torch.tensor([cond_mel.shape[-1]], device=self.device)
+        # the first sentence alone, then the buckets ordered by their earliest sentence
+        bucket_max_size = sentences_bucket_max_size if self.device != "cpu" else 1
+        buckets = self.bucket_sentences(sentences[1:], bucket_max_size=bucket_max_size,
+                                        token_budget=None if self.device != "cpu" else 0,
+                                        num_beams=gen_kwargs["num_beams"],
+                                        max_mel_tokens=gen_kwargs["max_generate_length"]) if len(sentences) > 1 else []
+        for bucket in buckets:
+            for item in bucket:
+                item["idx"] += 1
+        buckets.sort(key=lambda b: min(item["idx"] for item in b))
+        buckets.insert(0, [{"idx": 0, "sent": sentences[0], "len": len(sentences[0])}])
+        if verbose:
+            print(">> stream buckets:", [[item["idx"] for item in b] for b in buckets])
+
+        max_mel_tokens = gen_kwargs["max_generate_length"]
+        pending: Dict[int, Tuple[torch.Tensor, float]] = {}
+        next_idx = 0
+        has_warned = False
+        for bucket in buckets:
+            m_start_time = time.perf_counter()
+            bucket_sentences = [item["sent"] for item in bucket]
+            tokens = [self._text_to_tokens(sent) for sent in bucket_sentences]
+            batch_text_tokens = self.pad_tokens_cat(tokens) if len(tokens) > 1 else tokens[0]
+            with torch.no_grad():
+                with torch.amp.autocast(batch_text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                    batch_codes = self.gpt.inference_speech(cond_mel, batch_text_tokens,
+                                                            cond_mel_lengths=cond_mel_lengths,
+                                                            conds_latent=voice["conds_latent"],
+                                                            prefix_kv=voice.get("prefix_kv"),
+                                                            return_latent=capture_latents,
+                                                            **{**gen_kwargs, **self.mel_length_kwargs(bucket_sentences, max_mel_tokens)})
+            batch_latents = None
+            if capture_latents:
+                batch_codes, batch_latents = batch_codes
+            if not has_warned:
+                has_warned = self._warn_max_mel_tokens(batch_codes, gen_kwargs)
+            self._log_mel_lengths(bucket_sentences, batch_codes, max_mel_tokens)
+            # share the batched generation time among the sentences of the bucket
+            gen_time = (time.perf_counter() - m_start_time) / len(bucket)
+            for i, item in enumerate(bucket):
+                m_start_time = time.perf_counter()
+                gen_latent = batch_latents[i : i + 1] if batch_latents is not None else None
+                latent = self._sentence_latent(cond_mel, voice["conds_latent"], tokens[i], batch_codes[i : i + 1], gen_latent)
+                wav = self._vocode(latent, voice["speaker_conds"])
+                pending[item["idx"]] = (wav, gen_time + time.perf_counter() - m_start_time)
+            while next_idx in pending:
+                yield pending.pop(next_idx)
+                next_idx += 1
+
+    def _stream_tokens(self, voice, sentences, gen_kwargs, verbose, chunk_tokens, lookback_tokens, crossfade_tokens):
+        """
+        Yields (wav, compute_time) every ``chunk_tokens`` decoded mel tokens, wav: [1, samples] in the int16 range.
+        The GPT decodes in a worker thread, BigVGAN runs inside the `generate()` loop through `LatentStreamer`.
+        """
+        cond_mel = voice["cond_mel"]
+        cond_mel_lengths = torch.tensor([cond_mel.shape[-1]], device=self.device)
+        hop_length = math.prod(self.cfg.bigvgan.upsample_rates) * (4 if self.cfg.bigvgan.feat_upsample else 1)
+        vocoder = StreamingVocoder(lambda latent: self._vocode(latent, voice["speaker_conds"]), hop_length,
+                                   chunk_size=chunk_tokens, lookback=lookback_tokens, crossfade=crossfade_tokens)
+        for sent in sentences:
+            text_tokens = self._text_to_tokens(sent)
+            streamer = LatentStreamer(self.gpt.inference_model, vocoder, self.stop_mel_token)
+            errors = []
+
+            def generate():
+                try:
+                    # grad mode and autocast are thread local
+                    with torch.no_grad():
+                        with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                            codes, _ = self.gpt.inference_speech(cond_mel, text_tokens,
+                                                                 cond_mel_lengths=cond_mel_lengths,
+                                                                 conds_latent=voice["conds_latent"],
+                                                                 return_latent=True,
+                                                                 streamer=streamer,
+                                                                 stopping_criteria=streamer.stopping_criteria(),
+                                                                 **{**gen_kwargs, **self.mel_length_kwargs(
+                                                                     [sent], gen_kwargs["max_generate_length"])})
+                    if not streamer.cancelled:
+                        self._warn_max_mel_tokens(codes, gen_kwargs)
+                except BaseException as e:
+                    errors.append(e)
+                    streamer.abort()
+
+            thread = threading.Thread(target=generate, daemon=True)
+            m_start_time = time.perf_counter()
+            thread.start()
+            try:
+                for wav in streamer:
+                    yield wav, time.perf_counter() - m_start_time
+                    m_start_time = time.perf_counter()
+            finally:
+                # the consumer may quit early (GeneratorExit at `yield`): stop the decoding before the next
+                # request captures latents on the same model
+                streamer.cancel()
+                thread.join()
+                vocoder.reset()
+            if errors:
+                raise errors[0]
+            if verbose:
+                print(f">> [stream] sentence of {text_tokens.shape[-1]} text tokens, {streamer.num_tokens} mel tokens")
+
 
 if __name__ == "__main__":
     prompt_wav="test_data/input.wav"
@@ -0,0 +1,259 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import torch
+import torchaudio
+
+from indextts.gpt.batch_decoder import BatchDecoder, DecodeSequence
+from indextts.infer import IndexTTS, PipelineStage
+
+
+class SynthesisRequest:
+    """
+    Handle of a request submitted to `ContinuousBatchScheduler`, call `result()` to wait for the audio.
+    """
+
+    def __init__(self, text: str, audio_prompt=None, voice_id=None, generation_kwargs=None):
+        self.text = text
+        self.audio_prompt = audio_prompt
+        self.voice_id = voice_id
+        self.generation_kwargs = generation_kwargs or {}
+        self.voice: Optional[Dict[str, torch.Tensor]] = None
+        self.num_sentences = 0
+        self.wavs: Dict[int, torch.Tensor] = {}
+        self.error: Optional[BaseException] = None
+        self.submit_time = time.perf_counter()
+        self.first_token_time: Optional[float] = None
+        self.finish_time: Optional[float] = None
+        self._done = threading.Event()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def result(self, timeout: Optional[float] = None) -> Tuple[int, "numpy.ndarray"]:
+        """
+        Wait for the request, returns ``(sampling_rate, wav_data)`` in the same format as `IndexTTS.infer()`
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("Synthesis request is not finished")
+        if self.error is not None:
+            raise self.error
+        wav = torch.cat([self.wavs[i] for i in range(self.num_sentences)], dim=1)
+        return ContinuousBatchScheduler.sampling_rate, wav.type(torch.int16).numpy().T
+
+    def save(self, output_path: str, timeout: Optional[float] = None) -> str:
+        """
+        Wait for the request and save the audio to ``output_path``, as `IndexTTS.infer()` with an ``output_path``
+        """
+        sampling_rate, wav_data = self.result(timeout)
+        if os.path.dirname(output_path) != "":
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        torchaudio.save(output_path, torch.from_numpy(wav_data.T), sampling_rate)
+        return output_path
+
+    def _add_wav(self, idx: int, wav: torch.Tensor):
+        self.wavs[idx] = wav
+        if len(self.wavs) == self.num_sentences:
+            self._finish()
+
+    def _fail(self, error: BaseException):
+        if not self._done.is_set():
+            self.error = error
+            self._finish()
+
+    def _finish(self):
+        self.finish_time = time.perf_counter()
+        self.voice = None
+        self._done.set()
+
+
+class ContinuousBatchScheduler:
+    """
+    Continuous batching of the GPT decoding across concurrent requests, possibly with different voices.
+
+    The sentences of all submitted requests are queued, and a background thread decodes them with a `BatchDecoder`:
+    between two decoding steps, finished sentences leave the batch and queued sentences join it, so the batch
+    stays full. Finished sentences go to a `PipelineStage` worker for the latent pass and BigVGAN, and the audio
+    is routed back to its `SynthesisRequest`.
+
+    Only sampling / greedy decoding (``num_beams=1``) is supported.
+    ```
+    scheduler = ContinuousBatchScheduler(tts, max_batch_size=8)
+    request = scheduler.submit(text, audio_prompt="voice.wav")
+    sampling_rate, wav_data = request.result()
+    scheduler.stop()
+    ```
+    """
+
+    sampling_rate = 24000
+
+    def __init__(self, tts: IndexTTS, max_batch_size=8, max_text_tokens_per_sentence=120, capture_latents=False,
+                 vocoder_queue_size=4, verbose=False):
+        """
+        Args:
+            tts (IndexTTS): the loaded models
+            max_batch_size (int): max number of sentences decoded together
+            max_text_tokens_per_sentence (int): default of `submit()`
+            capture_latents (bool): see `IndexTTS.infer_fast()`
+            vocoder_queue_size (int): max number of finished sentences waiting for the vocoder
+        """
+        self.tts = tts
+        self.max_batch_size = max_batch_size
+        self.max_text_tokens_per_sentence = max_text_tokens_per_sentence
+        self.capture_latents = capture_latents
+        self.verbose = verbose
+        self.decoder = BatchDecoder(tts.gpt)
+        self.pending: Deque[Tuple[SynthesisRequest, int, List[str], torch.Tensor, int, Optional[int]]] = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        # statistics
+        self.num_steps = 0
+        self.num_tokens = 0
+        self.decode_time = 0.0
+        self.vocoder_stage = PipelineStage(self._vocode_sentence, queue_size=vocoder_queue_size, device=tts.device,
+                                           name="bigvgan", keep_results=False)
+        self.thread = threading.Thread(target=self._run, name="gpt-scheduler", daemon=True)
+        self.thread.start()
+
+    def submit(self, text: str, audio_prompt=None, voice_id=None, max_text_tokens_per_sentence=None,
+               **generation_kwargs) -> SynthesisRequest:
+        """
+        Queue a request, ``generation_kwargs`` are the sampling settings of `IndexTTS.infer()`
+        (``do_sample``, ``top_p``, ``top_k``, ``temperature``, ``repetition_penalty``, ``max_mel_tokens``).
+        """
+        if generation_kwargs.pop("num_beams", 1) != 1:
+            raise ValueError("ContinuousBatchScheduler only supports num_beams=1")
+        generation_kwargs.pop("length_penalty", None)  # only used by beam search
+        if generation_kwargs.pop("detect_degenerate", False):
+            raise ValueError("ContinuousBatchScheduler does not support detect_degenerate")
+        if audio_prompt is None and voice_id is None:
+            raise ValueError("Either `audio_prompt` or `voice_id` is required")
+        request = SynthesisRequest(text, audio_prompt=audio_prompt, voice_id=voice_id, generation_kwargs=generation_kwargs)
+        tokenizer = self.tts.tokenizer
+        sentences = tokenizer.split_sentences(tokenizer.tokenize(text),
+                                              max_text_tokens_per_sentence or self.max_text_tokens_per_sentence)
+        sentences = [sent for sent in sentences if len(sent) > 0]
+        request.num_sentences = len(sentences)
+        if len(sentences) == 0:
+            request._fail(ValueError("No text to synthesize"))
+            return request
+        with self.condition:
+            if not self.running:
+                raise RuntimeError("ContinuousBatchScheduler is stopped")
+            for idx, sent in enumerate(sentences):
+                text_tokens = torch.tensor(tokenizer.convert_tokens_to_ids(sent), dtype=torch.int32)
+                # stop at the predicted mel length limit of the sentence
+                mel_length_kwargs = self.tts.mel_length_kwargs([sent], generation_kwargs.get("max_mel_tokens", 600))
+                max_length = mel_length_kwargs.get("max_lengths")
+                self.pending.append((request, idx, sent, text_tokens, mel_length_kwargs["max_generate_length"],
+                                     None if max_length is None else int(max_length[0])))
+            self.condition.notify()
+        return request
+
+    def stop(self):
+        """
+        Finish the queued requests and stop the background threads.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.vocoder_stage.join()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "steps": self.num_steps,
+            "tokens": self.num_tokens,
+            "mean_batch_size": self.num_tokens / max(self.num_steps, 1),
+            "tokens_per_second": self.num_tokens / max(self.decode_time, 1e-6),
+            "pending_sentences": len(self.pending),
+            "active_sentences": len(self.decoder),
+        }
+
+    def _admit(self) -> List[DecodeSequence]:
+        """
+        Take queued sentences to fill the batch, resolving the voice of each new request.
+        """
+        sequences = []
+        while len(self.decoder) + len(sequences) < self.max_batch_size:
+            with self.condition:
+                if len(self.pending) == 0:
+                    break
+                request, idx, sent, text_tokens, max_new_tokens, max_length = self.pending.popleft()
+            if request.done():
+                continue
+            try:
+                if request.voice is None:
+                    request.voice = self.tts.get_voice_conditioning(request.audio_prompt, request.voice_id)
+                kwargs = request.generation_kwargs
+                sequences.append(DecodeSequence(
+                    request.voice["conds_latent"], text_tokens.to(self.tts.device),
+                    do_sample=kwargs.get("do_sample", True),
+                    top_k=kwargs.get("top_k", 30),
+                    top_p=kwargs.get("top_p", 0.8),
+                    temperature=kwargs.get("temperature", 1.0),
+                    repetition_penalty=kwargs.get("repetition_penalty", 10.0),
+                    max_new_tokens=max_new_tokens,
+                    max_length=max_length,
+                    capture_latents=self.capture_latents,
+                    tag=(request, idx, sent),
+                    prefix_kv=request.voice.get("prefix_kv"),
+                ))
+            except Exception as e:
+                request._fail(e)
+        return sequences
+
+    def _run(self):
+        tts = self.tts
+        while True:
+            with self.condition:
+                while self.running and len(self.pending) == 0 and len(self.decoder) == 0:
+                    self.condition.wait()
+                if not self.running and len(self.pending) == 0 and len(self.decoder) == 0:
+                    break
+            new_sequences = []
+            try:
+                with torch.no_grad():
+                    with torch.amp.autocast(torch.device(tts.device).type, enabled=tts.dtype is not None, dtype=tts.dtype):
+                        new_sequences = self._admit()
+                        start_time = time.perf_counter()
+                        finished = self.decoder.add(new_sequences)
+                        batch_size = len(self.decoder)
+                        if batch_size > 0:
+                            finished += self.decoder.step()
+                        self.decode_time += time.perf_counter() - start_time
+                self.num_steps += 1
+                self.num_tokens += batch_size + len(new_sequences)
+                for seq in new_sequences:
+                    request = seq.tag[0]
+                    if request.first_token_time is None:
+                        request.first_token_time = time.perf_counter()
+            except Exception as e:
+                # fail every sentence in flight and start over with an empty batch
+                for seq in self.decoder.sequences + new_sequences:
+                    seq.tag[0]._fail(e)
+                self.decoder = BatchDecoder(tts.gpt)
+                continue
+            for seq in finished:
+                self.vocoder_stage.submit(seq)
+            if self.verbose and self.num_steps % 100 == 0:
+                print(f">> [scheduler] {self.stats()}")
+
+    def _vocode_sentence(self, seq: DecodeSequence):
+        request, idx, sent = seq.tag
+        if request.done():
+            return
+        try:
+            voice = request.voice
+            codes = seq.get_codes()
+            if codes[0, -1] != self.tts.stop_mel_token:
+                print(f">> [scheduler] WARN: generation stopped due to exceeding `max_mel_tokens` ({seq.max_new_tokens})")
+            self.tts._log_mel_lengths([sent], codes, request.generation_kwargs.get("max_mel_tokens", 600))
+            latent = self.tts._sentence_latent(voice["cond_mel"], voice["conds_latent"], seq.text_tokens, codes,
+                                               seq.get_latents())
+            request._add_wav(idx, self.tts._vocode(latent, voice["speaker_conds"]))
+        except Exception as e:
+            request._fail(e)
@@ -0,0 +1,51 @@
+import torch
+from transformers import LogitsProcessor
+
+from indextts.utils.mel_length import ForcedStopLogitsProcessor
+
+
+class DegenerateOutputLogitsProcessor(LogitsProcessor):
+    """
+    Detects degenerate codes while decoding, per row, instead of trimming them after the generation:
+        - a run of ``max_silent_run`` silent tokens is capped, the silent token is masked until the run breaks
+          (`IndexTTS.remove_long_silence()` keeps at most 10 tokens of such runs anyway)
+        - codes repeating a cycle of at most ``max_cycle_len`` tokens over the last ``cycle_tokens`` steps
+          get ``stop_token`` forced, as the loop would run until ``max_mel_tokens``
+
+    Only the last tokens are compared at every step, no state is kept, so it works with the beam reordering of
+    `GenerationMixin.generate()` and `DecodeEngine`.
+    """
+
+    def __init__(self, prompt_len: int, stop_token: int, silent_token=52, max_silent_run=30, max_cycle_len=8,
+                 cycle_tokens=24):
+        """
+        Args:
+            prompt_len (int): length of the input ids before the first generated token
+            stop_token (int): token forced on the looping rows
+            silent_token (int): token of silence
+            max_silent_run (int): max consecutive silent tokens, ``0`` to disable
+            max_cycle_len (int): max length of a detected cycle, ``0`` to disable
+            cycle_tokens (int): number of last tokens that must repeat the cycle, ~1 second with 24
+        """
+        self.prompt_len = prompt_len
+        self.stop_token = stop_token
+        self.silent_token = silent_token
+        self.max_silent_run = max_silent_run
+        self.max_cycle_len = max_cycle_len
+        self.cycle_tokens = cycle_tokens
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        codes = input_ids[:, self.prompt_len:]
+        num_generated = codes.shape[1]
+        if 0 < self.max_silent_run <= num_generated:
+            silent_run = (codes[:, -self.max_silent_run:] == self.silent_token).all(dim=-1)
+            scores[:, self.silent_token] = scores[:, self.silent_token].masked_fill(silent_run, -float("inf"))
+        if self.max_cycle_len > 0 and num_generated >= self.cycle_tokens:
+            window = codes[:, -self.cycle_tokens:]
+            looping = torch.zeros(codes.shape[0], dtype=torch.bool, device=codes.device)
+            for cycle_len in range(1, min(self.max_cycle_len, self.cycle_tokens - 1) + 1):
+                looping |= (window[:, cycle_len:] == window[:, :-cycle_len]).all(dim=-1)
+            # silence is capped above
+            looping &= ~(window == self.silent_token).all(dim=-1)
+            scores = ForcedStopLogitsProcessor.force_stop(scores, looping, self.stop_token)
+        return scores
@@ -0,0 +1,159 @@
+import json
+import os
+import re
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import torch
+from transformers import LogitsProcessor
+
+CJK_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+
+
+class MelLengthEstimator:
+    """
+    Linear estimate of the number of mel codes generated for a sentence, from its text tokens by language:
+    ``mel_tokens = zh * (CJK tokens) + other * (other tokens) + bias``.
+
+    Fitted on logged runs (see the ``mel_length_log`` of `IndexTTS`) and stored as ``mel_length_estimator.json``
+    in the checkpoint dir:
+    ```
+    python -m indextts.utils.mel_length mel_lengths.jsonl checkpoints
+    ```
+    ``max_ratio`` bounds the generation of a sentence to that multiple of its estimate, so a row that never emits
+    ``stop_mel_token`` stops early instead of running to ``max_mel_tokens`` (``None`` to disable). Only a fitted
+    estimator caps the generation: without ``mel_length_estimator.json`` the defaults only order the sentences.
+    """
+
+    filename = "mel_length_estimator.json"
+
+    def __init__(self, zh=6.0, other=6.0, bias=1.0, max_ratio: Optional[float] = 3.0, num_samples=0):
+        """
+        Args:
+            zh (float): mel codes per CJK text token
+            other (float): mel codes per other text token
+            bias (float): mel codes per sentence
+            max_ratio (None | float): max generated codes of a sentence, as a multiple of its estimate
+            num_samples (int): number of logged sentences of the fit, 0 for the defaults
+        """
+        self.zh = zh
+        self.other = other
+        self.bias = bias
+        self.max_ratio = max_ratio
+        self.num_samples = num_samples
+
+    @staticmethod
+    def features(tokens: List[str]) -> Dict[str, int]:
+        """
+        Number of CJK and other tokens of a tokenized sentence
+        """
+        zh = sum(1 for token in tokens if CJK_PATTERN.search(token))
+        return {"zh": zh, "other": len(tokens) - zh}
+
+    def estimate(self, tokens: List[str]) -> float:
+        features = self.features(tokens)
+        return self.zh * features["zh"] + self.other * features["other"] + self.bias
+
+    def max_tokens(self, tokens: List[str], max_mel_tokens: int) -> int:
+        """
+        Max number of codes generated before ``stop_mel_token`` is forced, at most ``max_mel_tokens``
+        """
+        if self.max_ratio is None:
+            return max_mel_tokens
+        return min(max_mel_tokens, int(self.max_ratio * self.estimate(tokens)) + 1)
+
+    @classmethod
+    def fit(cls, records: Iterable[Dict[str, int]], max_ratio: Optional[float] = 3.0, prior_weight=1.0):
+        """
+        Least squares fit on records of ``{"zh": ..., "other": ..., "mel_tokens": ...}``, regularized towards the
+        defaults with ``prior_weight``, so a language missing from the records keeps its default rate.
+        """
+        records = list(records)
+        x = np.array([[r["zh"], r["other"], 1.0] for r in records], dtype=np.float64).reshape(-1, 3)
+        y = np.array([r["mel_tokens"] for r in records], dtype=np.float64)
+        default = cls()
+        prior = np.array([default.zh, default.other, default.bias])
+        a = x.T @ x + prior_weight * np.eye(3)
+        w = np.linalg.solve(a, x.T @ y + prior_weight * prior)
+        return cls(zh=float(max(w[0], 0.0)), other=float(max(w[1], 0.0)), bias=float(w[2]), max_ratio=max_ratio,
+                   num_samples=len(records))
+
+    @classmethod
+    def load(cls, model_dir: str) -> "MelLengthEstimator":
+        """
+        The estimator saved in ``model_dir``, or the defaults without ``max_ratio`` if there is none: the default
+        rates are not fitted to the model, they are only used for bucketing, not to stop the generation
+        """
+        path = os.path.join(model_dir, cls.filename)
+        if not os.path.isfile(path):
+            return cls(max_ratio=None)
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(**json.load(f))
+
+    def save(self, model_dir: str) -> str:
+        path = os.path.join(model_dir, self.filename)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"zh": self.zh, "other": self.other, "bias": self.bias, "max_ratio": self.max_ratio,
+                       "num_samples": self.num_samples}, f, indent=2)
+        return path
+
+    @classmethod
+    def log(cls, path: str, tokens: List[str], mel_tokens: int):
+        """
+        Append a generated sentence to the jsonl log used by `fit()`
+        """
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({**cls.features(tokens), "mel_tokens": mel_tokens}) + "\n")
+
+
+class ForcedStopLogitsProcessor(LogitsProcessor):
+    """
+    Forces ``stop_token`` on the rows that generated their max number of tokens.
+
+    The other tokens keep a negligible probability (``exp(-penalty)``) rather than zero, as beam sampling draws
+    ``2 * num_beams`` distinct candidates per batch item.
+    """
+
+    penalty = 50.0
+
+    def __init__(self, max_lengths: torch.Tensor, prompt_len: int, stop_token: int):
+        """
+        Args:
+            max_lengths: (b,) max generated tokens of each batch item before ``stop_token``, the rows of the
+                generation are the batch items repeated (interleaved) for the beams / return sequences
+            prompt_len (int): length of the input ids before the first generated token
+        """
+        self.max_lengths = max_lengths
+        self.prompt_len = prompt_len
+        self.stop_token = stop_token
+
+    @staticmethod
+    def force_stop(scores: torch.FloatTensor, stop: torch.BoolTensor, stop_token: int) -> torch.FloatTensor:
+        forced = torch.full_like(scores, -ForcedStopLogitsProcessor.penalty)
+        forced[:, stop_token] = 0
+        return torch.where(stop.unsqueeze(1), forced, scores)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        max_lengths = self.max_lengths.repeat_interleave(input_ids.shape[0] // self.max_lengths.shape[0])
+        return self.force_stop(scores, max_lengths <= input_ids.shape[1] - self.prompt_len, self.stop_token)
+
+
+if __name__ == "__main__":
+    """
+    Fit the mel-length estimator on a log of `IndexTTS(mel_length_log=...)` and save it in the checkpoint dir.
+    ```
+    python -m indextts.utils.mel_length mel_lengths.jsonl checkpoints [max_ratio]
+    ```
+    """
+    import sys
+
+    if len(sys.argv) < 3:
+        print("Usage: python -m indextts.utils.mel_length <log.jsonl> <model_dir> [max_ratio]")
+        sys.exit(1)
+    with open(sys.argv[1], "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    estimator = MelLengthEstimator.fit(records, max_ratio=float(sys.argv[3]) if len(sys.argv) > 3 else 3.0)
+    errors = [abs(r["mel_tokens"] - estimator.zh * r["zh"] - estimator.other * r["other"] - estimator.bias) for r in records]
+    print(f">> fitted on {len(records)} sentences: zh={estimator.zh:.3f} other={estimator.other:.3f} "
+          f"bias={estimator.bias:.3f}, mean abs error: {np.mean(errors):.1f} codes")
+    print(">> saved to:", estimator.save(sys.argv[2]))
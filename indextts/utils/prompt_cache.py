@@ -0,0 +1,129 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import torch
+
+
+def tensor_nbytes(value) -> int:
+    """
+    Total number of bytes held by the tensors in ``value`` (tensors, dicts, lists and tuples are walked).
+    """
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(tensor_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_nbytes(v) for v in value)
+    return 0
+
+
+class PromptCache:
+    """
+    LRU cache of reference prompt features, keyed by a hash of the decoded PCM rather than the file path,
+    so the same voice uploaded under different (temporary) file names is only processed once.
+
+    Each entry is a dict of tensors (e.g. ``{"cond_mel": ...}``); the total size of all entries is kept
+    under ``max_bytes`` by evicting the least recently used voices.
+    Thread-safe: the webui and `ContinuousBatchScheduler` look up voices from different threads.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, max_entries: Optional[int] = None):
+        """
+        Args:
+            max_bytes (int): memory budget of all cached tensors, in bytes.
+            max_entries (None | int): optional limit on the number of cached voices.
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, torch.Tensor]]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def hash_audio(audio: torch.Tensor, sample_rate: int) -> str:
+        """
+        Content hash of a decoded waveform ``audio`` (channels, samples) at ``sample_rate``.
+        """
+        h = hashlib.sha1()
+        h.update(f"{sample_rate}:{tuple(audio.shape)}:{audio.dtype}".encode())
+        h.update(audio.detach().cpu().contiguous().numpy().tobytes())
+        return h.hexdigest()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key: str):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key: str) -> Optional[Dict[str, torch.Tensor]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: Dict[str, torch.Tensor]):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._sizes.pop(key)
+                del self._entries[key]
+            self._entries[key] = entry
+            self._sizes[key] = tensor_nbytes(entry)
+            self.nbytes += self._sizes[key]
+            self._evict()
+
+    def update(self, key: str, **tensors):
+        """
+        Add derived tensors (e.g. conditioning latents) to an existing entry and re-account its size.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.update(tensors)
+            self.nbytes -= self._sizes[key]
+            self._sizes[key] = tensor_nbytes(entry)
+            self.nbytes += self._sizes[key]
+            self._evict()
+
+    def _evict(self):
+        # called with the lock held
+        # always keep the most recently used entry, even if it alone exceeds the budget
+        while len(self._entries) > 1 and (
+            self.nbytes > self.max_bytes or (self.max_entries is not None and len(self._entries) > self.max_entries)
+        ):
+            key, _ = self._entries.popitem(last=False)
+            self.nbytes -= self._sizes.pop(key)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __repr__(self):
+        with self._lock:
+            return (f"PromptCache(entries={len(self._entries)}, size={self.nbytes / 1024 / 1024:.2f}MB/"
+                    f"{self.max_bytes / 1024 / 1024:.0f}MB, hits={self.hits}, misses={self.misses}, evictions={self.evictions})")
@@ -0,0 +1,96 @@
+import os
+import re
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+try:
+    from safetensors.torch import load_file as safetensors_load_file
+    from safetensors.torch import save_file as safetensors_save_file
+
+    HAS_SAFETENSORS = True
+except ImportError:
+    HAS_SAFETENSORS = False
+
+VOICE_ID_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.\-]{0,127}$")
+
+
+class SpeakerProfileStore:
+    """
+    On-disk store of enrolled voices. A profile holds everything the inference needs from the reference audio:
+        - ``cond_mel``: (1, n_mels, frames) reference mel spectrogram
+        - ``conds_latent``: (1, 32, model_dim) perceiver latents from `UnifiedVoice.get_conditioning()`
+        - ``speaker_embedding``: (1, 1, speaker_embedding_dim) ECAPA embedding from `BigVGAN.get_speaker_embedding()`
+
+    Profiles are saved as ``<voice_id>.safetensors`` (or ``<voice_id>.npz`` if safetensors is not installed).
+    """
+
+    def __init__(self, root_dir: str, fp16: bool = False):
+        """
+        Args:
+            root_dir (str): directory of the profile files, created on first save.
+            fp16 (bool): store the tensors in float16 to halve the disk size.
+        """
+        self.root_dir = root_dir
+        self.fp16 = fp16
+        self.ext = ".safetensors" if HAS_SAFETENSORS else ".npz"
+
+    @staticmethod
+    def check_voice_id(voice_id: str):
+        if not isinstance(voice_id, str) or not VOICE_ID_PATTERN.match(voice_id):
+            raise ValueError(f"Invalid voice_id: {voice_id!r}, expected [A-Za-z0-9_.-] with at most 128 characters")
+
+    def path(self, voice_id: str) -> str:
+        self.check_voice_id(voice_id)
+        return os.path.join(self.root_dir, voice_id + self.ext)
+
+    def exists(self, voice_id: str) -> bool:
+        return os.path.isfile(self.path(voice_id))
+
+    def list_voices(self) -> List[str]:
+        if not os.path.isdir(self.root_dir):
+            return []
+        return sorted(f[: -len(self.ext)] for f in os.listdir(self.root_dir) if f.endswith(self.ext))
+
+    def save(self, voice_id: str, profile: Dict[str, torch.Tensor]) -> str:
+        path = self.path(voice_id)
+        os.makedirs(self.root_dir, exist_ok=True)
+        tensors = {}
+        for k, v in profile.items():
+            v = v.detach().cpu()
+            if v.is_floating_point():
+                v = v.half() if self.fp16 else v.float()
+            tensors[k] = v.contiguous()
+        # write to a temporary file first, so concurrent readers never see a partial profile
+        tmp_path = path + ".tmp"
+        if HAS_SAFETENSORS:
+            safetensors_save_file(tensors, tmp_path, metadata={"format": "pt"})
+        else:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **{k: v.numpy() for k, v in tensors.items()})
+        os.replace(tmp_path, path)
+        return path
+
+    def load(self, voice_id: str, device=None) -> Dict[str, torch.Tensor]:
+        path = self.path(voice_id)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Speaker profile of voice_id {voice_id!r} not found: {path}")
+        if HAS_SAFETENSORS:
+            tensors = safetensors_load_file(path, device="cpu")
+        else:
+            with np.load(path) as data:
+                tensors = {k: torch.from_numpy(data[k]) for k in data.files}
+        profile = {}
+        for k, v in tensors.items():
+            if v.is_floating_point():
+                v = v.float()
+            profile[k] = v.to(device) if device is not None else v
+        return profile
+
+    def delete(self, voice_id: str) -> bool:
+        path = self.path(voice_id)
+        if os.path.isfile(path):
+            os.remove(path)
+            return True
+        return False
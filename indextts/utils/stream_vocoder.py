@@ -0,0 +1,169 @@
+import queue
+from typing import Callable, List, Optional
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+
+class StreamingVocoder:
+    """
+    Incremental vocoding of GPT latents, frame by frame as they are decoded.
+
+    Every window vocodes ``chunk_size`` new frames after ``lookback`` frames of left context (already emitted,
+    only used to warm up the convolutions). The last ``crossfade`` frames of a window have no right context,
+    they are held back and overlap-added with the start of the next window, so chunk boundaries are smooth.
+    Concatenating all chunks gives ``frames * hop_length`` samples, the same length as vocoding all latents at once.
+    """
+
+    def __init__(self, vocode: Callable[[torch.Tensor], torch.Tensor], hop_length: int, chunk_size=24, lookback=16, crossfade=4):
+        """
+        Args:
+            vocode: maps latents (1, frames, dim) to a wav (1, frames * hop_length)
+            hop_length (int): number of samples per latent frame
+            chunk_size (int): number of new latent frames per chunk
+            lookback (int): number of previous frames fed as left context
+            crossfade (int): number of frames overlap-added between consecutive chunks
+        """
+        if chunk_size <= 0 or lookback < 0 or crossfade < 0:
+            raise ValueError(f"Invalid streaming window: chunk_size={chunk_size}, lookback={lookback}, crossfade={crossfade}")
+        self.vocode = vocode
+        self.hop_length = hop_length
+        self.chunk_size = chunk_size
+        self.lookback = lookback
+        self.crossfade = crossfade
+        self.fade_in = (torch.arange(crossfade * hop_length, dtype=torch.float32) + 0.5) / max(crossfade * hop_length, 1)
+        self.reset()
+
+    def reset(self):
+        self.latents: List[torch.Tensor] = []
+        self.num_frames = 0
+        # frames [0, emitted) are emitted, the wav of the next ``crossfade`` frames is held in ``tail``
+        self.emitted = 0
+        self.tail: Optional[torch.Tensor] = None
+
+    def push(self, latent: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Add latents (1, n, dim), returns the wav chunks (1, samples) that became ready.
+        """
+        self.latents.append(latent)
+        self.num_frames += latent.shape[1]
+        chunks = []
+        while self.num_frames - self.emitted >= self.chunk_size + self.crossfade:
+            chunks.append(self._vocode_window(self.emitted + self.chunk_size + self.crossfade, final=False))
+        return chunks
+
+    def flush(self) -> Optional[torch.Tensor]:
+        """
+        Vocode the remaining frames, returns the last wav chunk or None.
+        """
+        if self.num_frames <= self.emitted:
+            return None
+        chunk = self._vocode_window(self.num_frames, final=True)
+        self.reset()
+        return chunk
+
+    def _vocode_window(self, end: int, final: bool) -> torch.Tensor:
+        if len(self.latents) > 1:
+            self.latents = [torch.cat(self.latents, dim=1)]
+        start = max(0, self.emitted - self.lookback)
+        wav = self.vocode(self.latents[0][:, start:end])
+        wav = wav[:, (self.emitted - start) * self.hop_length:]
+        if self.tail is not None:
+            n = self.tail.shape[-1]
+            fade_in = self.fade_in.to(wav.device, wav.dtype)
+            wav = torch.cat([self.tail * (1 - fade_in) + wav[:, :n] * fade_in, wav[:, n:]], dim=-1)
+            self.tail = None
+        if final:
+            self.emitted = end
+            return wav
+        emitted = end - self.crossfade
+        split = (emitted - self.emitted) * self.hop_length
+        if self.crossfade > 0:
+            self.tail = wav[:, split:]
+        self.emitted = emitted
+        return wav[:, :split]
+
+
+class LatentStreamer(BaseStreamer):
+    """
+    `generate(streamer=...)` hook that feeds the latent of every decoded mel code to a `StreamingVocoder`.
+    Requires batch size 1, ``num_beams=1`` and `GPT2InferenceModel.start_latent_capture()`.
+
+    Iterate over the streamer (e.g. while `generate()` runs in another thread) to receive the wav chunks.
+    Pass `stopping_criteria()` to `generate()` so that `cancel()` stops the decoding.
+    """
+
+    def __init__(self, inference_model, vocoder: StreamingVocoder, stop_token: int, timeout: Optional[float] = None):
+        self.inference_model = inference_model
+        self.vocoder = vocoder
+        self.stop_token = stop_token
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.stop_signal = None
+        self.next_tokens_are_prompt = True
+        self.finished = False
+        self.cancelled = False
+        self.num_tokens = 0
+
+    def put(self, value):
+        if self.next_tokens_are_prompt:
+            # the prompt is pushed first
+            self.next_tokens_are_prompt = False
+            return
+        if self.finished or self.cancelled:
+            return
+        if value.numel() != 1:
+            raise ValueError("LatentStreamer only supports batch size 1 and num_beams=1")
+        if value.item() == self.stop_token:
+            self.finished = True
+            return
+        self.num_tokens += 1
+        # the hidden state that predicted this code
+        latent = self.inference_model.captured_latents[-1]
+        for chunk in self.vocoder.push(latent.unsqueeze(1)):
+            self.queue.put(chunk)
+
+    def end(self):
+        if not self.cancelled:
+            chunk = self.vocoder.flush()
+            if chunk is not None:
+                self.queue.put(chunk)
+        self.queue.put(self.stop_signal)
+
+    def abort(self):
+        """
+        Unblock the consumer when generation failed.
+        """
+        self.queue.put(self.stop_signal)
+
+    def cancel(self):
+        """
+        The consumer quits: no more latents are vocoded and `generate()` stops at its next step.
+        """
+        self.cancelled = True
+        self.abort()
+
+    def stopping_criteria(self) -> StoppingCriteriaList:
+        return StoppingCriteriaList([CancelledCriteria(self)])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> torch.Tensor:
+        value = self.queue.get(timeout=self.timeout)
+        if value is self.stop_signal:
+            raise StopIteration()
+        return value
+
+
+class CancelledCriteria(StoppingCriteria):
+    """
+    Stops `generate()` once `LatentStreamer.cancel()` is called.
+    """
+
+    def __init__(self, streamer: LatentStreamer):
+        self.streamer = streamer
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.streamer.cancelled
@@ -0,0 +1,112 @@
+import os
+
+import torch
+import transformers
+from omegaconf import OmegaConf
+
+from indextts.gpt.batch_decoder import BatchDecoder, DecodeSequence
+from indextts.gpt.model import UnifiedVoice
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "checkpoints", "config.yaml")
+
+
+def build_tiny_gpt(seed=0):
+    """
+    UnifiedVoice with the release token layout, but a tiny transformer and random weights.
+    """
+    cfg = OmegaConf.load(CONFIG_PATH).gpt
+    cfg.model_dim = 64
+    cfg.heads = 4
+    cfg.layers = 2
+    cfg.number_text_tokens = 60
+    cfg.condition_module.output_size = 32
+    cfg.condition_module.linear_units = 64
+    cfg.condition_module.attention_heads = 4
+    cfg.condition_module.num_blocks = 1
+    torch.manual_seed(seed)
+    gpt = UnifiedVoice(**cfg).eval()
+    gpt.post_init_gpt2_config(use_deepspeed=False, kv_cache=True, half=False)
+    return gpt
+
+
+def generate_hf(gpt, conds_latent, text_tokens, max_new_tokens, seed, **kwargs):
+    transformers.set_seed(seed)
+    return gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, num_beams=1,
+                                max_generate_length=max_new_tokens, **kwargs)
+
+
+@torch.no_grad()
+def test_single_sequence_matches_hf():
+    gpt = build_tiny_gpt()
+    conds_latent = torch.randn(1, 32, gpt.model_dim)
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (1, 9))
+    for kwargs in (
+        dict(do_sample=False, repetition_penalty=10.0),
+        dict(do_sample=True, top_k=30, top_p=0.8, temperature=1.0, repetition_penalty=10.0),
+        dict(do_sample=True, top_k=5, top_p=0.95, temperature=0.7, repetition_penalty=2.0),
+    ):
+        expected = generate_hf(gpt, conds_latent, text_tokens, 30, seed=7, **kwargs)
+        transformers.set_seed(7)
+        decoder = BatchDecoder(gpt)
+        seq = DecodeSequence(conds_latent, text_tokens, max_new_tokens=30, **kwargs)
+        decoder.add([seq])
+        while len(decoder) > 0:
+            decoder.step()
+        assert torch.equal(seq.get_codes(), expected), kwargs
+
+
+@torch.no_grad()
+def test_sequences_join_and_leave():
+    gpt = build_tiny_gpt()
+    voices = [torch.randn(1, 32, gpt.model_dim) for _ in range(2)]
+    texts = [torch.randint(2, gpt.number_text_tokens, (1, n)) for n in (5, 11, 3, 8)]
+    lengths = [30, 12, 20, 16]
+    seqs = [DecodeSequence(voices[i % 2], texts[i], do_sample=False, max_new_tokens=lengths[i]) for i in range(4)]
+    decoder = BatchDecoder(gpt)
+    decoder.add(seqs[:2])
+    for _ in range(4):
+        decoder.step()
+    decoder.add(seqs[2:3])
+    for _ in range(10):
+        decoder.step()
+    # seqs[1] left the batch, seqs[3] joins
+    assert seqs[1].finished and len(decoder) == 2
+    decoder.add(seqs[3:])
+    while len(decoder) > 0:
+        decoder.step()
+    for i, seq in enumerate(seqs):
+        expected = generate_hf(gpt, voices[i % 2], texts[i], lengths[i], seed=0, do_sample=False, repetition_penalty=10.0)
+        assert torch.equal(seq.get_codes(), expected), i
+
+
+@torch.no_grad()
+def test_forced_stop():
+    gpt = build_tiny_gpt()
+    conds_latent = torch.randn(1, 32, gpt.model_dim)
+    texts = [torch.randint(2, gpt.number_text_tokens, (1, n)) for n in (9, 6)]
+    seqs = [DecodeSequence(conds_latent, texts[0], do_sample=False, max_new_tokens=30, max_length=7),
+            DecodeSequence(conds_latent, texts[1], do_sample=False, max_new_tokens=30)]
+    decoder = BatchDecoder(gpt)
+    decoder.add(seqs)
+    while len(decoder) > 0:
+        decoder.step()
+    # the ``max_lengths`` of `IndexTTS.mel_length_kwargs()`
+    expected = generate_hf(gpt, conds_latent, texts[0], 8, seed=0, do_sample=False, repetition_penalty=10.0,
+                           max_lengths=torch.tensor([7]))
+    assert expected[0, -1] == gpt.stop_mel_token and expected.shape[-1] == 8
+    assert torch.equal(seqs[0].get_codes(), expected)
+    expected = generate_hf(gpt, conds_latent, texts[1], 30, seed=0, do_sample=False, repetition_penalty=10.0)
+    assert torch.equal(seqs[1].get_codes(), expected)
+
+
+if __name__ == "__main__":
+    """
+    Compare the continuous batching decoder with `UnifiedVoice.inference_speech()`.
+    ```
+    python tests/batch_decoder_test.py
+    ```
+    """
+    test_single_sequence_matches_hf()
+    test_sequences_join_and_leave()
+    test_forced_stop()
+    print("ok")
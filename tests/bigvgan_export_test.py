@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+import pytest
+import torch
+
+from indextts.BigVGAN.alias_free_activation.cpu.activation1d import FrozenActivation1d
+from indextts.BigVGAN.models import BigVGAN
+from stream_vocoder_test import build_tiny_bigvgan
+
+
+@torch.no_grad()
+def test_export_roundtrip():
+    model, speaker_conds, _, dim = build_tiny_bigvgan()
+    latents = torch.randn(2, 30, dim)
+    mel_ref = torch.randn(1, 50, model.h.num_mels)
+    expected = model(latents, speaker_conds=speaker_conds)[0]
+    expected_embedding = model.get_speaker_embedding(mel_ref)
+    receptive_field = model.receptive_field()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = model.freeze().export_inference(os.path.join(tmp_dir, BigVGAN.inference_filename))
+        loaded = BigVGAN.load_inference(path)
+    assert loaded.frozen and isinstance(loaded.activation_post, FrozenActivation1d)
+    # weight norm folded, the Snake parameters replaced by the constants
+    keys = loaded.state_dict().keys()
+    assert not any(k.endswith(("weight_g", "weight_v", "act.alpha", "act.beta")) for k in keys)
+    torch.testing.assert_close(loaded(latents, speaker_conds=speaker_conds)[0], expected, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(loaded.get_speaker_embedding(mel_ref), expected_embedding)
+    assert loaded.receptive_field() == receptive_field
+
+
+@torch.no_grad()
+def test_stale_export():
+    model, _, _, _ = build_tiny_bigvgan()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = os.path.join(tmp_dir, "bigvgan_generator.pth")
+        torch.save({"generator": model.state_dict()}, source)
+        path = model.freeze().export_inference(os.path.join(tmp_dir, BigVGAN.inference_filename), source=source)
+        assert BigVGAN.load_inference(path, source=source).frozen
+        # the generator checkpoint updated after the export
+        torch.save({"generator": model.state_dict(), "step": 1}, source)
+        with pytest.raises(ValueError):
+            BigVGAN.load_inference(path, source=source)
+
+
+if __name__ == "__main__":
+    """
+    Export a BigVGAN as a frozen inference module (`BigVGAN.freeze()`) and load it back.
+    ```
+    python tests/bigvgan_export_test.py
+    ```
+    """
+    test_export_roundtrip()
+    test_stale_export()
+    print("ok")
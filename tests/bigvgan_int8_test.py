@@ -0,0 +1,88 @@
+import copy
+import os
+import sys
+import tempfile
+import time
+
+import torch
+from omegaconf import OmegaConf
+from torch.ao.quantization import QuantWrapper
+
+from indextts.BigVGAN.models import BigVGAN
+from indextts.BigVGAN.quantization import (CalibrationRecorder, multi_resolution_stft_distance,
+                                           quantize_static_int8, stft_distance)
+from stream_vocoder_test import CONFIG_PATH, build_tiny_bigvgan
+
+
+@torch.no_grad()
+def test_quantize():
+    model, speaker_conds, hop_length, dim = build_tiny_bigvgan()
+    receptive_field = model.receptive_field()
+    # calibration inputs recorded while decoding
+    with CalibrationRecorder(model) as recorder:
+        for _ in range(3):
+            model.inference_tiled(torch.randn(1, 80, dim), speaker_conds, tile_size=40)
+    assert len(recorder.inputs) == 6
+    int8_model = quantize_static_int8(copy.deepcopy(model), recorder.inputs, min_channels=0)
+    wrappers = [m for m in int8_model.modules() if isinstance(m, QuantWrapper)]
+    # conv_pre, the upsamplers and 6 convs of each of the 3 AMP blocks per upsampler
+    assert len(wrappers) == 1 + 6 * (1 + 3 * 6)
+    assert not isinstance(int8_model.conv_post, QuantWrapper)
+    assert int8_model.receptive_field() == receptive_field
+    latents = torch.randn(2, 50, dim)
+    speaker_conds = [c.expand(2, -1, -1) for c in speaker_conds]
+    lengths = torch.tensor([50, 30])
+    wav = model(latents, speaker_conds=speaker_conds, lengths=lengths)[0]
+    int8_wav = int8_model(latents, speaker_conds=speaker_conds, lengths=lengths)[0]
+    assert (int8_wav[1, :, 30 * hop_length:] == 0).all()
+    snr = 10 * torch.log10(wav.pow(2).sum() / (int8_wav - wav).pow(2).sum())
+    assert snr > 40, snr
+    assert multi_resolution_stft_distance(wav, wav) == 0
+    assert stft_distance(model, int8_model, [(latents, speaker_conds, lengths)]) < 0.5
+    # exported with the frozen module layout
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = int8_model.export_inference(os.path.join(tmp_dir, BigVGAN.int8_inference_filename))
+        loaded = BigVGAN.load_inference(path)
+    assert loaded.quantization == int8_model.quantization
+    torch.testing.assert_close(loaded(latents, speaker_conds=speaker_conds, lengths=lengths)[0], int8_wav)
+
+
+def benchmark(frames=200, repeats=3):
+    """
+    RTF of the release BigVGAN (random weights) on CPU, frozen float32 against static int8, for ``frames``
+    latent frames (~8.5 s). Calibrated on random latents, only the timings are meaningful: export the int8 module
+    of a checkpoint dir with ``python -m indextts.BigVGAN.quantization`` for the quality check on real latents.
+    """
+    cfg = OmegaConf.load(CONFIG_PATH).bigvgan
+    torch.manual_seed(0)
+    model = BigVGAN(cfg).eval().freeze()
+    speaker_conds = model.get_speaker_conds(torch.randn(1, 1, cfg.speaker_embedding_dim))
+    calibration = [(torch.randn(1, frames // 4, cfg.gpt_dim), speaker_conds, None) for _ in range(2)]
+    int8_model = quantize_static_int8(copy.deepcopy(model), calibration)
+    latents = torch.randn(1, frames, cfg.gpt_dim)
+    seconds = frames * model.hop_length / cfg.sampling_rate
+    with torch.no_grad():
+        for name, m in (("fp32", model), ("int8", int8_model)):
+            m(latents, speaker_conds=speaker_conds)  # warmup
+            start = time.perf_counter()
+            for _ in range(repeats):
+                m(latents, speaker_conds=speaker_conds)
+            elapsed = (time.perf_counter() - start) / repeats
+            print(f">> {name}: {elapsed:.2f} s for {seconds:.1f} s of audio, RTF: {elapsed / seconds:.3f}")
+    print(f">> multi-resolution STFT distance: {stft_distance(model, int8_model, [(latents, speaker_conds, None)]):.4f}, "
+          f"threads: {torch.get_num_threads()}")
+
+
+if __name__ == "__main__":
+    """
+    Test the static int8 quantization of BigVGAN, and benchmark the RTF against float32 on CPU.
+    ```
+    python tests/bigvgan_int8_test.py
+    python tests/bigvgan_int8_test.py bench [frames]
+    ```
+    """
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 200)
+    else:
+        test_quantize()
+        print("ok")
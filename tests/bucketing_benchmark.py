@@ -0,0 +1,119 @@
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+import torch
+
+from indextts.infer import IndexTTS
+
+CASES_PATH = os.path.join(os.path.dirname(__file__), "cases.jsonl")
+
+
+def length_bucket_sentences(sentences, bucket_max_size=4) -> List[List[Dict]]:
+    """
+    The previous `IndexTTS.bucket_sentences()`: buckets by sentence length within 1.5x of the bucket median,
+    at most ``bucket_max_size`` sentences, the single sentences merged into other buckets.
+    """
+    outputs = [{"idx": idx, "sent": sent, "len": len(sent)} for idx, sent in enumerate(sentences)]
+    if len(outputs) <= bucket_max_size:
+        return [outputs]
+    buckets: List[List[Dict]] = []
+    last_bucket = None
+    last_bucket_sent_len_median = 0
+    for sent in sorted(outputs, key=lambda x: x["len"]):
+        if last_bucket is None \
+                or sent["len"] >= int(last_bucket_sent_len_median * 1.5) \
+                or len(last_bucket) >= bucket_max_size:
+            buckets.append([sent])
+            last_bucket = buckets[-1]
+            last_bucket_sent_len_median = sent["len"]
+        else:
+            last_bucket.append(sent)
+            last_bucket_sent_len_median = last_bucket[len(last_bucket) // 2]["len"]
+    out_buckets = [b for b in buckets if len(b) > 1]
+    only_ones = [b[0] for b in buckets if len(b) == 1]
+    for b in out_buckets:
+        if len(only_ones) == 0:
+            break
+        if len(b) < bucket_max_size:
+            b.append(only_ones.pop(0))
+    out_buckets.extend([only_ones[i:i + bucket_max_size] for i in range(0, len(only_ones), bucket_max_size)])
+    return out_buckets
+
+
+def plan_stats(tts, buckets, num_beams, max_mel_tokens):
+    """
+    Padding waste of the text tokens and of ``rows * text tokens * predicted mel tokens * num_beams``,
+    and the predicted sequential decoding steps (the longest sentence of each bucket).
+    """
+    text_tokens = padded_text_tokens = cost = padded_cost = max_cost = decode_steps = 0
+    for bucket in buckets:
+        lens = [len(item["sent"]) + 2 for item in bucket]
+        mel_lens = [tts.estimate_mel_tokens(item["sent"], max_mel_tokens) for item in bucket]
+        text_tokens += sum(lens)
+        padded_text_tokens += len(bucket) * max(lens)
+        cost += sum(n * m for n, m in zip(lens, mel_lens)) * num_beams
+        bucket_cost = len(bucket) * max(lens) * max(mel_lens) * num_beams
+        padded_cost += bucket_cost
+        max_cost = max(max_cost, bucket_cost)
+        decode_steps += max(mel_lens)
+    return {
+        "buckets": len(buckets),
+        "text_padding": 1 - text_tokens / padded_text_tokens,
+        "cost_padding": 1 - cost / padded_cost,
+        "max_bucket_cost": max_cost,
+        "decode_steps": decode_steps,
+    }
+
+
+def bench_bucketing(tts, texts, bucket_max_size=4, num_beams=3, max_mel_tokens=600, max_text_tokens_per_sentence=100):
+    planners = {
+        "length": lambda sentences, **kwargs: length_bucket_sentences(sentences, kwargs["bucket_max_size"]),
+        "token budget": tts.bucket_sentences,
+    }
+    for name, text in texts.items():
+        sentences = tts.tokenizer.split_sentences(tts.tokenizer.tokenize(text), max_text_tokens_per_sentence)
+        print(f">> {name}: {len(sentences)} sentences, lengths: {sorted(len(s) for s in sentences)}")
+        for planner_name, planner in planners.items():
+            buckets = planner(sentences, bucket_max_size=bucket_max_size, num_beams=num_beams,
+                              max_mel_tokens=max_mel_tokens)
+            stats = plan_stats(tts, buckets, num_beams, max_mel_tokens)
+            # infer_fast() calls `self.bucket_sentences()`
+            tts.bucket_sentences = planner
+            if "cuda" in tts.device:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            tts.infer_fast("tests/sample_prompt.wav", text, None, max_text_tokens_per_sentence=max_text_tokens_per_sentence,
+                           sentences_bucket_max_size=bucket_max_size, num_beams=num_beams, max_mel_tokens=max_mel_tokens)
+            if "cuda" in tts.device:
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            del tts.bucket_sentences
+            print(f">> {name} {planner_name:>12}: buckets: {stats['buckets']:2d}, "
+                  f"text padding: {stats['text_padding']:.1%}, cost padding: {stats['cost_padding']:.1%}, "
+                  f"max bucket cost: {stats['max_bucket_cost'] / 1e6:.2f}M, decode steps: {stats['decode_steps']}, "
+                  f"infer_fast: {elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    """
+    Compare the token-budget bucketing of `IndexTTS.infer_fast()` with the previous length bucketing,
+    on the long Chinese and English texts of tests/cases.jsonl.
+    ```
+    python tests/bucketing_benchmark.py [model_dir] [bucket_max_size]
+    ```
+    On CPU, `infer_fast()` decodes every sentence alone, only the padding figures are meaningful.
+    """
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    bucket_max_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    with open(CASES_PATH, encoding="utf-8") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    long_cases = [case["text"] for case in cases if case["infer_mode"] == 1]
+    texts = {
+        "en": max((t for t in long_cases if t.isascii()), key=len),
+        "zh": max((t for t in long_cases if not t.isascii()), key=len),
+    }
+    tts = IndexTTS(cfg_path=os.path.join(model_dir, "config.yaml"), model_dir=model_dir, is_fp16=False, use_cuda_kernel=False)
+    bench_bucketing(tts, texts, bucket_max_size=bucket_max_size)
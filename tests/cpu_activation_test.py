@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from indextts.BigVGAN.activations import Snake, SnakeBeta
+from indextts.BigVGAN.alias_free_activation.cpu.activation1d import Activation1d as CpuActivation1d
+from indextts.BigVGAN.alias_free_torch import Activation1d
+from stream_vocoder_test import build_tiny_bigvgan
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "checkpoints", "config.yaml")
+
+
+def make_activations(channels, snake_beta=True, alpha_logscale=True):
+    activation = (SnakeBeta if snake_beta else Snake)(channels, alpha_logscale=alpha_logscale)
+    for p in activation.parameters():
+        p.data = p.data + 0.3 * torch.randn_like(p) if alpha_logscale else torch.rand_like(p) + 0.5
+    reference = Activation1d(activation)
+    fused = CpuActivation1d(activation)
+    fused.load_state_dict(reference.state_dict())
+    return reference, fused
+
+
+@torch.no_grad()
+def test_same_as_torch():
+    torch.manual_seed(0)
+    for snake_beta in (True, False):
+        for alpha_logscale in (True, False):
+            reference, fused = make_activations(24, snake_beta, alpha_logscale)
+            for shape in ((1, 24, 1), (1, 24, 7), (3, 24, 200)):
+                x = torch.randn(shape)
+                torch.testing.assert_close(fused(x), reference(x), rtol=1e-5, atol=1e-5)
+            # the constants follow the parameters
+            reference.act.alpha.add_(0.1)
+            x = torch.randn(2, 24, 50)
+            torch.testing.assert_close(fused(x), reference(x), rtol=1e-5, atol=1e-5)
+    # grad mode runs the unfused path
+    with torch.enable_grad():
+        x = torch.randn(1, 24, 30, requires_grad=True)
+        fused(x).sum().backward()
+    assert x.grad is not None
+
+
+@torch.no_grad()
+def test_bigvgan():
+    model, speaker_conds, _, dim = build_tiny_bigvgan()
+    cfg = OmegaConf.load(CONFIG_PATH).bigvgan
+    cfg.upsample_initial_channel = 64
+    cfg.gpt_dim = dim
+    cfg.speaker_embedding_dim = 16
+    fused = type(model)(cfg, use_cpu_kernel=True)
+    fused.remove_weight_norm()
+    fused.load_state_dict(model.state_dict())
+    fused.eval()
+    assert isinstance(fused.activation_post, CpuActivation1d)
+    latents = torch.randn(2, 40, dim)
+    torch.testing.assert_close(fused(latents, speaker_conds=speaker_conds)[0],
+                               model(latents, speaker_conds=speaker_conds)[0], rtol=1e-4, atol=1e-5)
+
+
+@torch.no_grad()
+def benchmark(frames=24, repeats=10):
+    """
+    Per-layer timing of the anti-aliased activations of the release BigVGAN, for ``frames`` latent frames (~1 s).
+    """
+    cfg = OmegaConf.load(CONFIG_PATH).bigvgan
+    length = frames
+    total = [0.0, 0.0]
+    for i, rate in enumerate(cfg.upsample_rates):
+        channels = cfg.upsample_initial_channel // (2 ** (i + 1))
+        length *= rate
+        reference, fused = make_activations(channels)
+        x = torch.randn(1, channels, length)
+        results = []
+        for fn in (reference, fused):
+            fn(x)  # warmup
+            start = time.perf_counter()
+            for _ in range(repeats):
+                fn(x)
+            results.append((time.perf_counter() - start) / repeats)
+        # 6 activations per AMP block, one block per resblock kernel
+        count = 6 * len(cfg.resblock_kernel_sizes)
+        total[0] += results[0] * count
+        total[1] += results[1] * count
+        print(f">> stage {i}: channels={channels:4d} length={length:6d} torch: {results[0] * 1000:7.2f} ms, "
+              f"cpu: {results[1] * 1000:7.2f} ms, speedup: {results[0] / results[1]:.2f}x, x{count} per stage")
+    print(f">> all activations: torch: {total[0] * 1000:.1f} ms, cpu: {total[1] * 1000:.1f} ms, "
+          f"speedup: {total[0] / total[1]:.2f}x, threads: {torch.get_num_threads()}")
+
+
+if __name__ == "__main__":
+    """
+    Compare the CPU path of the anti-aliased activation with `alias_free_torch.Activation1d`, and benchmark
+    both per layer of BigVGAN.
+    ```
+    python tests/cpu_activation_test.py
+    python tests/cpu_activation_test.py bench [frames]
+    ```
+    """
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 24)
+    else:
+        test_same_as_torch()
+        test_bigvgan()
+        print("ok")
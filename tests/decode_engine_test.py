@@ -0,0 +1,127 @@
+import torch
+import transformers
+
+from batch_decoder_test import build_tiny_gpt
+
+
+def generate(gpt, engine, conds_latent, text_tokens, seed, **kwargs):
+    gpt.decode_engine = engine
+    transformers.set_seed(seed)
+    return gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, max_generate_length=30,
+                                return_latent=True, **kwargs)
+
+
+@torch.no_grad()
+def test_same_codes_as_hf():
+    gpt = build_tiny_gpt()
+    engine = gpt.decode_engine
+    assert engine is not None
+    assert not engine.compact_rows  # bit-exact by default
+    # make the stop token likely, so the rows finish at different steps
+    gpt.mel_head.bias.data[gpt.stop_mel_token] += 1.0
+    conds_latent = torch.randn(2, 32, gpt.model_dim)
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (2, 9))
+    text_tokens[1, 6:] = gpt.stop_text_token
+    for kwargs in (
+        dict(do_sample=False, num_beams=1, repetition_penalty=10.0),
+        dict(do_sample=True, top_k=30, top_p=0.8, temperature=0.7, num_beams=1, repetition_penalty=10.0),
+        dict(do_sample=False, num_beams=3, repetition_penalty=2.0, min_new_tokens=4),
+        dict(do_sample=True, top_k=30, top_p=0.8, temperature=1.0, num_beams=3, repetition_penalty=10.0,
+             length_penalty=0.0, num_return_sequences=2),
+    ):
+        for seed in range(3):
+            expected_codes, expected_latents = generate(gpt, None, conds_latent, text_tokens, seed, **kwargs)
+            codes, latents = generate(gpt, engine, conds_latent, text_tokens, seed, **kwargs)
+            assert torch.equal(codes, expected_codes), (kwargs, seed)
+            assert torch.equal(latents, expected_latents), (kwargs, seed)
+
+
+@torch.no_grad()
+def test_compact_rows():
+    gpt = build_tiny_gpt()
+    engine = gpt.decode_engine
+    gpt.mel_head.bias.data[gpt.stop_mel_token] += 2.0
+    conds_latent = torch.randn(3, 32, gpt.model_dim)
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (3, 9))
+    for kwargs in (
+        dict(do_sample=True, top_k=30, top_p=0.8, num_beams=1, repetition_penalty=10.0),
+        dict(do_sample=True, top_k=30, top_p=0.8, num_beams=3, repetition_penalty=10.0, length_penalty=0.0),
+    ):
+        expected, _ = generate(gpt, engine, conds_latent, text_tokens, 0, **kwargs)
+        full_stats = dict(engine.row_stats)
+        assert full_stats["skipped_row_steps"] == 0
+        codes, _ = generate(gpt, engine, conds_latent, text_tokens, 0, compact_rows=True, **kwargs)
+        # finished rows leave the batch, the random draws of the other rows stay the same
+        assert torch.equal(codes, expected), kwargs
+        assert engine.row_stats["skipped_row_steps"] > 0, engine.row_stats
+        assert sum(engine.row_stats.values()) == full_stats["row_steps"]
+
+
+@torch.no_grad()
+def test_prefix_kv():
+    gpt = build_tiny_gpt()
+    conds_latent = torch.randn(1, 32, gpt.model_dim)
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (3, 9))
+    text_tokens[1, 6:] = gpt.stop_text_token
+    text_tokens[2, 3:] = gpt.stop_text_token
+    prefix_kv = gpt.get_prefix_kv(conds_latent)
+    for kwargs in (
+        dict(do_sample=False, num_beams=1, repetition_penalty=10.0),
+        dict(do_sample=True, top_k=30, top_p=0.8, num_beams=3, repetition_penalty=10.0),
+    ):
+        expected_codes, expected_latents = generate(gpt, gpt.decode_engine, conds_latent, text_tokens, 0, **kwargs)
+        # [cond][pad][text] with the cached prefix, instead of prefilling [pad][cond][text]
+        codes, latents = generate(gpt, gpt.decode_engine, conds_latent, text_tokens, 0, prefix_kv=prefix_kv, **kwargs)
+        assert torch.equal(codes, expected_codes), kwargs
+        torch.testing.assert_close(latents, expected_latents)
+
+
+@torch.no_grad()
+def test_max_lengths():
+    gpt = build_tiny_gpt()
+    engine = gpt.decode_engine
+    engine.compact_rows = False  # bit-exact
+    conds_latent = torch.randn(3, 32, gpt.model_dim)
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (3, 9))
+    max_lengths = torch.tensor([5, 30, 12])
+    for kwargs in (
+        dict(do_sample=True, top_k=30, top_p=0.8, num_beams=1, repetition_penalty=10.0),
+        dict(do_sample=True, top_k=30, top_p=0.8, num_beams=3, repetition_penalty=10.0, length_penalty=0.0),
+    ):
+        # the HF path with `ForcedStopLogitsProcessor`
+        expected, _ = generate(gpt, None, conds_latent, text_tokens, 0, max_lengths=max_lengths, **kwargs)
+        codes, _ = generate(gpt, engine, conds_latent, text_tokens, 0, max_lengths=max_lengths, **kwargs)
+        assert torch.equal(codes, expected), kwargs
+        stop_lens = (codes != gpt.stop_mel_token).long().cumprod(dim=-1).sum(dim=-1)
+        assert (stop_lens <= max_lengths).all(), (kwargs, stop_lens)
+
+
+@torch.no_grad()
+def test_speculative_greedy_matches():
+    gpt = build_tiny_gpt()
+    conds_latent = torch.randn(1, 32, gpt.model_dim)
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (1, 9))
+    kwargs = dict(do_sample=False, num_beams=1, repetition_penalty=10.0, max_generate_length=30)
+    expected = gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, **kwargs)
+    for num_draft_tokens in (1, 4):
+        codes = gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, draft_layers=1,
+                                     num_draft_tokens=num_draft_tokens, **kwargs)
+        # the verification pass scores several positions at once, the argmax is stable here
+        assert torch.equal(codes, expected), num_draft_tokens
+        stats = gpt.decode_engine.speculative_stats
+        assert stats["rounds"] > 0 and 0 <= stats["accepted"] <= stats["drafted"]
+
+
+if __name__ == "__main__":
+    """
+    Compare `DecodeEngine` with the HF `generate()` of `UnifiedVoice.inference_speech()`.
+    ```
+    python tests/decode_engine_test.py
+    ```
+    """
+    test_same_codes_as_hf()
+    test_compact_rows()
+    test_prefix_kv()
+    test_max_lengths()
+    test_speculative_greedy_matches()
+    print("ok")
@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+from batch_decoder_test import build_tiny_gpt
+from indextts.utils.degenerate_output import DegenerateOutputLogitsProcessor
+
+SILENT_TOKEN = 52
+
+
+def test_processor():
+    processor = DegenerateOutputLogitsProcessor(prompt_len=4, stop_token=99, max_silent_run=30, max_cycle_len=8,
+                                                cycle_tokens=24)
+    prompt = torch.ones(3, 4, dtype=torch.long)
+    codes = torch.randint(100, 200, (3, 40))
+    codes[1, -30:] = SILENT_TOKEN  # long silence
+    codes[2, -24:] = torch.tensor([7, 8, 9]).repeat(8)  # loop
+    scores = torch.randn(3, 300)
+    out = processor(torch.cat([prompt, codes], dim=1), scores.clone())
+    assert torch.equal(out[0], scores[0])
+    assert out[1, SILENT_TOKEN] == -float("inf")
+    assert torch.equal(out[1, :SILENT_TOKEN], scores[1, :SILENT_TOKEN])
+    assert out[2].argmax() == 99
+    # not enough tokens yet
+    out = processor(torch.cat([prompt, codes[:, -20:]], dim=1), scores.clone())
+    assert torch.equal(out[2], scores[2])
+
+
+def generate(gpt, conds_latent, text_tokens, **kwargs):
+    results = []
+    for engine in (None, gpt.decode_engine):
+        decode_engine, gpt.decode_engine = gpt.decode_engine, engine
+        torch.manual_seed(0)
+        results.append(gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, max_generate_length=100,
+                                            detect_degenerate=True, **kwargs))
+        gpt.decode_engine = decode_engine
+    assert torch.equal(results[1], results[0]), kwargs
+    return results[0]
+
+
+@torch.no_grad()
+def test_generation():
+    gpt = build_tiny_gpt()
+    conds_latent = torch.randn(2, 32, gpt.model_dim)
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (2, 9))
+    for kwargs in (
+        dict(do_sample=False, num_beams=1),
+        dict(do_sample=True, top_k=30, top_p=0.8, num_beams=3, length_penalty=0.0),
+    ):
+        # degenerate model: always the same code
+        gpt.mel_head.bias.data[SILENT_TOKEN] += 100.0
+        codes = generate(gpt, conds_latent, text_tokens, **kwargs)
+        gpt.mel_head.bias.data[SILENT_TOKEN] -= 100.0
+        # the silent runs are capped
+        silent = (codes == SILENT_TOKEN).long()
+        run = silent.clone()
+        for t in range(1, codes.shape[1]):
+            run[:, t] = (run[:, t - 1] + 1) * silent[:, t]
+        assert run.max() == 30, kwargs
+        gpt.mel_head.bias.data[500] += 100.0
+        codes = generate(gpt, conds_latent, text_tokens, **kwargs)
+        gpt.mel_head.bias.data[500] -= 100.0
+        # the loop is stopped after 24 codes
+        assert codes.shape[1] == 25 and (codes[:, -1] == gpt.stop_mel_token).all(), kwargs
+    # not applied by speculative decoding
+    with pytest.raises(ValueError):
+        gpt.inference_speech(None, text_tokens[:1], conds_latent=conds_latent[:1], max_generate_length=100,
+                             detect_degenerate=True, draft_layers=1, do_sample=False, num_beams=1)
+
+
+if __name__ == "__main__":
+    """
+    Test the in-loop detection of degenerate codes of `UnifiedVoice.inference_speech()`.
+    ```
+    python tests/degenerate_output_test.py
+    ```
+    """
+    test_processor()
+    test_generation()
+    print("ok")
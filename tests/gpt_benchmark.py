@@ -0,0 +1,226 @@
+import copy
+import os
+import sys
+import time
+
+import torch
+import torchaudio
+from omegaconf import OmegaConf
+
+from indextts.gpt.model import UnifiedVoice
+from indextts.gpt.quantization import quantize_gpt_int8
+from indextts.utils.checkpoint import load_checkpoint
+from indextts.utils.feature_extractors import MelSpectrogramFeatures
+
+
+def load_gpt(model_dir, device):
+    cfg = OmegaConf.load(os.path.join(model_dir, "config.yaml"))
+    gpt = UnifiedVoice(**cfg.gpt)
+    gpt_path = os.path.join(model_dir, cfg.gpt_checkpoint)
+    if os.path.exists(gpt_path):
+        load_checkpoint(gpt, gpt_path)
+    else:
+        print(">> checkpoint not found, benchmark with random weights:", gpt_path)
+    gpt = gpt.to(device).eval()
+    gpt.post_init_gpt2_config(use_deepspeed=False, kv_cache=True, half=False)
+    return gpt
+
+
+def load_cond_mel(audio_prompt, device):
+    audio, sr = torchaudio.load(audio_prompt)
+    audio = torch.mean(audio, dim=0, keepdim=True)
+    audio = torchaudio.transforms.Resample(sr, 24000)(audio)
+    return MelSpectrogramFeatures()(audio).to(device)
+
+
+def sync(device):
+    if "cuda" in str(device):
+        torch.cuda.synchronize()
+
+
+def bench_conditioning(gpt, cond_mel, num_sentences=8, text_len=40, max_mel_tokens=50):
+    """
+    Per-sentence cost of recomputing `get_conditioning()` in `inference_speech()` and in `forward(return_latent=True)`,
+    against computing it once per request.
+    """
+    device = cond_mel.device
+    cond_mel_lengths = torch.tensor([cond_mel.shape[-1]], device=device)
+    sentences = [torch.randint(2, gpt.number_text_tokens, (1, text_len), device=device) for _ in range(num_sentences)]
+    kwargs = dict(do_sample=False, num_beams=1, max_generate_length=max_mel_tokens)
+
+    def run(once):
+        sync(device)
+        start = time.perf_counter()
+        conds_latent = gpt.get_conditioning(cond_mel, cond_mel_lengths) if once else None
+        for text_tokens in sentences:
+            codes = gpt.inference_speech(cond_mel, text_tokens, cond_mel_lengths=cond_mel_lengths,
+                                         conds_latent=conds_latent, **kwargs)
+            gpt(cond_mel, text_tokens, torch.tensor([text_tokens.shape[-1]], device=device), codes,
+                torch.tensor([codes.shape[-1]], device=device) * gpt.mel_length_compression,
+                cond_mel_lengths=cond_mel_lengths, return_latent=True, clip_inputs=False, conds_latent=conds_latent)
+        sync(device)
+        return time.perf_counter() - start
+
+    with torch.no_grad():
+        run(True)  # warmup
+        per_sentence = run(False)
+        once = run(True)
+        sync(device)
+        start = time.perf_counter()
+        for _ in range(10):
+            gpt.get_conditioning(cond_mel, cond_mel_lengths)
+        sync(device)
+        cond_time = (time.perf_counter() - start) / 10
+    print(f">> get_conditioning: {cond_time * 1000:.1f} ms/call, cond_mel frames: {cond_mel.shape[-1]}")
+    print(f">> {num_sentences} sentences, conditioning per sentence and pass: {per_sentence:.3f} s")
+    print(f">> {num_sentences} sentences, conditioning once per request:      {once:.3f} s")
+    print(f">> saving: {(per_sentence - once) / num_sentences * 1000:.1f} ms/sentence")
+
+
+def bench_decode(gpt, cond_mel, text_len=40, max_mel_tokens=200, repeats=3):
+    """
+    Decoding throughput of `DecodeEngine` against the HF `generate()`, with the sampling settings of `IndexTTS.infer()`.
+    """
+    device = cond_mel.device
+    conds_latent = gpt.get_conditioning(cond_mel, torch.tensor([cond_mel.shape[-1]], device=device))
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (1, text_len), device=device)
+    engine = gpt.decode_engine
+    for num_beams in (1, 3):
+        kwargs = dict(do_sample=True, top_p=0.8, top_k=30, temperature=1.0, length_penalty=0.0,
+                      repetition_penalty=10.0, num_beams=num_beams, max_generate_length=max_mel_tokens,
+                      min_new_tokens=max_mel_tokens)  # decode exactly max_mel_tokens
+        results = {}
+        for name, decode_engine in (("hf", None), ("native", engine)):
+            gpt.decode_engine = decode_engine
+            with torch.no_grad():
+                gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, **kwargs)  # warmup
+                elapsed = 0.0
+                for i in range(repeats):
+                    torch.manual_seed(i)
+                    sync(device)
+                    start = time.perf_counter()
+                    codes = gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, **kwargs)
+                    sync(device)
+                    elapsed += time.perf_counter() - start
+            results[name] = codes
+            print(f">> num_beams={num_beams} {name:>6}: {codes.shape[-1] * repeats / elapsed:.1f} tokens/s")
+        print(f">> num_beams={num_beams} same codes: {torch.equal(results['hf'], results['native'])}")
+    gpt.decode_engine = engine
+
+
+def bench_speculative(gpt, cond_mel, text_len=40, max_mel_tokens=200, repeats=3):
+    """
+    Acceptance rate and tokens/sec of self-speculative decoding for several drafter depths and draft lengths.
+    """
+    device = cond_mel.device
+    conds_latent = gpt.get_conditioning(cond_mel, torch.tensor([cond_mel.shape[-1]], device=device))
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (1, text_len), device=device)
+    kwargs = dict(do_sample=True, top_p=0.8, top_k=30, temperature=1.0, repetition_penalty=10.0, num_beams=1,
+                  max_generate_length=max_mel_tokens)
+    layers = len(gpt.gpt.h)
+    configs = [(None, 0)] + [(d, k) for d in sorted({max(1, layers // 4), max(1, layers // 2)}) for k in (2, 4, 6)]
+    with torch.no_grad():
+        gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, **kwargs)  # warmup
+        for draft_layers, num_draft_tokens in configs:
+            num_tokens, elapsed, drafted, accepted = 0, 0.0, 0, 0
+            for i in range(repeats):
+                torch.manual_seed(i)
+                sync(device)
+                start = time.perf_counter()
+                codes = gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, draft_layers=draft_layers,
+                                             num_draft_tokens=num_draft_tokens, **kwargs)
+                sync(device)
+                elapsed += time.perf_counter() - start
+                num_tokens += codes.shape[-1]
+                if draft_layers is not None:
+                    drafted += gpt.decode_engine.speculative_stats["drafted"]
+                    accepted += gpt.decode_engine.speculative_stats["accepted"]
+            name = "no drafter" if draft_layers is None else f"draft_layers={draft_layers:2d} k={num_draft_tokens}"
+            acceptance = f", acceptance: {accepted / max(drafted, 1):.1%}" if draft_layers is not None else ""
+            print(f">> {name:>22}: {num_tokens / elapsed:.1f} tokens/s{acceptance}")
+
+
+@torch.no_grad()
+def compare_int8(gpt, int8_gpt, conds_latent, text_tokens, max_mel_tokens=200):
+    """
+    Accuracy of the int8 GPT against float32 on the same inputs:
+        - ``codes``: fraction of the greedy codes that match until the first difference, and overall
+        - ``latent``: relative error of the latents of `forward(return_latent=True)` for the float32 codes
+        - ``argmax``: fraction of the top-1 codes of ``mel_head`` on these latents that match
+    """
+    device = conds_latent.device
+    kwargs = dict(do_sample=False, num_beams=1, max_generate_length=max_mel_tokens, detect_degenerate=False)
+    codes = gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, **kwargs)
+    int8_codes = int8_gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, **kwargs)
+    n = min(codes.shape[-1], int8_codes.shape[-1])
+    same = (codes[:, :n] == int8_codes[:, :n]).float()
+    forward_kwargs = dict(text_lengths=torch.tensor([text_tokens.shape[-1]] * len(text_tokens), device=device),
+                          mel_codes=codes,
+                          wav_lengths=torch.tensor([codes.shape[-1]] * len(codes), device=device) * gpt.mel_length_compression,
+                          conds_latent=conds_latent, return_latent=True, clip_inputs=False)
+    latent = gpt(None, text_tokens, **forward_kwargs)
+    int8_latent = int8_gpt(None, text_tokens, **forward_kwargs)
+    return {
+        "codes_prefix": same.cumprod(dim=-1).mean().item(),
+        "codes": same.mean().item(),
+        "latent": ((int8_latent - latent).norm() / latent.norm()).item(),
+        "argmax": (int8_gpt.mel_head(int8_latent).argmax(dim=-1) == gpt.mel_head(latent).argmax(dim=-1)).float().mean().item(),
+    }
+
+
+def bench_int8(gpt, cond_mel, text_len=40, max_mel_tokens=200, repeats=3):
+    """
+    Decoding throughput and accuracy of the dynamic int8 GPT (see `quantize_gpt_int8()`) against float32, on CPU.
+    """
+    if cond_mel.device.type != "cpu":
+        print(">> int8 quantization runs on CPU only")
+        return
+    int8_gpt = copy.deepcopy(gpt)
+    quantize_gpt_int8(int8_gpt)
+    conds_latent = gpt.get_conditioning(cond_mel, torch.tensor([cond_mel.shape[-1]]))
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (1, text_len))
+    kwargs = dict(do_sample=True, top_p=0.8, top_k=30, temperature=1.0, length_penalty=0.0,
+                  repetition_penalty=10.0, max_generate_length=max_mel_tokens,
+                  min_new_tokens=max_mel_tokens)  # decode exactly max_mel_tokens
+    for num_beams in (1, 3):
+        for name, model in (("fp32", gpt), ("int8", int8_gpt)):
+            with torch.no_grad():
+                model.inference_speech(None, text_tokens, conds_latent=conds_latent, num_beams=num_beams, **kwargs)  # warmup
+                elapsed = 0.0
+                for i in range(repeats):
+                    torch.manual_seed(i)
+                    start = time.perf_counter()
+                    codes = model.inference_speech(None, text_tokens, conds_latent=conds_latent, num_beams=num_beams,
+                                                   **kwargs)
+                    elapsed += time.perf_counter() - start
+            print(f">> num_beams={num_beams} {name}: {codes.shape[-1] * repeats / elapsed:.1f} tokens/s")
+    stats = compare_int8(gpt, int8_gpt, conds_latent, text_tokens, max_mel_tokens)
+    print(f">> greedy codes matching fp32: {stats['codes_prefix']:.1%} until the first difference, {stats['codes']:.1%} overall")
+    print(f">> latents relative error: {stats['latent']:.2%}, top-1 codes matching fp32: {stats['argmax']:.1%}")
+
+
+if __name__ == "__main__":
+    """
+    Benchmark the GPT inference.
+    ```
+    python tests/gpt_benchmark.py conditioning [model_dir]
+    python tests/gpt_benchmark.py decode [model_dir]
+    python tests/gpt_benchmark.py speculative [model_dir]
+    python tests/gpt_benchmark.py int8 [model_dir]
+    ```
+    """
+    benchmarks = {
+        "conditioning": bench_conditioning,
+        "decode": bench_decode,
+        "speculative": bench_speculative,
+        "int8": bench_int8,
+    }
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print("Usage: python tests/gpt_benchmark.py {%s} [model_dir]" % "|".join(benchmarks))
+        sys.exit(1)
+    model_dir = sys.argv[2] if len(sys.argv) > 2 else "checkpoints"
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(42)
+    gpt = load_gpt(model_dir, device)
+    cond_mel = load_cond_mel("tests/sample_prompt.wav", device)
+    benchmarks[sys.argv[1]](gpt, cond_mel)
@@ -0,0 +1,51 @@
+import copy
+
+import torch
+
+from batch_decoder_test import build_tiny_gpt
+from indextts.gpt.quantization import conv1d_to_linear, quantize_gpt_int8
+
+
+@torch.no_grad()
+def test_conv1d_to_linear():
+    conv = build_tiny_gpt().gpt.h[0].attn.c_attn
+    x = torch.randn(2, 5, conv.weight.shape[0])
+    torch.testing.assert_close(conv1d_to_linear(conv)(x), conv(x))
+
+
+@torch.no_grad()
+def test_accuracy():
+    gpt = build_tiny_gpt()
+    int8_gpt = copy.deepcopy(gpt)
+    quantize_gpt_int8(int8_gpt)
+    assert int8_gpt.inference_model.lm_head[1] is int8_gpt.mel_head
+    conds_latent = torch.randn(2, 32, gpt.model_dim)
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (2, 20))
+    kwargs = dict(do_sample=False, num_beams=1, max_generate_length=60, detect_degenerate=False)
+    codes = gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, **kwargs)
+    # the decode engine and the HF `generate()` agree on the quantized model
+    int8_codes = int8_gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, **kwargs)
+    engine, int8_gpt.decode_engine = int8_gpt.decode_engine, None
+    assert torch.equal(int8_gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, **kwargs), int8_codes)
+    int8_gpt.decode_engine = engine
+    # teacher forcing with the float32 codes
+    forward_kwargs = dict(text_lengths=torch.tensor([20, 20]), mel_codes=codes,
+                          wav_lengths=torch.tensor([codes.shape[-1]] * 2) * gpt.mel_length_compression,
+                          conds_latent=conds_latent, return_latent=True, clip_inputs=False)
+    latent = gpt(None, text_tokens, **forward_kwargs)
+    int8_latent = int8_gpt(None, text_tokens, **forward_kwargs)
+    assert (int8_latent - latent).norm() / latent.norm() < 0.05
+    top1 = gpt.mel_head(latent).argmax(dim=-1)
+    assert (int8_gpt.mel_head(int8_latent).argmax(dim=-1) == top1).float().mean() > 0.9
+
+
+if __name__ == "__main__":
+    """
+    Test the dynamic int8 quantization of the GPT, see `tests/gpt_benchmark.py int8` for the tokens/sec.
+    ```
+    python tests/gpt_int8_test.py
+    ```
+    """
+    test_conv1d_to_linear()
+    test_accuracy()
+    print("ok")
@@ -4,6 +4,61 @@ from indextts.infer import IndexTTS
 from indextts.utils.feature_extractors import MelSpectrogramFeatures
 from torch.nn import functional as F
 
+
+def prepare_gpt_inputs_loop(gpt, conditional_latents, text_inputs, cond_first=False):
+    """
+    The per-row loop replaced by the batched `UnifiedVoice.prepare_gpt_inputs()`, returns (inputs_embeds, attention_mask)
+    """
+    b, L = text_inputs.shape[:2]
+    single_cond = conditional_latents.shape[0] == 1
+    target_len = conditional_latents.shape[1] + L + 2
+    batched_mel_emb = []
+    attention_masks = []
+    for i in range(b):
+        valid_mask = (text_inputs[i] != gpt.stop_text_token) & (text_inputs[i] != gpt.start_text_token)
+        text_input = text_inputs[i][valid_mask]
+        text_input = F.pad(text_input, (1, 0), value=gpt.start_text_token)
+        text_input = F.pad(text_input, (0, 1), value=gpt.stop_text_token)
+        text_input_pos = torch.arange(0, text_input.size(-1))
+        text_emb = gpt.text_embedding(text_input) + gpt.text_pos_embedding.emb(text_input_pos)
+        conds_text_emb = [conditional_latents[0] if single_cond else conditional_latents[i], text_emb]
+        attention_mask = torch.ones(target_len + 1, dtype=torch.long)
+        padding = L + 2 - text_input.size(-1)
+        if padding > 0:
+            pad = torch.zeros((padding, conditional_latents.size(-1)), dtype=text_emb.dtype)
+            if cond_first:
+                cond_len = conds_text_emb[0].shape[0]
+                conds_text_emb.insert(1, pad)
+                attention_mask[cond_len:cond_len + padding] = 0
+            else:
+                conds_text_emb.insert(0, pad)
+                attention_mask[:padding] = 0
+        batched_mel_emb.append(torch.cat(conds_text_emb))
+        attention_masks.append(attention_mask)
+    return torch.stack(batched_mel_emb), torch.stack(attention_masks)
+
+
+@torch.no_grad()
+def test_prepare_gpt_inputs():
+    from batch_decoder_test import build_tiny_gpt
+    gpt = build_tiny_gpt()
+    text_tokens = torch.randint(2, gpt.number_text_tokens, (6, 12))
+    text_tokens[1, :4] = gpt.start_text_token  # left bos
+    text_tokens[2, 7:] = gpt.stop_text_token  # right eos
+    text_tokens[3, :2] = gpt.start_text_token
+    text_tokens[3, 9:] = gpt.stop_text_token
+    text_tokens[4, 5:8] = gpt.stop_text_token  # padding in the middle
+    text_tokens[5, :] = gpt.stop_text_token  # empty text
+    for conds_latent in (torch.randn(1, 32, gpt.model_dim), torch.randn(6, 32, gpt.model_dim)):
+        for cond_first in (False, True):
+            expected_embeds, expected_mask = prepare_gpt_inputs_loop(gpt, conds_latent, text_tokens, cond_first)
+            input_ids, inputs_embeds, attention_mask = gpt.prepare_gpt_inputs(conds_latent, text_tokens, cond_first)
+            assert torch.equal(inputs_embeds, expected_embeds), cond_first
+            assert torch.equal(attention_mask, expected_mask), cond_first
+            assert input_ids.shape == attention_mask.shape
+            assert (input_ids[:, -1] == gpt.start_mel_token).all()
+
+
 if __name__ == "__main__":
     """
     Test the padding of text tokens in inference.
@@ -12,6 +67,7 @@ if __name__ == "__main__":
     python tests/padding_test.py IndexTTS-1.5
     ```
     """
+    test_prepare_gpt_inputs()
     import transformers
     transformers.set_seed(42)
     import sys
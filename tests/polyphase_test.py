@@ -0,0 +1,79 @@
+import sys
+import time
+
+import torch
+
+from indextts.BigVGAN import alias_free_torch
+from indextts.BigVGAN.activations import SnakeBeta
+from indextts.BigVGAN.alias_free_activation.torch import act, resample
+
+
+@torch.no_grad()
+def test_same_as_direct():
+    torch.manual_seed(0)
+    for module in (alias_free_torch, resample):
+        for ratio, kernel_size in ((2, 12), (2, None), (3, None), (4, 8)):
+            pairs = (
+                (module.UpSample1d(ratio, kernel_size), module.PolyphaseUpSample1d(ratio, kernel_size)),
+                (module.DownSample1d(ratio, kernel_size), module.PolyphaseDownSample1d(ratio, kernel_size)),
+            )
+            for direct, polyphase in pairs:
+                polyphase.load_state_dict(direct.state_dict())
+                for length in (1, 2, 7, 64, 301):
+                    x = torch.randn(2, 5, length)
+                    expected = direct(x)
+                    out = polyphase(x)
+                    assert out.shape == expected.shape, (type(direct), ratio, length)
+                    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-6)
+
+
+@torch.no_grad()
+def test_activation():
+    torch.manual_seed(0)
+    for module in (alias_free_torch, act):
+        activation = SnakeBeta(16, alpha_logscale=True)
+        direct = module.Activation1d(activation)
+        polyphase = module.Activation1d(activation, polyphase=True)
+        assert direct.state_dict().keys() == polyphase.state_dict().keys()
+        x = torch.randn(2, 16, 100)
+        torch.testing.assert_close(polyphase(x), direct(x), rtol=1e-5, atol=1e-6)
+
+
+@torch.no_grad()
+def benchmark(frames=24, repeats=20):
+    """
+    Timing of the resampling of the anti-aliased activations at every stage of the release BigVGAN,
+    ``frames`` latent frames (~1 s).
+    """
+    channels, length = 1536, frames
+    up, down = alias_free_torch.UpSample1d(2, 12), alias_free_torch.DownSample1d(2, 12)
+    polyphase_up, polyphase_down = alias_free_torch.PolyphaseUpSample1d(2, 12), alias_free_torch.PolyphaseDownSample1d(2, 12)
+    for rate in (4, 4, 4, 4, 2, 2):
+        channels, length = channels // 2, length * rate
+        x = torch.randn(1, channels, length)
+        upsampled = torch.randn(1, channels, 2 * length)
+        results = []
+        for fn, inputs in ((up, x), (polyphase_up, x), (down, upsampled), (polyphase_down, upsampled)):
+            fn(inputs)  # warmup
+            start = time.perf_counter()
+            for _ in range(repeats):
+                fn(inputs)
+            results.append((time.perf_counter() - start) / repeats * 1000)
+        print(f">> channels={channels:4d} length={length:6d} upsample: {results[0]:6.2f} ms, polyphase: {results[1]:6.2f} ms, "
+              f"downsample: {results[2]:6.2f} ms, polyphase: {results[3]:6.2f} ms")
+
+
+if __name__ == "__main__":
+    """
+    Compare the polyphase resampling with `UpSample1d` / `DownSample1d`, and benchmark both.
+    ```
+    python tests/polyphase_test.py
+    python tests/polyphase_test.py bench [frames]
+    ```
+    """
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 24)
+    else:
+        test_same_as_direct()
+        test_activation()
+        print("ok")
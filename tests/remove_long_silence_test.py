@@ -0,0 +1,125 @@
+import sys
+import time
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from indextts.infer import IndexTTS
+
+STOP_MEL_TOKEN = 8193
+SILENT_TOKEN = 52
+
+
+def make_tts():
+    # only `stop_mel_token` is used by the codes post-processing
+    tts = IndexTTS.__new__(IndexTTS)
+    tts.stop_mel_token = STOP_MEL_TOKEN
+    return tts
+
+
+def remove_long_silence_loop(tts, codes, silent_token=52, max_consecutive=30):
+    """
+    The per-row python loop replaced by the batched `IndexTTS.remove_long_silence()`.
+    """
+    code_lens = []
+    codes_list = []
+    isfix = False
+    for i in range(0, codes.shape[0]):
+        code = codes[i]
+        if not torch.any(code == tts.stop_mel_token).item():
+            len_ = code.size(0)
+        else:
+            stop_mel_idx = (code == tts.stop_mel_token).nonzero(as_tuple=False)
+            len_ = stop_mel_idx[0].item() if len(stop_mel_idx) > 0 else code.size(0)
+        count = torch.sum(code == silent_token).item()
+        if count > max_consecutive:
+            ncode_idx = []
+            n = 0
+            for k in range(len_):
+                if code[k] != silent_token:
+                    ncode_idx.append(k)
+                    n = 0
+                elif code[k] == silent_token and n < 10:
+                    ncode_idx.append(k)
+                    n += 1
+            len_ = len(ncode_idx)
+            codes_list.append(code[ncode_idx])
+            isfix = True
+        else:
+            codes_list.append(code[:len_])
+        code_lens.append(len_)
+    if isfix:
+        if len(codes_list) > 1:
+            codes = pad_sequence(codes_list, batch_first=True, padding_value=tts.stop_mel_token)
+        else:
+            codes = codes_list[0].unsqueeze(0)
+    max_len = max(code_lens)
+    if max_len < codes.shape[1]:
+        codes = codes[:, :max_len]
+    return codes, torch.tensor(code_lens, dtype=torch.long, device=codes.device)
+
+
+def random_codes(batch_size, max_len, silence=0.5, generator=None):
+    """
+    Codes with runs of silent tokens, each row stops at a random length and is padded with ``stop_mel_token``.
+    """
+    codes = torch.randint(0, 100, (batch_size, max_len), generator=generator)
+    run_starts = torch.rand(batch_size, max_len, generator=generator) < silence / 8
+    run_lens = torch.randint(1, 30, (batch_size, max_len), generator=generator)
+    for b, k in run_starts.nonzero().tolist():
+        codes[b, k : k + run_lens[b, k]] = SILENT_TOKEN
+    lens = torch.randint(1, max_len + 1, (batch_size,), generator=generator)
+    lens[0] = max_len  # one row without stop token
+    codes[torch.arange(max_len) >= lens.unsqueeze(1)] = STOP_MEL_TOKEN
+    return codes
+
+
+def test_same_as_loop():
+    tts = make_tts()
+    generator = torch.Generator().manual_seed(0)
+    for batch_size in (1, 2, 5, 16):
+        for silence in (0.0, 0.1, 0.5, 1.0):
+            for _ in range(5):
+                codes = random_codes(batch_size, 120, silence=silence, generator=generator)
+                expected_codes, expected_lens = remove_long_silence_loop(tts, codes)
+                out_codes, out_lens = tts.remove_long_silence(codes)
+                assert torch.equal(out_codes, expected_codes), (batch_size, silence)
+                assert torch.equal(out_lens, expected_lens), (batch_size, silence)
+    # every row stops at the first token
+    codes = torch.full((3, 10), STOP_MEL_TOKEN)
+    out_codes, out_lens = tts.remove_long_silence(codes)
+    assert out_codes.shape == (3, 0) and out_lens.tolist() == [0, 0, 0]
+
+
+def benchmark(device, max_len=600, repeats=20):
+    tts = make_tts()
+    for batch_size in (1, 2, 4, 8, 16):
+        codes = random_codes(batch_size, max_len, silence=0.3).to(device)
+        results = []
+        for fn in (remove_long_silence_loop, IndexTTS.remove_long_silence):
+            fn(tts, codes)  # warmup
+            if "cuda" in device:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                fn(tts, codes)
+            if "cuda" in device:
+                torch.cuda.synchronize()
+            results.append((time.perf_counter() - start) / repeats)
+        print(f">> batch_size={batch_size:2d} loop: {results[0] * 1000:8.2f} ms, "
+              f"batched: {results[1] * 1000:6.2f} ms, speedup: {results[0] / results[1]:.1f}x")
+
+
+if __name__ == "__main__":
+    """
+    Compare the batched `IndexTTS.remove_long_silence()` with the per-row loop, and benchmark both.
+    ```
+    python tests/remove_long_silence_test.py
+    python tests/remove_long_silence_test.py bench [device]
+    ```
+    """
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark(sys.argv[2] if len(sys.argv) > 2 else ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    else:
+        test_same_as_loop()
+        print("ok")
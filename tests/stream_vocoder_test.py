@@ -0,0 +1,164 @@
+import os
+import threading
+
+import torch
+from omegaconf import OmegaConf
+
+from batch_decoder_test import build_tiny_gpt
+from indextts.BigVGAN.models import BigVGAN
+from indextts.infer import IndexTTS
+from indextts.utils.mel_length import MelLengthEstimator
+from indextts.utils.stream_vocoder import LatentStreamer, StreamingVocoder
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "checkpoints", "config.yaml")
+
+
+def build_tiny_bigvgan(seed=0, gpt_dim=32):
+    """
+    BigVGAN with the upsampling layout of the release config, but narrow channels and random weights.
+    """
+    cfg = OmegaConf.load(CONFIG_PATH).bigvgan
+    cfg.upsample_initial_channel = 64
+    cfg.gpt_dim = gpt_dim
+    cfg.speaker_embedding_dim = 16
+    torch.manual_seed(seed)
+    model = BigVGAN(cfg)
+    model.remove_weight_norm()
+    model.eval()
+    speaker_conds = model.get_speaker_conds(torch.randn(1, 1, cfg.speaker_embedding_dim))
+    hop_length = 1
+    for r in cfg.upsample_rates:
+        hop_length *= r
+    return model, speaker_conds, hop_length, cfg.gpt_dim
+
+
+def stream(vocode, latents, hop_length, **kwargs):
+    vocoder = StreamingVocoder(vocode, hop_length, **kwargs)
+    chunks = []
+    for t in range(latents.shape[1]):
+        chunks.extend(vocoder.push(latents[:, t : t + 1]))
+    last = vocoder.flush()
+    if last is not None:
+        chunks.append(last)
+    return chunks
+
+
+@torch.no_grad()
+def test_streamed_matches_offline():
+    model, speaker_conds, hop_length, dim = build_tiny_bigvgan()
+    vocode = lambda x: model(x, speaker_conds=speaker_conds)[0].squeeze(1)
+    latents = torch.randn(1, 100, dim)
+    offline = vocode(latents)
+    for chunk_size in (20, 24, 40):
+        chunks = stream(vocode, latents, hop_length, chunk_size=chunk_size, lookback=16, crossfade=4)
+        streamed = torch.cat(chunks, dim=-1)
+        assert streamed.shape == offline.shape, (streamed.shape, offline.shape)
+        rel_err = (streamed - offline).pow(2).mean() / offline.pow(2).mean()
+        assert rel_err < 1e-6, f"chunk_size={chunk_size}: relative error {rel_err:.3e}"
+        # every chunk but the last one holds exactly chunk_size frames
+        assert all(c.shape[-1] == chunk_size * hop_length for c in chunks[:-1])
+    # without context the chunk boundaries are audible
+    chunks = stream(vocode, latents, hop_length, chunk_size=24, lookback=0, crossfade=0)
+    rel_err = (torch.cat(chunks, dim=-1) - offline).pow(2).mean() / offline.pow(2).mean()
+    assert rel_err > 1e-6
+
+
+def build_tiny_tts():
+    """
+    `IndexTTS` with the tiny GPT and BigVGAN, only the attributes used by the streaming inference.
+    """
+    gpt = build_tiny_gpt()
+    model, speaker_conds, hop_length, _ = build_tiny_bigvgan(gpt_dim=gpt.model_dim)
+    tts = IndexTTS.__new__(IndexTTS)
+    tts.gpt, tts.bigvgan, tts.stop_mel_token, tts.dtype, tts.bigvgan_tile_size = gpt, model, gpt.stop_mel_token, None, None
+    tts.cfg, tts.device = OmegaConf.load(CONFIG_PATH), "cpu"
+    tts.mel_length_estimator, tts.mel_length_log = MelLengthEstimator(max_ratio=None), None
+    tts._text_to_tokens = lambda sent: torch.tensor([sent])
+    voice = {"cond_mel": torch.zeros(1, 100, 1), "conds_latent": torch.randn(1, 32, gpt.model_dim),
+             "speaker_conds": speaker_conds}
+    return tts, voice
+
+
+def stream_sentence(tts, speaker_conds, conds_latent, text_tokens, **kwargs):
+    """
+    Streamed chunks of `LatentStreamer` as in `IndexTTS.infer_stream()`, and the generated codes and latents.
+    """
+    vocoder = StreamingVocoder(lambda latent: tts._vocode(latent, speaker_conds), tts.bigvgan.hop_length, **kwargs)
+    streamer = LatentStreamer(tts.gpt.inference_model, vocoder, tts.stop_mel_token)
+    codes, latent = tts.gpt.inference_speech(None, text_tokens, conds_latent=conds_latent, return_latent=True,
+                                             streamer=streamer, do_sample=False, num_beams=1, max_generate_length=90)
+    return list(streamer), codes, latent
+
+
+@torch.no_grad()
+def test_streamed_matches_infer():
+    tts, voice = build_tiny_tts()
+    speaker_conds, conds_latent, hop_length = voice["speaker_conds"], voice["conds_latent"], tts.bigvgan.hop_length
+    text_tokens = torch.randint(2, tts.gpt.number_text_tokens, (1, 12))
+
+    def boundary_errors(lookback, crossfade):
+        chunks, codes, gen_latent = stream_sentence(tts, speaker_conds, conds_latent, text_tokens, chunk_size=24,
+                                                    lookback=lookback, crossfade=crossfade)
+        offline = tts._vocode(tts._sentence_latent(None, conds_latent, text_tokens, codes, gen_latent), speaker_conds)
+        streamed = torch.cat(chunks, dim=-1)
+        assert streamed.shape == offline.shape, (streamed.shape, offline.shape)
+        err = (streamed - offline).abs() / offline.pow(2).mean().sqrt()
+        boundaries = [sum(c.shape[-1] for c in chunks[:k]) for k in range(1, len(chunks))]
+        assert len(boundaries) >= 2
+        # the last frame before a boundary lacks the right context beyond the crossfade,
+        # the frames after the crossfade are vocoded with ``lookback`` frames of left context
+        before = max(err[:, b - hop_length : b].max().item() for b in boundaries)
+        after = max(err[:, b + crossfade * hop_length : b + (crossfade + 2) * hop_length].max().item() for b in boundaries)
+        return before, after
+
+    before, after = boundary_errors(lookback=16, crossfade=4)
+    assert before < 0.05 and after < 1e-5, (before, after)
+    # a short lookback or no crossfade shows at the boundaries
+    assert boundary_errors(lookback=4, crossfade=4)[1] > 1e-4
+    assert boundary_errors(lookback=16, crossfade=0)[0] > 0.5
+
+
+def test_stream_closed_early():
+    tts, voice = build_tiny_tts()
+    sentence = torch.randint(2, tts.gpt.number_text_tokens, (12,)).tolist()
+    gen_kwargs = {"do_sample": False, "num_beams": 1, "max_generate_length": 90}
+    stream = lambda: tts._stream_tokens(voice, [sentence], gen_kwargs, False, chunk_tokens=8, lookback_tokens=4,
+                                        crossfade_tokens=2)
+    threads = threading.active_count()
+    chunks = stream()
+    next(chunks)
+    chunks.close()
+    # the decoding thread is stopped and no longer captures latents
+    assert threading.active_count() == threads
+    assert tts.gpt.inference_model.captured_latents is None
+    # the next request is not mixed with the closed one
+    first = torch.cat([wav for wav, _ in stream()], dim=-1)
+    second = torch.cat([wav for wav, _ in stream()], dim=-1)
+    assert first.shape[-1] == 90 * tts.bigvgan.hop_length
+    torch.testing.assert_close(first, second)
+
+
+def test_window_bookkeeping():
+    # identity "vocoder": every frame becomes hop_length samples of its value
+    hop_length = 4
+    vocode = lambda x: x[..., 0].repeat_interleave(hop_length, dim=1)
+    latents = torch.arange(53, dtype=torch.float32).view(1, 53, 1)
+    chunks = stream(vocode, latents, hop_length, chunk_size=10, lookback=3, crossfade=2)
+    assert [c.shape[-1] // hop_length for c in chunks] == [10, 10, 10, 10, 10, 3]
+    streamed = torch.cat(chunks, dim=-1)
+    torch.testing.assert_close(streamed, vocode(latents))
+
+
+if __name__ == "__main__":
+    """
+    Compare the incremental vocoding of `StreamingVocoder` with vocoding all latents at once, and the
+    `LatentStreamer` decoding of a tiny GPT with the latents and wav of `IndexTTS.infer()`.
+    ```
+    python tests/stream_vocoder_test.py
+    ```
+    """
+    test_window_bookkeeping()
+    test_streamed_matches_offline()
+    test_streamed_matches_infer()
+    test_stream_closed_early()
+    print("ok")
@@ -0,0 +1,85 @@
+import torch
+
+from stream_vocoder_test import build_tiny_bigvgan
+
+
+@torch.no_grad()
+def test_receptive_field():
+    model, speaker_conds, hop_length, dim = build_tiny_bigvgan()
+    latents = torch.randn(1, 160, dim)
+    wav = model(latents, speaker_conds=speaker_conds)[0]
+    perturbed = latents.clone()
+    perturbed[:, 80] += 1.0
+    changed = (model(perturbed, speaker_conds=speaker_conds)[0] - wav).abs()[0, 0].nonzero()
+    field = model.receptive_field()
+    assert changed.min() >= (80 - field) * hop_length
+    assert changed.max() < (81 + field) * hop_length
+
+
+@torch.no_grad()
+def test_tiled_matches_untiled():
+    model, speaker_conds, hop_length, dim = build_tiny_bigvgan()
+    latents = torch.randn(2, 150, dim)
+    speaker_conds = [c.expand(2, -1, -1) for c in speaker_conds]
+    untiled = model(latents, speaker_conds=speaker_conds)[0]
+    for tile_size, crossfade in ((20, 0), (37, 2), (64, 4), (150, 0)):
+        tiled = model.inference_tiled(latents, speaker_conds, tile_size=tile_size, crossfade=crossfade)
+        assert tiled.shape == untiled.shape, (tiled.shape, untiled.shape)
+        torch.testing.assert_close(tiled, untiled, rtol=0, atol=1e-5)
+    # with a short context the tile boundaries differ
+    tiled = model.inference_tiled(latents, speaker_conds, tile_size=20, context=2, crossfade=0)
+    assert (tiled - untiled).abs().max() > 1e-4
+
+
+
+@torch.no_grad()
+def test_padded_batch():
+    model, speaker_conds, hop_length, dim = build_tiny_bigvgan()
+    field = model.receptive_field()
+    lengths = [150, 90, 57]
+    latents = [torch.randn(1, n, dim) for n in lengths]
+    padded = torch.nn.utils.rnn.pad_sequence([l[0] for l in latents], batch_first=True)
+    lengths = torch.tensor(lengths)
+    batched = model(padded, speaker_conds=speaker_conds, lengths=lengths)[0]
+    for latent, row, n in zip(latents, batched, lengths.tolist()):
+        single = model(latent, speaker_conds=speaker_conds)[0][0]
+        assert (row[:, n * hop_length :] == 0).all()
+        # away from the padding, see `test_padded_batch_tail()` for the last frames
+        stable = (n - field) * hop_length
+        torch.testing.assert_close(row[:, :stable], single[:, :stable], rtol=0, atol=1e-5)
+    tiled = model.inference_tiled(padded, speaker_conds, tile_size=32, lengths=lengths)
+    torch.testing.assert_close(tiled, batched, rtol=0, atol=1e-5)
+
+
+@torch.no_grad()
+def test_padded_batch_tail():
+    model, speaker_conds, hop_length, dim = build_tiny_bigvgan()
+    # larger biases than the random init, the padding picks them up at each layer
+    for module in model.modules():
+        if isinstance(module, (torch.nn.Conv1d, torch.nn.ConvTranspose1d)) and module.bias is not None:
+            module.bias.normal_(0, 0.1)
+    field = model.receptive_field()
+    lengths = [120, 70, 45]
+    latents = [torch.randn(1, n, dim) for n in lengths]
+    padded = torch.nn.utils.rnn.pad_sequence([l[0] for l in latents], batch_first=True)
+    batched = model(padded, speaker_conds=speaker_conds, lengths=torch.tensor(lengths))[0]
+    for latent, row, n in zip(latents[1:], batched[1:], lengths[1:]):
+        single = model(latent, speaker_conds=speaker_conds)[0][0]
+        # the samples decoded next to the padding
+        tail = slice((n - field) * hop_length, n * hop_length)
+        torch.testing.assert_close(row[:, tail], single[:, tail], rtol=0, atol=1e-4)
+
+
+if __name__ == "__main__":
+    """
+    Compare the tiled decoding of `BigVGAN.inference_tiled()` and the decoding of padded batches with decoding
+    all latents of a sentence at once.
+    ```
+    python tests/tiled_vocoder_test.py
+    ```
+    """
+    test_receptive_field()
+    test_tiled_matches_untiled()
+    test_padded_batch()
+    test_padded_batch_tail()
+    print("ok")
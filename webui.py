@@ -3,6 +3,7 @@ import os
 import sys
 import threading
 import time
+import uuid
 import gradio as gr
 
 from indextts.infer import IndexTTS
@@ -22,6 +23,8 @@ parser.add_argument("--verbose", action="store_true", default=False, help="Enabl
 parser.add_argument("--port", type=int, default=7860, help="Port to run the web UI on")
 parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to run the web UI on")
 parser.add_argument("--model_dir", type=str, default="checkpoints", help="Model checkpoints directory")
+parser.add_argument("--continuous_batching", action="store_true", default=False, help="Batch the sentences of concurrent requests (num_beams=1 only)")
+parser.add_argument("--max_batch_size", type=int, default=8, help="Max number of sentences decoded together with --continuous_batching")
 cmd_args = parser.parse_args()
 
 if not os.path.exists(cmd_args.model_dir):
@@ -43,6 +46,10 @@ for file in [
 i18n = I18nAuto(language="zh_CN")
 MODE = 'local'
 tts = IndexTTS(model_dir=cmd_args.model_dir, cfg_path=os.path.join(cmd_args.model_dir, "config.yaml"),)
+scheduler = None
+if cmd_args.continuous_batching:
+    from indextts.scheduler import ContinuousBatchScheduler
+    scheduler = ContinuousBatchScheduler(tts, max_batch_size=cmd_args.max_batch_size, verbose=cmd_args.verbose)
 
 
 os.makedirs("outputs/tasks",exist_ok=True)
@@ -62,9 +69,8 @@ def gen_single(prompt, text, infer_mode, max_text_tokens_per_sentence=120, sente
                 *args, progress=gr.Progress()):
     output_path = None
     if not output_path:
-        output_path = os.path.join("outputs", f"spk_{int(time.time())}.wav")
-    # set gradio progress
-    tts.gr_progress = progress
+        # concurrent requests with --continuous_batching can start in the same second
+        output_path = os.path.join("outputs", f"spk_{int(time.time())}_{uuid.uuid4().hex[:8]}.wav")
     do_sample, top_p, top_k, temperature, \
         length_penalty, num_beams, repetition_penalty, max_mel_tokens = args
     kwargs = {
@@ -79,16 +85,25 @@ def gen_single(prompt, text, infer_mode, max_text_tokens_per_sentence=120, sente
         # "typical_sampling": bool(typical_sampling),
         # "typical_mass": float(typical_mass),
     }
-    if infer_mode == "ordinary reasoning":
-        output = tts.infer(prompt, text, output_path, verbose=cmd_args.verbose,
-                           max_text_tokens_per_sentence=int(max_text_tokens_per_sentence),
-                           **kwargs)
-    else:
-        # 批次推理
-        output = tts.infer_fast(prompt, text, output_path, verbose=cmd_args.verbose,
-            max_text_tokens_per_sentence=int(max_text_tokens_per_sentence),
-            sentences_bucket_max_size=(sentences_bucket_max_size),
-            **kwargs)
+    if scheduler is not None and int(num_beams) == 1:
+        # 连续批处理：与其他并发请求共享GPT解码batch（不显示进度）
+        output = scheduler.submit(text, audio_prompt=prompt,
+                                  max_text_tokens_per_sentence=int(max_text_tokens_per_sentence),
+                                  **kwargs).save(output_path)
+        return gr.update(value=output, visible=True)
+    with mutex:
+        # set gradio progress, shared by the requests: set under the mutex
+        tts.gr_progress = progress
+        if infer_mode == "ordinary reasoning":
+            output = tts.infer(prompt, text, output_path, verbose=cmd_args.verbose,
+                               max_text_tokens_per_sentence=int(max_text_tokens_per_sentence),
+                               **kwargs)
+        else:
+            # 批次推理
+            output = tts.infer_fast(prompt, text, output_path, verbose=cmd_args.verbose,
+                max_text_tokens_per_sentence=int(max_text_tokens_per_sentence),
+                sentences_bucket_max_size=(sentences_bucket_max_size),
+                **kwargs)
     return gr.update(value=output,visible=True)
 
 def update_prompt_audio():
@@ -128,7 +143,7 @@ with gr.Blocks(title="IndexTTS Demo") as demo:
                     with gr.Row():
                         top_p = gr.Slider(label="top_p", minimum=0.0, maximum=1.0, value=0.8, step=0.01)
                         top_k = gr.Slider(label="top_k", minimum=0, maximum=100, value=30, step=1)
-                        num_beams = gr.Slider(label="num_beams", value=3, minimum=1, maximum=10, step=1)
+                        num_beams = gr.Slider(label="num_beams", value=1 if scheduler is not None else 3, minimum=1, maximum=10, step=1)
                     with gr.Row():
                         repetition_penalty = gr.Number(label="repetition_penalty", precision=None, value=10.0, minimum=0.1, maximum=20.0, step=0.1)
                         length_penalty = gr.Number(label="length_penalty", precision=None, value=0.0, minimum=-2.0, maximum=2.0, step=0.1)
@@ -204,7 +219,8 @@ with gr.Blocks(title="IndexTTS Demo") as demo:
                              max_text_tokens_per_sentence, sentences_bucket_max_size,
                              *advanced_params,
                      ],
-                     outputs=[output_audio])
+                     outputs=[output_audio],
+                     concurrency_limit=cmd_args.max_batch_size if scheduler is not None else 1)
 
 
 if __name__ == "__main__":